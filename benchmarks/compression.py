@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Purpose: Benchmark the compression of a 4D dwi image written to the derivatives
+
+import os
+import sys
+import gzip
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import nibabel as nib
+
+from dmri_preprocessing import compression
+
+# A multiband dwi series: 1.5 mm isotropic, 100 volumes
+SHAPE = (140, 140, 92, 100)
+
+def make_dwi(filename, shape):
+    """
+    Write a synthetic int16 dwi series: a smooth head-like signal
+    decaying over the volumes, with noise. It compresses about as well as
+    real data (random data would not compress, zeros would compress too
+    well).
+    """
+    rng = np.random.RandomState(0)
+    x, y, z = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape[:3]], indexing='ij')
+    head = np.clip(1.0 - (x**2 + y**2 + z**2), 0, None).astype(np.float32)
+    data = np.empty(shape, dtype=np.int16)
+    for volume in range(shape[3]):
+        signal = 1000 * head * np.exp(-0.5 * (volume % 10) / 10.0)
+        noise = rng.normal(0, 20, shape[:3]) * (head > 0)
+        data[..., volume] = np.clip(signal + noise, 0, None)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), filename)
+
+def time_run(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+def main():
+    shape = SHAPE
+    if len(sys.argv) > 1:
+        shape = tuple([int(dim) for dim in sys.argv[1].split('x')])
+    n_cpus = os.cpu_count()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp_dir, 'dwi.nii')
+        make_dwi(src, shape)
+        size_mb = os.path.getsize(src) / 1e6
+        print(f"{'x'.join([str(dim) for dim in shape])} int16: {size_mb:.0f} MB, {n_cpus} cpus")
+        print(f"  {'method':38s} {'time':>7s} {'MB/s':>7s} {'ratio':>6s}")
+
+        def single_threaded_gzip():
+            # The path before parallel compression (gzip.open, level 6)
+            with open(src,'rb') as f_in, gzip.open(dst,'wb',compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1 << 20)
+
+        dst = os.path.join(tmp_dir, 'dwi.nii.gz')
+        runs = [('gzip.open, level 6', single_threaded_gzip)]
+        for level in [1, 6]:
+            for n_threads in sorted(set([1, 2, 4, n_cpus])):
+                runs.append((
+                    f"compress_file, level {level}, {n_threads} threads",
+                    lambda level=level, n_threads=n_threads: compression.compress_file(src, dst, level, n_threads)
+                ))
+        for name, func in runs:
+            seconds = time_run(func)
+            ratio = size_mb / (os.path.getsize(dst) / 1e6)
+            print(f"  {name:38s} {seconds:6.2f}s {size_mb/seconds:7.0f} {ratio:6.2f}")
+
+        # The output is read by nibabel as one stream
+        assert np.array_equal(np.asanyarray(nib.load(dst).dataobj), np.asanyarray(nib.load(src).dataobj))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
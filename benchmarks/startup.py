@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# Purpose: Benchmark the startup time of the command line interface
+
+import sys
+import time
+import subprocess
+
+# Modules of the scientific stack, which the command line interface should
+# not import before a session is processed
+HEAVY_MODULES = [
+    'numpy', 'pandas', 'nibabel', 'nipype', 'bids', 'nilearn',
+    'niworkflows', 'matplotlib', 'seaborn', 'jinja2'
+]
+
+def run_python(code):
+    """
+    Run python code in a fresh interpreter and return the wall time and
+    the output.
+    """
+    start = time.time()
+    cmd = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    return time.time() - start, cmd.stdout + cmd.stderr
+
+def time_code(code, n_repeats):
+    """
+    Median wall time (s) of running code in a fresh interpreter.
+    """
+    times = sorted([run_python(code)[0] for i in range(n_repeats)])
+    return times[len(times)//2]
+
+def main(n_repeats=5):
+    cli = "from dmri_preprocessing import dmri_preprocessing as m; "
+    benchmarks = {
+        'python': "pass",
+        'import cli': cli,
+        'parse_args': cli + "m.parse_args(['in','out','participant','-w','work'])",
+        '--version': cli + "m.parse_args(['--version'])",
+        '--help': cli + "m.parse_args(['--help'])",
+        'import workflows (for comparison)': "from dmri_preprocessing import workflows",
+    }
+    print(f"Median wall time of {n_repeats} runs:")
+    for name, code in benchmarks.items():
+        print(f"  {name:35s} {time_code(code, n_repeats):6.3f} s")
+
+    # Which heavy modules are loaded by parse_args
+    check = (cli + "m.parse_args(['in','out','participant','-w','work']); import sys; "
+             "print(' '.join(sorted(set(name.split('.')[0] for name in sys.modules))))")
+    loaded = run_python(check)[1].split()
+    heavy_loaded = [module for module in HEAVY_MODULES if module in loaded]
+    print("Heavy modules loaded by parse_args: " + (", ".join(heavy_loaded) if heavy_loaded else "none"))
+
+if __name__ == "__main__":
+    main()
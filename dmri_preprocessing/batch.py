@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# Purpose: Run the pipeline on several subjects and sessions
+
+import os
+import csv
+import argparse
+import glob
+import time
+import fnmatch
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# Seconds between checks of the size of the running sessions while a
+# session waits for room (--max-work-disk). Intermediates are deleted while sessions
+# run (--gc_work_dir), not only when they finish.
+QUOTA_POLL_INTERVAL = 30
+
+# Units of --max-work-disk
+SIZE_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+def strip_label(label, prefix):
+    """
+    Remove the BIDS prefix (e.g. 'sub-') from a label.
+    """
+    if label.startswith(prefix):
+        return label[len(prefix):]
+    return label
+
+def get_sessions(bids_dir, participant_labels=None, session_labels=None):
+    """
+    Find all subject and session pairs in a BIDS dataset.
+
+    Input
+    =====
+    bids_dir:
+        root folder of BIDS dataset.
+    participant_labels:
+        list of subject labels or glob patterns (the sub- prefix can be
+        removed). None selects all subjects.
+    session_labels:
+        list of session labels or glob patterns (the ses- prefix can be
+        removed). None selects all sessions.
+
+    Output
+    ======
+    sessions:
+        sorted list of (subject, session) tuples, without prefixes.
+    """
+    if participant_labels is None:
+        participant_labels = ['*']
+    if session_labels is None:
+        session_labels = ['*']
+    participant_labels = [strip_label(label, 'sub-') for label in participant_labels]
+    session_labels = [strip_label(label, 'ses-') for label in session_labels]
+
+    sessions = []
+    for session_dir in glob.glob(os.path.join(bids_dir, 'sub-*', 'ses-*')):
+        if not os.path.isdir(session_dir):
+            continue
+        subject = strip_label(os.path.basename(os.path.dirname(session_dir)), 'sub-')
+        session = strip_label(os.path.basename(session_dir), 'ses-')
+        if (any([fnmatch.fnmatchcase(subject, label) for label in participant_labels])
+            and any([fnmatch.fnmatchcase(session, label) for label in session_labels])):
+            sessions.append((subject, session))
+
+    return sorted(sessions)
+
+def parse_shard(value):
+    """
+    Parse a shard given as INDEX/COUNT, e.g. 0/10. INDEX starts at 0.
+
+    Output
+    ======
+    shard:
+        tuple (index, count).
+    """
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be INDEX/COUNT, e.g. 0/10, got: %s" % value)
+    if count < 1 or index < 0 or index >= count:
+        raise argparse.ArgumentTypeError("shard INDEX must be in 0..COUNT-1, got: %s" % value)
+    return index, count
+
+def get_session_cost(bids_dir, subject, session):
+    """
+    Estimated cost of processing a session: number of volumes times number
+    of voxels per volume of all dwi files. Only the NIfTI headers are read.
+    """
+    from dmri_preprocessing import planner
+
+    dwi_files = glob.glob(os.path.join(bids_dir, 'sub-'+subject, 'ses-'+session, 'dwi', '*_dwi.nii*'))
+    cost = 0
+    for dwi_file in dwi_files:
+        info = planner.get_image_info(dwi_file)
+        cost += info['n_volumes'] * info['n_voxels']
+    return cost
+
+def parse_size(value):
+    """
+    Parse a size given as a number of bytes or with a unit, e.g. 500G.
+
+    Output
+    ======
+    size:
+        size in bytes.
+    """
+    unit = value[-1:].upper()
+    try:
+        if unit in SIZE_UNITS:
+            size = float(value[:-1]) * SIZE_UNITS[unit]
+        else:
+            size = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("size must be a number with an optional unit K, M, G or T, e.g. 500G, got: %s" % value)
+    if size <= 0:
+        raise argparse.ArgumentTypeError("size must be positive, got: %s" % value)
+    return int(size)
+
+def get_session_disk(bids_dir, subject, session):
+    """
+    Estimated size (bytes) of the work directory of a session, with all
+    intermediates kept (see planner.estimate_session_disk).
+    """
+    from dmri_preprocessing import planner
+    return planner.estimate_session_disk(get_session_cost(bids_dir, subject, session)) * 1000000
+
+def get_session_work_dir(opts, application_name, subject, session):
+    """
+    Glob pattern of the folder a session writes its files in while it
+    runs: its folder in the work directory, or with --scratch_dir its
+    scratch folder (see staging.staged_session).
+    """
+    if opts.scratch_dir is not None:
+        from dmri_preprocessing import staging
+        prefix = staging.get_scratch_prefix(application_name, subject, session)
+        return os.path.join(glob.escape(opts.scratch_dir), glob.escape(prefix) + '*')
+    session_wf_dir = 'sub-' + subject + '_ses-' + session + '_wf'
+    return glob.escape(os.path.join(opts.work_dir, application_name + '_wf', session_wf_dir))
+
+def get_disk_usage(path):
+    """
+    Bytes used by the files under path, like du. Hard linked files are
+    counted once and symlinks are not followed.
+    """
+    usage = 0
+    seen = set()
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                # Deleted by a running session
+                continue
+            if (stat.st_dev, stat.st_ino) in seen:
+                continue
+            seen.add((stat.st_dev, stat.st_ino))
+            usage += stat.st_blocks * 512
+    return usage
+
+def has_disk_room(disk_quota, running_dirs, reserved_bytes, session_bytes):
+    """
+    Check if a session can be started within --max-work-disk.
+
+    The running sessions have not written all their files yet, so the
+    usage is the largest of the measured size of their folders and their
+    estimated size. Only the folders of the running sessions are measured:
+    the folders left by finished sessions (or other runs) do not count,
+    and are not walked at each check.
+
+    Input
+    =====
+    disk_quota:
+        dict with 'max_bytes' (see run_batch).
+    running_dirs:
+        glob patterns of the folders of the running sessions (see
+        get_session_work_dir).
+    reserved_bytes:
+        estimated size of the running sessions.
+    session_bytes:
+        estimated size of the session.
+    """
+    measured_bytes = sum([get_disk_usage(path) for pattern in running_dirs for path in glob.glob(pattern)])
+    used_bytes = max(measured_bytes, reserved_bytes)
+    return used_bytes + session_bytes <= disk_quota['max_bytes']
+
+def shard_sessions(sessions, costs, shard_index, shard_count):
+    """
+    Split sessions into shard_count shards with about the same total cost,
+    and return the sessions of shard shard_index.
+
+    Sessions are given to shards from the most to the least costly, each
+    to the shard with the lowest total cost so far (ties to the lowest
+    shard index). The split only depends on the sessions and their costs,
+    so all array jobs compute the same split.
+
+    Input
+    =====
+    sessions:
+        list of (subject, session) tuples.
+    costs:
+        list of estimated cost of each session.
+    shard_index:
+        index of the shard, from 0 to shard_count-1.
+    shard_count:
+        number of shards.
+
+    Output
+    ======
+    shard:
+        sorted list of (subject, session) tuples in the shard.
+    """
+    order = sorted(zip(costs, sessions), key=lambda item: (-item[0], item[1]))
+    loads = [0] * shard_count
+    shards = [[] for i in range(shard_count)]
+    for cost, session in order:
+        index = min(range(shard_count), key=lambda i: (loads[i], i))
+        loads[index] += cost
+        shards[index].append(session)
+    return sorted(shards[shard_index])
+
+def _run_session_safe(run_session, opts, subject, session, cpu_budget):
+    """
+    Run one session and catch any error, so that one failing session does
+    not stop the other sessions in the batch.
+    """
+    start = time.time()
+    result = {
+        'subject': subject,
+        'session': session,
+        'status': 'success',
+        'duration_s': 0.0,
+        'error': ''
+    }
+    try:
+        run_session(opts, subject, session, cpu_budget)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+        print(f"sub-{subject} ses-{session} failed:\n{traceback.format_exc()}")
+    result['duration_s'] = round(time.time() - start, 1)
+    return result
+
+def _failed_result(subject, session, error):
+    # The worker process died, e.g. killed because of memory
+    return {
+        'subject': subject,
+        'session': session,
+        'status': 'failed',
+        'duration_s': '',
+        'error': repr(error)
+    }
+
+def write_summary(results, summary_file):
+    """
+    Write a .tsv file with one row per session in the batch.
+    """
+    os.makedirs(os.path.dirname(summary_file), exist_ok=True)
+    columns = ['subject', 'session', 'status', 'duration_s', 'error']
+    with open(summary_file, 'w', newline='') as tsv_file:
+        writer = csv.DictWriter(tsv_file, fieldnames=columns, delimiter='\t')
+        writer.writeheader()
+        for result in sorted(results, key=lambda r: (r['subject'], r['session'])):
+            writer.writerow(result)
+
+def run_batch(run_session, opts, sessions, n_workers, cpu_budget, summary_file, disk_quota=None):
+    """
+    Process sessions in a bounded pool of worker processes.
+
+    With a disk quota, a session is only started when there is room for
+    it next to the running sessions (see has_disk_room), so that running sessions do not
+    fill the disk. A session is always started when no session is
+    running, even if it is estimated to be larger than the quota.
+
+    Input
+    =====
+    run_session:
+        function processing one session, called as
+        run_session(opts, subject, session, cpu_budget).
+    opts:
+        parsed command line options.
+    sessions:
+        list of (subject, session) tuples.
+    n_workers:
+        maximum number of sessions processed at the same time.
+    cpu_budget:
+        path to cpu budget file shared by all sessions.
+    summary_file:
+        path to .tsv file summarising successes and failures.
+    disk_quota:
+        dict with 'max_bytes' (--max-work-disk), 'session_dirs' (the
+        folder each session writes in, see get_session_work_dir) and
+        'session_bytes' (estimated size of each session, see
+        get_session_disk), or None.
+
+    Output
+    ======
+    results:
+        list of dicts with status for each session.
+    """
+    results = []
+    pending = list(sessions)
+    session_bytes = {}
+    session_dirs = {}
+    if disk_quota is not None:
+        session_bytes = dict(zip(sessions, disk_quota['session_bytes']))
+        session_dirs = dict(zip(sessions, disk_quota['session_dirs']))
+    waiting = None
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {}
+        while len(pending) > 0 or len(futures) > 0:
+            # Start sessions while there are free workers and room in the
+            # work directory
+            while len(pending) > 0 and len(futures) < n_workers:
+                subject, session = pending[0]
+                if disk_quota is not None and len(futures) > 0:
+                    running_dirs = [session_dirs[running] for running in futures.values()]
+                    reserved_bytes = sum([session_bytes[running] for running in futures.values()])
+                    if not has_disk_room(disk_quota, running_dirs, reserved_bytes, session_bytes[(subject, session)]):
+                        if waiting != (subject, session):
+                            print(f"sub-{subject} ses-{session}: waiting for room in the work directory "
+                                  f"(--max-work-disk), {len(futures)} sessions running")
+                            waiting = (subject, session)
+                        break
+                pending.pop(0)
+                try:
+                    future = executor.submit(_run_session_safe, run_session, opts, subject, session, cpu_budget)
+                except Exception as e:
+                    # A worker process died before, the pool is broken
+                    print(f"sub-{subject} ses-{session}: failed")
+                    results.append(_failed_result(subject, session, e))
+                    continue
+                futures[future] = (subject, session)
+
+            if len(futures) == 0:
+                continue
+            timeout = QUOTA_POLL_INTERVAL if len(pending) > 0 else None
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                subject, session = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = _failed_result(subject, session, e)
+                print(f"sub-{subject} ses-{session}: {result['status']}")
+                results.append(result)
+
+    write_summary(results, summary_file)
+    return results
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# Purpose: Apply a 3D bias field to a 4D series in-process, one volume at a time (replaces fslmaths -div)
+
+import os
+
+import numpy as np
+
+from dmri_preprocessing import compression, concat, frames
+
+def divide_volume(volume, bias, out_dtype):
+    """
+    Divide a volume by the bias field, 0 where the field is 0 (like
+    fslmaths -div), and cast it to the output data type. Integer outputs
+    are rounded and clipped to the range of the type.
+    """
+    out = np.zeros(volume.shape, dtype=np.float32)
+    np.divide(volume, bias, out=out, where=bias != 0)
+    if out_dtype.kind in 'iu':
+        info = np.iinfo(out_dtype)
+        out = np.clip(np.rint(out), info.min, info.max)
+    return out.astype(out_dtype)
+
+def apply_bias_field(in_file, bias_file, out_file, frame_nrs=(), compresslevel=6, n_threads=1):
+    """
+    Divide every volume of in_file by the 3D bias field, like fslmaths
+    in_file -div bias_file out_file.
+
+    The bias field is loaded once. The volumes are read in order, divided
+    in threads, and written in order, with at most 2 x n_threads volumes
+    in memory. A .nii.gz output is written in gzip blocks (see
+    compression.BlockGzipWriter); the n_threads threads are then split
+    between the division and the compression. The output is written next to out_file and renamed when it
+    is complete, or removed if the correction fails.
+
+    The frames frame_nrs (e.g. the low and high b-value volumes of the qc
+    plots) of in_file and out_file are written to their frame files in the
+    same pass, where frames.extract_frames finds them.
+
+    Input
+    =====
+    in_file: path to 3D or 4D image (.nii or .nii.gz).
+    bias_file: path to 3D bias field, on the grid of in_file.
+    out_file: path to output image (.nii or .nii.gz).
+    frame_nrs: frames written to frame files.
+    compresslevel: gzip compression level of a .nii.gz output.
+    n_threads: number of threads dividing and compressing the volumes.
+
+    Output
+    ======
+    out_file: path to output image.
+    """
+    import nibabel as nib
+    from concurrent.futures import ThreadPoolExecutor, Future
+
+    img = nib.load(in_file, keep_file_open=True)
+    bias = np.asarray(nib.load(bias_file).dataobj, dtype=np.float32)
+    assert bias.shape == img.shape[:3], \
+        f"{bias_file} has shape {bias.shape}, but {in_file} has shape {img.shape[:3]}"
+
+    header = img.header.copy()
+    scaled = (img.dataobj.slope, img.dataobj.inter) != (1.0, 0.0)
+    # The data type of in_file, like fslmaths, unless it is scaled
+    if scaled or img.get_data_dtype().kind not in 'iuf':
+        header.set_data_dtype(np.float32)
+    header.set_slope_inter(None, None)
+    out_dtype = header.get_data_dtype()
+    header_bytes = concat.get_header_bytes(header)
+
+    n_volumes = img.shape[3] if len(img.shape) > 3 else 1
+    frame_nrs = sorted(set([int(frame_nr) for frame_nr in frame_nrs]))
+    assert all([0 <= frame_nr < n_volumes for frame_nr in frame_nrs]), \
+        f"{in_file} has {n_volumes} volumes, frames {frame_nrs} were requested"
+    in_frames = {}
+    out_frames = {}
+    tmp_file = out_file + '.tmp%d' % os.getpid()
+
+    # The compression gets the threads the division does not use. A
+    # single thread divides and compresses in turn (BlockGzipWriter
+    # compresses in the calling thread when it has one thread).
+    n_divide_threads = n_threads
+    if out_file.endswith('.gz'):
+        n_divide_threads = max(1, n_threads // 2)
+    n_compress_threads = max(1, n_threads - n_divide_threads)
+    executor = ThreadPoolExecutor(max_workers=n_divide_threads) if n_threads > 1 else None
+    try:
+        if out_file.endswith('.gz'):
+            f_out = compression.BlockGzipWriter(tmp_file, compresslevel, n_compress_threads)
+        else:
+            f_out = open(tmp_file,'wb')
+        with f_out:
+            f_out.write(header_bytes)
+            pending = []
+            for volume_nr in range(n_volumes):
+                # Read in order, so a gzipped input is decompressed once
+                volume = np.asarray(img.dataobj[..., volume_nr] if len(img.shape) > 3 else img.dataobj[...])
+                if volume_nr in frame_nrs:
+                    in_frames[volume_nr] = volume
+                if executor is None:
+                    future = Future()
+                    future.set_result(divide_volume(volume, bias, out_dtype))
+                else:
+                    future = executor.submit(divide_volume, volume, bias, out_dtype)
+                pending.append((volume_nr, future))
+                # Bounded memory: wait for the oldest volumes
+                while len(pending) > n_divide_threads or (volume_nr == n_volumes - 1 and len(pending) > 0):
+                    done_nr, future = pending.pop(0)
+                    corrected = future.result()
+                    if done_nr in frame_nrs:
+                        out_frames[done_nr] = corrected
+                    f_out.write(corrected.tobytes(order='F'))
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    os.replace(tmp_file, out_file)
+
+    # After the output is in place, so the frame files are newer than it
+    for frame_nr in frame_nrs:
+        if not frames.is_up_to_date(frames.get_frame_filename(in_file, frame_nr), in_file):
+            frames.save_frame(in_file, frame_nr, in_frames[frame_nr], img.affine, img.header)
+        frames.save_frame(out_file, frame_nr, out_frames[frame_nr], img.affine, header)
+    return out_file
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# Purpose: Delete intermediate files in the work directory as soon as no stage needs them (--gc_work_dir)
+
+import os
+import glob
+import json
+
+from dmri_preprocessing import utils, gzindex
+
+def get_consumers(graph, stage_names):
+    """
+    Stages which get the outputs of each stage: its successors in the
+    workflow graph. Nodes which are not stages (e.g. merge_figures) pass
+    their inputs on, so their successors are used instead.
+
+    Input
+    =====
+    graph:
+        flat nipype workflow graph (networkx DiGraph of nodes).
+    stage_names:
+        names of the nodes which are stages (run through stages.run_stage).
+
+    Output
+    ======
+    consumers:
+        dict with sorted list of consumer stage names of each stage.
+    """
+    def stage_successors(node, seen):
+        names = set()
+        for successor in graph.successors(node):
+            if successor.name in stage_names:
+                names.add(successor.name)
+            elif successor not in seen:
+                seen.add(successor)
+                names |= stage_successors(successor, seen)
+        return names
+
+    return {
+        node.name: sorted(stage_successors(node, set()))
+        for node in graph.nodes() if node.name in stage_names
+    }
+
+def get_derived_files(path):
+    """
+    Files made next to an image when it is read: extracted frames (see
+    frames.extract_frames) and gzip indexes (see gzindex.open_indexed).
+    """
+    try:
+        base, extension = utils.split_nifti_ext(path)
+    except ValueError:
+        return []
+    # Frame numbers have at least two digits (see frames.get_frame_filename)
+    derived = [frame_file for frame_file in glob.glob(glob.escape(base) + '_[0-9]*' + extension)
+               if frame_file[len(base) + 1:-len(extension)].isdigit()]
+    derived += [gzindex.get_index_filename(path, True), gzindex.get_index_filename(path, False)]
+    return sorted([derived_file for derived_file in derived if os.path.exists(derived_file)])
+
+def delete_intermediate(path, mode):
+    """
+    Delete the files derived from a file no stage needs anymore. With
+    mode 'all' the file itself is deleted too, with 'keep_checkpoints' it
+    is kept, as it is an output in the checkpoint of a stage. Links are
+    removed, not the files they point to.
+
+    Output
+    ======
+    deleted:
+        list of deleted files.
+    """
+    deleted = []
+    for derived_file in get_derived_files(path):
+        os.remove(derived_file)
+        deleted.append(derived_file)
+    if mode == 'all' and os.path.lexists(path):
+        os.remove(path)
+        deleted.append(path)
+    return deleted
+
+def release(gc, stage_name, output_files, work_dir):
+    """
+    Called when a stage is done (run or cached). Registers the work
+    directory files in the outputs of the stage with the stages getting
+    them, and releases the files this stage got. Files which are
+    released by all their consumers are deleted.
+
+    A file can only reach a stage through the outputs of a stage before
+    it, which registers the file before the stage starts. A file passed
+    on by a stage (e.g. the brain mask in data) is registered with the
+    consumers of that stage before the stage releases it. So a file is
+    never deleted while a stage can still get it.
+
+    The reference counts are shared by the stages (nipype runs them in
+    separate processes) in a json file, under a file lock.
+
+    Input
+    =====
+    gc:
+        dict with 'mode' ('keep_checkpoints' or 'all', see delete_intermediate), 'refcount_file' and 'consumers'
+        (stages getting the result of this stage, see get_consumers).
+    stage_name:
+        name of the stage.
+    output_files:
+        files in the outputs of the stage (see stages.release_outputs).
+    work_dir:
+        work directory of the session. Only files inside it are deleted.
+
+    Output
+    ======
+    deleted:
+        list of deleted files.
+    """
+    work_dir = os.path.abspath(work_dir)
+    deleted = []
+    with utils.file_lock(gc['refcount_file'] + '.lock'):
+        refcounts = {}
+        if os.path.exists(gc['refcount_file']):
+            with open(gc['refcount_file']) as f:
+                refcounts = json.load(f)
+
+        for path in output_files:
+            path = os.path.abspath(path)
+            if not path.startswith(work_dir + os.sep):
+                continue
+            refcounts[path] = sorted(set(refcounts.get(path, [])) | set(gc['consumers']))
+
+        for path in sorted(refcounts):
+            if stage_name not in refcounts[path]:
+                continue
+            refcounts[path].remove(stage_name)
+            if len(refcounts[path]) == 0:
+                del refcounts[path]
+                deleted.extend(delete_intermediate(path, gc['mode']))
+
+        tmp_refcount_file = gc['refcount_file'] + '.tmp'
+        with open(tmp_refcount_file,'w') as f:
+            json.dump(refcounts, f, sort_keys=True, indent=4)
+        os.replace(tmp_refcount_file, gc['refcount_file'])
+
+    if len(deleted) > 0:
+        print(f"Stage {stage_name} is done, deleted {len(deleted)} intermediate files.")
+    return deleted
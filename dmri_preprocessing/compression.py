@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Purpose: Parallel gzip compression of the images written to the derivatives
+
+import zlib
+import shutil
+import struct
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Uncompressed bytes per gzip member. Larger blocks compress slightly
+# better, smaller blocks use the threads better on small files.
+BLOCK_SIZE = 4 << 20
+
+# gzip member header: magic, deflate, no flags, mtime 0 (so the output
+# only depends on the input), no extra flags, unknown OS
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+def compress_block(block, compresslevel):
+    """
+    Compress block into a complete gzip member. zlib releases the GIL,
+    so blocks can be compressed in parallel by threads.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(block) + compressor.flush()
+    trailer = struct.pack('<II', zlib.crc32(block) & 0xffffffff, len(block) & 0xffffffff)
+    return GZIP_HEADER + deflated + trailer
+
+class BlockGzipWriter:
+    """
+    Write-only file object which compresses what is written to it into
+    consecutive gzip members of block_size uncompressed bytes, using
+    n_threads threads. At most 2*n_threads blocks are held in memory.
+
+    Used by compress_file, and to write images in a stream (see
+    concat.concat_images).
+    """
+    def __init__(self, dst, compresslevel=6, n_threads=1, block_size=BLOCK_SIZE):
+        self.compresslevel = compresslevel
+        self.n_threads = n_threads
+        self.block_size = block_size
+        self._file = open(dst,'wb')
+        self._buffer = bytearray()
+        self._n_blocks = 0
+        self._pending = []
+        self._executor = ThreadPoolExecutor(max_workers=n_threads) if n_threads > 1 else None
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._write_block(block)
+        return len(data)
+
+    def _write_block(self, block):
+        self._n_blocks += 1
+        if self._executor is None:
+            self._file.write(compress_block(block, self.compresslevel))
+            return
+        self._pending.append(self._executor.submit(compress_block, block, self.compresslevel))
+        # Write the blocks in order, when enough are queued
+        if len(self._pending) >= 2*self.n_threads:
+            self._file.write(self._pending.pop(0).result())
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            # An empty file is one empty member
+            if len(self._buffer) > 0 or self._n_blocks == 0:
+                self._write_block(bytes(self._buffer))
+            for future in self._pending:
+                self._file.write(future.result())
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def compress_file(src, dst, compresslevel=6, n_threads=1, block_size=BLOCK_SIZE):
+    """
+    Compress src to dst with gzip, using n_threads threads.
+
+    The file is split into blocks which are compressed independently and
+    written as consecutive gzip members (like pigz --independent or
+    bgzip). A file with several members is a valid gzip file, which gzip,
+    zlib (fsl), nibabel and indexed_gzip read as one stream. At most
+    2*n_threads blocks are held in memory.
+
+    Input
+    =====
+    src:
+        path to uncompressed file.
+    dst:
+        path to compressed file (.gz).
+    compresslevel:
+        gzip compression level, 1 (fastest) to 9 (smallest).
+    n_threads:
+        number of threads compressing blocks.
+    block_size:
+        uncompressed bytes per block.
+    """
+    with open(src,'rb') as f_in, BlockGzipWriter(dst, compresslevel, n_threads, block_size) as f_out:
+        shutil.copyfileobj(f_in, f_out, block_size)
+    return dst
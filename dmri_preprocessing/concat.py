@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Purpose: Concatenate 3D/4D images along time in-process (replaces fslmerge -t)
+
+import io
+import gzip
+
+import numpy as np
+
+from dmri_preprocessing import compression
+from dmri_preprocessing.gradients import GradientTable
+
+# Bytes copied at a time when the voxel data is copied as it is
+CHUNK_SIZE = 4 << 20
+
+# Largest difference between the affines of the inputs, in mm
+AFFINE_TOLERANCE = 1e-3
+
+def open_output(output_file, compresslevel, n_threads):
+    if output_file.endswith('.gz'):
+        # Blocks, so frames can be read through the member index (see gzindex)
+        return compression.BlockGzipWriter(output_file, compresslevel, n_threads)
+    return open(output_file,'wb')
+
+def get_header_bytes(header):
+    """
+    Header and extensions of a single file NIfTI image, padded up to the
+    voxel data, which is placed right after them.
+    """
+    header.set_data_offset(0)
+    header_bytes = io.BytesIO()
+    header.write_to(header_bytes)
+    header_bytes.write(b'\x00' * (int(header.get_data_offset()) - header_bytes.tell()))
+    return header_bytes.getvalue()
+
+def copy_voxel_data(img, f_out):
+    """
+    Copy the voxel data of img to f_out as it is stored, in chunks.
+    """
+    fname = img.get_filename()
+    n_bytes = int(np.prod(img.shape)) * img.get_data_dtype().itemsize
+    with (gzip.open(fname,'rb') if fname.endswith('.gz') else open(fname,'rb')) as f_in:
+        f_in.seek(int(img.dataobj.offset))
+        while n_bytes > 0:
+            chunk = f_in.read(min(CHUNK_SIZE, n_bytes))
+            assert len(chunk) > 0, f"{fname} is truncated"
+            f_out.write(chunk)
+            n_bytes -= len(chunk)
+
+def check_images(imgs, in_files):
+    """
+    Check that the images are on the same voxel grid. Like fslmerge,
+    differing affines (e.g. after the subject moved between runs) are
+    only reported.
+    """
+    first = imgs[0]
+    for img, fname in zip(imgs[1:], in_files[1:]):
+        assert img.shape[:3] == first.shape[:3], \
+            f"{fname} has shape {img.shape[:3]}, but {in_files[0]} has shape {first.shape[:3]}"
+        assert len(img.shape) <= 4, f"{fname} has more than 4 dimensions"
+        assert np.allclose(img.header.get_zooms()[:3], first.header.get_zooms()[:3], atol=AFFINE_TOLERANCE), \
+            f"{fname} and {in_files[0]} have different voxel sizes"
+        if not np.allclose(img.affine, first.affine, atol=AFFINE_TOLERANCE):
+            print(f"Warning: {fname} and {in_files[0]} have different affines, the affine of {in_files[0]} is used.")
+
+def concat_images(in_files, output_file, gradients=None, compresslevel=6, n_threads=1):
+    """
+    Concatenate images along time, like fslmerge -t, one input at a time.
+
+    When all inputs store their voxels with the same data type and
+    scaling, the voxel data is copied as it is, in chunks. Otherwise the
+    volumes are written as float32, one at a time. The header and affine
+    are the ones of the first input. A .nii.gz output is written in gzip
+    blocks (see compression.BlockGzipWriter).
+
+    Input
+    =====
+    in_files: list of paths to 3D or 4D images (.nii or .nii.gz), on the
+        same voxel grid. A 3D image is one volume.
+    output_file: path to output image (.nii or .nii.gz).
+    gradients: list with the GradientTable of each input, or None. The
+        number of volumes of each input is checked against its table.
+    compresslevel: gzip compression level of a .nii.gz output.
+    n_threads: number of threads compressing a .nii.gz output.
+
+    Output
+    ======
+    source_ids: array with the index in in_files of the input of each
+        volume of the output.
+    merged_gradients: GradientTable of the output, or None if gradients
+        is None.
+    """
+    import nibabel as nib
+
+    imgs = [nib.load(fname, keep_file_open=True) for fname in in_files]
+    check_images(imgs, in_files)
+    n_volumes = [img.shape[3] if len(img.shape) > 3 else 1 for img in imgs]
+    source_ids = np.repeat(np.arange(len(in_files)), n_volumes)
+    merged_gradients = None
+    if gradients is not None:
+        for fname, n, table in zip(in_files, n_volumes, gradients):
+            assert n == len(table), f"{fname} has {n} volumes, but {len(table)} b-values and b-vectors"
+        merged_gradients = GradientTable.merge(gradients)
+
+    first = imgs[0]
+    raw_copy = all([
+        img.get_data_dtype() == first.get_data_dtype() and
+        np.allclose([img.dataobj.slope, img.dataobj.inter], [first.dataobj.slope, first.dataobj.inter])
+        for img in imgs
+    ])
+    header = first.header.copy()
+    header.set_data_shape(first.shape[:3] + (int(np.sum(n_volumes)),))
+    if not raw_copy:
+        header.set_data_dtype(np.float32)
+        header.set_slope_inter(None, None)
+    header_bytes = get_header_bytes(header)
+    out_dtype = header.get_data_dtype()
+
+    with open_output(output_file, compresslevel, n_threads) as f_out:
+        f_out.write(header_bytes)
+        for img, n in zip(imgs, n_volumes):
+            if raw_copy:
+                copy_voxel_data(img, f_out)
+                continue
+            for volume in range(n):
+                data = img.dataobj[..., volume] if len(img.shape) > 3 else img.dataobj[...]
+                f_out.write(np.asarray(data, dtype=out_dtype).tobytes(order='F'))
+
+    return source_ids, merged_gradients
@@ -3,19 +3,25 @@
 import os
 import copy
 import sys
+import shutil
+import signal
 
 from argparse import ArgumentParser
 from argparse import ArgumentDefaultsHelpFormatter
 
-# own functions
-from dmri_preprocessing import utils
-from dmri_preprocessing import workflows
-from dmri_preprocessing import outputs
-from dmri_preprocessing.report import reports
+# own functions. workflows (nipype, nibabel, ...) is imported in
+# run_session, so that --help, --version and argument errors are fast.
+from dmri_preprocessing import batch
+from dmri_preprocessing import scheduler
+from dmri_preprocessing import telemetry
+from dmri_preprocessing import versions
 
 application_name = "dmri_preprocessing"
 version = "0.3.0"
 
+# Parsed BIDS sidecars, shared by the sessions run in this process
+metadata_cache = {}
+
 # Modified from qsiprep
 def parse_args(args):
     """Build parser object"""
@@ -54,15 +60,26 @@ def parse_args(args):
         '--participant_label',
         '--participant-label',
         action='store',
-        help='a single subject identifier (the sub- prefix can be removed)',
-        required=True)
+        nargs='+',
+        help='one or more subject identifiers or glob patterns (the sub- prefix '
+        'can be removed). If not set, all subjects are processed.')
     g_bids.add_argument(
         '--session_label',
         '--session-label',
         action='store',
-        help='a single session identifier (the ses- prefix can be removed)',
-        required=True)
-        
+        nargs='+',
+        help='one or more session identifiers or glob patterns (the ses- prefix '
+        'can be removed). If not set, all sessions are processed.')
+
+    g_bids.add_argument(
+        '--shard',
+        action='store',
+        type=batch.parse_shard,
+        metavar='INDEX/COUNT',
+        help='split the selected sessions into COUNT shards with about the same '
+        'estimated cost (dwi volumes x voxels), and only process shard INDEX '
+        '(0 to COUNT-1). For array jobs, e.g. --shard $SLURM_ARRAY_TASK_ID/100.')
+
     g_perfm = parser.add_argument_group('Options to handle performance')
     g_perfm.add_argument(
         '--n_cpus',
@@ -72,6 +89,90 @@ def parse_args(args):
         default=1,
         type=int,
         help='maximum number of threads across all processes')
+    g_perfm.add_argument(
+        '--n_sessions',
+        '--n-sessions',
+        action='store',
+        default=1,
+        type=int,
+        help='maximum number of sessions processed in parallel')
+    g_perfm.add_argument(
+        '--plugin',
+        action='store',
+        choices=['Linear','MultiProc'],
+        default='MultiProc',
+        help='nipype plugin used to run the workflow. MultiProc runs independent '
+        'processing steps in parallel within --n_cpus.')
+
+    g_perfm.add_argument(
+        '--bids_index',
+        '--bids-index',
+        action='store',
+        choices=['session','dataset'],
+        default='session',
+        help='how the BIDS dataset is indexed by pybids. The index is saved in the '
+        'work dir and reused by later runs and concurrent jobs. session indexes '
+        'only the session folder and the top level sidecars, so the time does not '
+        'depend on the size of the dataset. dataset indexes the whole dataset once.')
+    g_perfm.add_argument(
+        '--uncompressed_intermediates',
+        '--uncompressed-intermediates',
+        action='store_true',
+        default=False,
+        help='write the images in the work directory as uncompressed .nii, so that '
+        'each step does not decompress and compress the whole dwi series again. '
+        'The derivatives are compressed (.nii.gz) when they are written. Needs '
+        'about 2-3 times more space in the work dir.')
+    g_perfm.add_argument(
+        '--compression_level',
+        '--compression-level',
+        action='store',
+        type=int,
+        choices=range(1,10),
+        metavar='{1..9}',
+        default=6,
+        help='gzip level of the images the pipeline compresses itself: the '
+        'preprocessed dwi, the RD and AD maps, and with --uncompressed_intermediates '
+        'all derivatives. 1 is fastest, 9 smallest. The compression uses the threads '
+        'of --n_cpus. Other images (e.g. the fsl outputs in the default mode) are '
+        'copied as fsl compressed them.')
+    g_perfm.add_argument(
+        '--scratch_dir',
+        '--scratch-dir',
+        action='store',
+        help='node-local scratch directory, e.g. $TMPDIR. The inputs of each '
+        'session are copied there, all processing is done there, and only the '
+        'derivatives are moved to output_dir. The copies are removed when the '
+        'session is done.')
+    g_perfm.add_argument(
+        '--sync_work_dir',
+        '--sync-work-dir',
+        action='store_true',
+        default=False,
+        help='with --scratch_dir, copy the work directory of each session '
+        '(with the checkpoints) from and back to -w, so that sessions can be '
+        'resumed.')
+    g_perfm.add_argument(
+        '--gc_work_dir',
+        '--gc-work-dir',
+        action='store',
+        choices=['off','keep_checkpoints','all'],
+        default='off',
+        help='delete the intermediate files in the work directory as soon as '
+        'the last step using them is done. keep_checkpoints only deletes the '
+        'files made from the step outputs (extracted frames, gzip indexes), so '
+        'that sessions can be resumed. all deletes all intermediates, a rerun '
+        'then runs all steps again.')
+    g_perfm.add_argument(
+        '--max_work_disk',
+        '--max-work-disk',
+        action='store',
+        type=batch.parse_size,
+        metavar='SIZE',
+        help='with several sessions, only start a session when its estimated '
+        'size and the size of the work folders of the running sessions (in '
+        '--scratch_dir if given) fit within SIZE, e.g. 500G. A session is '
+        'always started when none is running.')
 
     g_conf = parser.add_argument_group('Workflow configuration')
     g_conf.add_argument(
@@ -88,6 +189,14 @@ def parse_args(args):
         type=int,
         default=5,
         help='window size in voxels for ``dwidenoise``. Must be odd.')
+    g_conf.add_argument(
+        '--zarr_derivatives', '--zarr-derivatives',
+        action='store_true',
+        default=False,
+        help='also write the preprocessed dwi and the eddy cnr maps as chunked '
+        'Zarr arrays (*_dwi.zarr, *_cnr.zarr), with the gradients and the sidecar '
+        'as attributes, so that single volumes or regions can be read without '
+        'decompressing the whole image.')
    
     g_other = parser.add_argument_group('Other options')
     g_other.add_argument(
@@ -97,22 +206,54 @@ def parse_args(args):
         action='store',
         help='path where intermediate results should be stored',
         required=True)
+    g_other.add_argument(
+        '--dry-run', '--dry_run',
+        action='store_true',
+        default=False,
+        help='print the processing stages of each session with estimated time, '
+        'memory and work dir usage, without running them. Only NIfTI headers '
+        'and metadata are read.')
+    g_other.add_argument(
+        '--preflight',
+        action='store_true',
+        default=False,
+        help='check the inputs of all selected sessions (gradient files, sidecars, '
+        'topup compatibility), write output_dir/'+application_name+'/preflight_manifest.tsv '
+        'and exit, without processing. Only NIfTI headers, sidecars and gradient '
+        'files are read.')
+    g_other.add_argument(
+        '--skip-invalid', '--skip_invalid',
+        action='store_true',
+        default=False,
+        help='run the preflight check first, and only process the sessions '
+        'without blocking errors.')
 
     return parser.parse_args(args)
 
-def main():
-    opts = parse_args(sys.argv[1:])
+def get_session_data(opts, subject, session, tool_versions):
+    """
+    Collect the data and metadata of one subject and session, and decide
+    how to run topup.
+
+    Output
+    ======
+    data:
+        dict with information about the data we are going to process.
+    data_raw:
+        dict with information about all data and the processing.
+    topup_options:
+        options for running topup.
+    phase_encoding_directions:
+        phase encoding directions for dwi, fmap and sbref.
+    denoise_filter_length:
+        tuple with 3 ints, e.g: (5,5,5)
+    """
+    from dmri_preprocessing import utils
 
     BIDS_DIR = opts.bids_dir
-    OUTPUT_DIR = opts.output_dir
-    WORK_DIR = opts.work_dir
-
-    subject = opts.participant_label.replace("sub-","")
-    session = opts.session_label.replace("ses-","")
 
     # Settings
     b0_threshold = opts.b0_threshold
-    n_cpus = opts.n_cpus
     denoise_filter_length = (
         opts.dwi_denoise_window,
         opts.dwi_denoise_window,
@@ -122,84 +263,186 @@ def main():
     bids_input = os.path.join(BIDS_DIR,"sub-"+subject,"ses-"+session)
     assert os.path.exists(bids_input) == True, "Input dir: %s does not exist." % bids_input
 
-    subject_work_dir = os.path.join(WORK_DIR, application_name + "_wf","sub-"+str(subject)+"_ses-"+str(session)+"_wf")
-    os.makedirs(subject_work_dir,exist_ok=True)
-
-    # Get overview of data
-    layout, subject_data = utils.get_bids_layout(BIDS_DIR,subject,session)
-    data = utils.get_overview_of_data(subject_data, layout, b0_threshold)
+    # Get overview of data, from the BIDS index in the work dir
+    index_dir = os.path.join(opts.work_dir, application_name + "_wf", "bids_index")
+    layout, subject_data = utils.get_bids_layout(BIDS_DIR,subject,session,index_dir,opts.bids_index)
+    data = utils.get_overview_of_data(subject_data, layout, b0_threshold, metadata_cache)
+    # Extension of the images in the work directory
+    data['nifti_ext'] = '.nii' if opts.uncompressed_intermediates else '.nii.gz'
 
     data_raw = copy.deepcopy(data)
-    data_raw['bids_dir'] = BIDS_DIR
+    # The filenames are relative to the root of the index, which is a
+    # folder with symlinks to the session when --bids_index is session
+    data_raw['bids_dir'] = layout.root
     data_raw['subject'] = subject
     data_raw['session'] = session
     data_raw['denoise_filer_length'] = denoise_filter_length
-    data_raw['fsl_version'] = workflows.get_fsl_version()
-    data_raw['mrtrix3_version'] = workflows.get_mrtrix3_version()
-    data_raw['ants_version'] = workflows.get_ants_version()
+    data_raw['b0_threshold'] = b0_threshold
+    data_raw['compression_level'] = opts.compression_level
+    data_raw['gc_work_dir'] = opts.gc_work_dir
+    data_raw['zarr_derivatives'] = opts.zarr_derivatives
+    data_raw['fsl_version'] = tool_versions['fsl']
+    data_raw['mrtrix3_version'] = tool_versions['mrtrix3']
+    data_raw['ants_version'] = tool_versions['ants']
     data_raw['application_version'] = version
 
-    # 00_pre_hmc, here we will make the following:
-    # - input dwi: sub-id_ses-id_dwi.nii.gz
-    # - input bvals and bvecs: sub-id_ses-id_dwi.[bvec,bval]
-    # - All input needed for head motion correcton (hmc)
-    pre_hmc_dir = os.path.join(subject_work_dir,'00_pre_hmc')
-    os.makedirs(pre_hmc_dir,exist_ok=True)
-
-    workflows.gather_inputs(data,subject,session,pre_hmc_dir)
-
-    figures = []
-
-    # mrtrix3 dwidenoise
-    output_svg = workflows.run_dwidenoise(data,denoise_filter_length,n_cpus,pre_hmc_dir)
-    figures.extend(output_svg)
-
-    # mrtrix3 mrdegibbs
-    # Only run mrdegibbs if we have acquired full k-space data:
-    try:
-        partial_fourier = data['dwi'][0]['metadata']['PartialFourier']
-        if partial_fourier == 1:
-            output_svg = workflows.run_mrdegibbs(data,n_cpus,pre_hmc_dir)
-            figures.extend(output_svg)
-    except:
-        print(f"metadata 'PartialFourier' does not exist in .json. Because of \
-        incomplete information we are not running mrdegibbs.")
-
     # Check if and how we should do topup
     topup_options, phase_encoding_directions = utils.check_if_dataset_compatible_with_topup(data)
 
     data_raw['topup_options'] = topup_options
     data_raw['phase_encoding_directions'] = phase_encoding_directions
 
-    # topup
-    if topup_options['do_topup']:
-        output_svg = workflows.run_topup(data,topup_options,pre_hmc_dir)
-        figures.append(output_svg)
+    return data, data_raw, topup_options, phase_encoding_directions, denoise_filter_length
 
-    # eddy
-    eddy_inputs = workflows.prepare_eddy(data,topup_options,phase_encoding_directions,pre_hmc_dir)
-    eddy_inputs['in_file'] = data['dwi'][0]['filename']
-    eddy_inputs['in_bval'] = data['in_bval']
-    eddy_inputs['in_bvec'] = data['in_bvec']
-    eddy_output_dir = workflows.run_eddy(eddy_inputs,topup_options,subject_work_dir,n_cpus)
+def run_session(opts, subject, session, cpu_budget):
+    """
+    Run the full preprocessing pipeline on one subject and session.
 
-    eddy_output = {}
-    data['dwi'][0]['filename'] = os.path.join(eddy_output_dir,'eddy_corrected.nii.gz')
-    eddy_output['rotated_bvec'] = os.path.join(eddy_output_dir,"eddy_corrected.eddy_rotated_bvecs")
-    eddy_output['cnr_maps'] = os.path.join(eddy_output_dir,"eddy_corrected.eddy_cnr_maps.nii.gz")
+    All stages take their threads from the cpu budget file cpu_budget,
+    which is shared by all sessions in the run. With --scratch_dir the
+    session is run in node-local scratch (see staging.py).
+    """
+    if opts.scratch_dir is None:
+        return process_session(opts, subject, session, cpu_budget)
 
-    # N4biasfield correction!
-    output_svg = workflows.run_n4biasfieldcorrection(data,subject_work_dir)
-    figures.extend(output_svg)
+    from dmri_preprocessing import staging
+    with staging.staged_session(opts, subject, session, application_name) as staged_opts:
+        process_session(staged_opts, subject, session, cpu_budget)
 
-    # dtifit
-    dtifit_output_dir = workflows.run_dtifit(data['dwi'][0]['filename'],data['in_bval'],eddy_output['rotated_bvec'], eddy_inputs['in_mask'],subject_work_dir)
+def process_session(opts, subject, session, cpu_budget):
+    """
+    Build and run the workflow of one subject and session, with the bids,
+    work and output directories in opts.
+    """
+    from dmri_preprocessing import workflows
 
-    # Radial diffusitivity
-    workflows.run_rd(dtifit_output_dir)
+    OUTPUT_DIR = opts.output_dir
+    WORK_DIR = opts.work_dir
 
-    print("Output results to derivatives directory")
-    outputs.to_derivatives(data, data_raw,OUTPUT_DIR,application_name,eddy_output_dir,dtifit_output_dir,eddy_inputs,figures)
+    subject_work_dir = os.path.join(WORK_DIR, application_name + "_wf","sub-"+str(subject)+"_ses-"+str(session)+"_wf")
+    os.makedirs(subject_work_dir,exist_ok=True)
+
+    # Time and resources used by the stages of this run, see telemetry.py
+    telemetry_dir = os.path.join(subject_work_dir,'telemetry')
+    if os.path.exists(telemetry_dir):
+        shutil.rmtree(telemetry_dir)
+
+    with telemetry.measure('collect_data', telemetry_dir):
+        # Cached for all sessions sharing the work directory
+        tool_versions = versions.get_tool_versions(
+            os.path.join(WORK_DIR, application_name + "_wf", "tool_versions.json")
+        )
+        data, data_raw, topup_options, phase_encoding_directions, denoise_filter_length = \
+            get_session_data(opts, subject, session, tool_versions)
+
+    wf = workflows.init_dmri_preprocessing_wf(
+        data,
+        data_raw,
+        topup_options,
+        phase_encoding_directions,
+        denoise_filter_length,
+        cpu_budget,
+        subject_work_dir,
+        OUTPUT_DIR,
+        application_name
+    )
+    if opts.plugin == 'MultiProc':
+        # Each stage holds one nipype slot, and waits for its threads in
+        # the cpu budget. The budget makes sure --n_cpus is not exceeded.
+        wf.run(plugin='MultiProc', plugin_args={'n_procs': opts.n_cpus})
+    else:
+        wf.run(plugin='Linear')
+
+def plan_session(opts, subject, session):
+    """
+    Print the processing plan of one subject and session with estimated
+    cost (--dry-run). No tool is run, only the BIDS index is written to
+    the work dir.
+    """
+    from dmri_preprocessing import planner
+
+    data, data_raw, topup_options, phase_encoding_directions, denoise_filter_length = \
+        get_session_data(opts, subject, session, planner.UNKNOWN_VERSIONS)
+    plan = planner.plan_session(data, data_raw, topup_options, phase_encoding_directions,
+                                denoise_filter_length, opts.n_cpus)
+    planner.print_plan(plan)
+    return plan
+
+def _exit_on_sigterm(signum, frame):
+    # Run the cleanup in finally blocks (cpu budget, scratch) when the job
+    # is killed by the scheduler
+    sys.exit(128 + signum)
 
-    # Create report
-    reports.create_report(data, data_raw, OUTPUT_DIR, application_name)
+def main():
+    opts = parse_args(sys.argv[1:])
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
+    sessions = batch.get_sessions(opts.bids_dir, opts.participant_label, opts.session_label)
+    assert len(sessions) > 0, "No sessions found in %s." % opts.bids_dir
+
+    if opts.shard is not None:
+        shard_index, shard_count = opts.shard
+        costs = [batch.get_session_cost(opts.bids_dir, subject, session) for subject, session in sessions]
+        sessions = batch.shard_sessions(sessions, costs, shard_index, shard_count)
+        print(f"Shard {shard_index}/{shard_count}: {len(sessions)} sessions")
+        if len(sessions) == 0:
+            return
+
+    # Files written by each shard of an array job
+    shard_suffix = ""
+    if opts.shard is not None:
+        shard_suffix = "_shard-%d-of-%d" % opts.shard
+
+    if opts.preflight or opts.skip_invalid:
+        from dmri_preprocessing import preflight
+        manifest_file = os.path.join(opts.output_dir, application_name, "preflight_manifest" + shard_suffix + ".tsv")
+        manifest = preflight.run_preflight(opts.bids_dir, sessions, opts.b0_threshold, manifest_file)
+        invalid = [row for row in manifest if row['status'] != 'ok']
+        for row in invalid:
+            print(f"sub-{row['subject']} ses-{row['session']}: {row['errors']}")
+        print(f"Preflight: {len(manifest)} sessions, {len(invalid)} with blocking errors. "
+              f"Manifest: {manifest_file}")
+        if opts.preflight:
+            if len(invalid) > 0:
+                sys.exit(1)
+            return
+        sessions = [(row['subject'], row['session']) for row in manifest if row['status'] == 'ok']
+        if len(sessions) == 0:
+            return
+
+    if opts.dry_run:
+        plans = [plan_session(opts, subject, session) for subject, session in sessions]
+        total_time = sum([plan['wall_time_s'] for plan in plans])
+        total_disk = sum([plan['disk_mb'] for plan in plans])
+        print(f"{len(plans)} sessions, estimated {round(total_time/3600.0, 1)} hours "
+              f"with one session at a time, work dir: {round(total_disk/1000.0, 1)} GB")
+        return
+
+    # --n_cpus is a budget for all processes started by this run
+    cpu_budget = scheduler.create_cpu_budget(opts.n_cpus)
+    try:
+        if len(sessions) == 1:
+            subject, session = sessions[0]
+            run_session(opts, subject, session, cpu_budget)
+            return
+
+        # Batch mode
+        n_workers = max(1, min(opts.n_sessions, len(sessions)))
+        summary_file = os.path.join(opts.output_dir, application_name, "batch_summary" + shard_suffix + ".tsv")
+        disk_quota = None
+        if opts.max_work_disk is not None:
+            disk_quota = {
+                'max_bytes': opts.max_work_disk,
+                'session_dirs': [batch.get_session_work_dir(opts, application_name, subject, session)
+                                 for subject, session in sessions],
+                'session_bytes': [batch.get_session_disk(opts.bids_dir, subject, session)
+                                  for subject, session in sessions]
+            }
+        results = batch.run_batch(run_session, opts, sessions, n_workers, cpu_budget, summary_file, disk_quota)
+    finally:
+        scheduler.remove_cpu_budget(cpu_budget)
+
+    n_failed = len([result for result in results if result['status'] != 'success'])
+    print(f"Processed {len(results)} sessions, {n_failed} failed. Summary: {summary_file}")
+    if n_failed > 0:
+        sys.exit(1)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# Purpose: Compute scalar maps (RD, AD, ...) from the eigenvalues of dtifit in-process, in slabs
+
+import os
+import sys
+import time
+import fnmatch
+import argparse
+import traceback
+
+import numpy as np
+
+from dmri_preprocessing import concat, compression
+
+# Scalar maps from the eigenvalues L1 >= L2 >= L3 of the tensor:
+# axial (AD), radial (RD) and mean (MD) diffusivity, and the Westin
+# linear (CL), planar (CP) and spherical (CS) shape measures
+SCALARS = {
+    'AD': lambda l1, l2, l3: l1,
+    'RD': lambda l1, l2, l3: (l2 + l3) / 2.0,
+    'MD': lambda l1, l2, l3: (l1 + l2 + l3) / 3.0,
+    'CL': lambda l1, l2, l3: divide(l1 - l2, l1),
+    'CP': lambda l1, l2, l3: divide(l2 - l3, l1),
+    'CS': lambda l1, l2, l3: divide(l3, l1),
+}
+
+# Maps computed by the pipeline, dtifit writes MD itself
+PIPELINE_SCALARS = ['RD', 'AD']
+
+# Slices along z read and written at a time
+SLAB_SLICES = 16
+
+# Eigenvalue images, e.g. dtifit__L1.nii.gz or
+# sub-01_ses-01_space-orig_desc-preproc_model-DTI_parameter-L1_diffmodel.nii.gz
+L1_PATTERNS = [base + extension for base in ['*[_-]L1', '*[_-]L1_*'] for extension in ['.nii', '.nii.gz']]
+
+def divide(numerator, denominator):
+    """
+    numerator / denominator, 0 where the denominator is not positive
+    (outside the mask, or a degenerate fit).
+    """
+    out = np.zeros_like(numerator)
+    np.divide(numerator, denominator, out=out, where=denominator > 0)
+    return out
+
+def get_filename(l1_file, name):
+    """
+    Path of the eigenvalue or scalar map name (e.g. 'L2', 'RD') next to
+    l1_file, named like it.
+    """
+    dirname, basename = os.path.split(l1_file)
+    index = basename.rfind('L1')
+    return os.path.join(dirname, basename[:index] + name + basename[index + 2:])
+
+def compute_scalars(l1_file, scalars=PIPELINE_SCALARS, compresslevel=6, n_threads=1, slab_slices=SLAB_SLICES):
+    """
+    Compute scalar maps from the eigenvalue images of dtifit, in one pass.
+
+    L1, L2 and L3 are read SLAB_SLICES slices at a time, and all maps are
+    computed from the slab and appended to their files, so memory does
+    not grow with the image, and each eigenvalue image is decompressed
+    once. The maps are float32, with the header of L1, and named like L1
+    (e.g. dtifit__RD.nii.gz). A map is written next to its final name and
+    renamed when it is complete, or removed if the computation fails.
+
+    Input
+    =====
+    l1_file: path to L1 image (.nii or .nii.gz). L2 and L3 are found by
+        replacing L1 in the name (see get_filename).
+    scalars: list of maps to compute, keys of SCALARS.
+    compresslevel: gzip compression level of .nii.gz maps.
+    n_threads: number of threads compressing each .nii.gz map.
+    slab_slices: slices along z read at a time.
+
+    Output
+    ======
+    output_files: dict with the path of each map.
+    """
+    import nibabel as nib
+
+    for name in scalars:
+        assert name in SCALARS, f"unknown scalar map {name}, choose from {sorted(SCALARS)}"
+    # The images are read in order, the gzip streams are kept open
+    imgs = [nib.load(get_filename(l1_file, name), keep_file_open=True) for name in ['L1', 'L2', 'L3']]
+    shape = imgs[0].shape
+    for img in imgs[1:]:
+        assert img.shape == shape, f"{img.get_filename()} has shape {img.shape}, but {l1_file} has shape {shape}"
+    assert len(shape) == 3, f"{l1_file} is not a 3D image"
+
+    header = imgs[0].header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(None, None)
+    header_bytes = concat.get_header_bytes(header)
+
+    output_files = {name: get_filename(l1_file, name) for name in scalars}
+    tmp_files = {name: output_file + '.tmp%d' % os.getpid() for name, output_file in output_files.items()}
+    outputs = {}
+    completed = False
+    try:
+        for name in scalars:
+            if output_files[name].endswith('.gz'):
+                outputs[name] = compression.BlockGzipWriter(tmp_files[name], compresslevel, n_threads)
+            else:
+                outputs[name] = open(tmp_files[name],'wb')
+            outputs[name].write(header_bytes)
+        for start in range(0, shape[2], slab_slices):
+            l1, l2, l3 = [np.asarray(img.dataobj[:, :, start:start + slab_slices], dtype=np.float64) for img in imgs]
+            for name in scalars:
+                # Slabs along the last dimension are contiguous in the file
+                outputs[name].write(SCALARS[name](l1, l2, l3).astype(np.float32).tobytes(order='F'))
+        completed = True
+    finally:
+        for name in outputs:
+            outputs[name].close()
+        if not completed:
+            for tmp_file in tmp_files.values():
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+    for name in scalars:
+        os.replace(tmp_files[name], output_files[name])
+    return output_files
+
+def find_l1_files(paths):
+    """
+    Find the L1 images of dtifit outputs, in files or folders (searched
+    recursively).
+    """
+    l1_files = []
+    for path in paths:
+        if os.path.isfile(path):
+            l1_files.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            for fname in files:
+                if any([fnmatch.fnmatchcase(fname, pattern) for pattern in L1_PATTERNS]):
+                    l1_files.append(os.path.join(root, fname))
+    return sorted(l1_files)
+
+def _compute_scalars_safe(l1_file, scalars, compresslevel):
+    """
+    Compute the maps of one dtifit output and catch any error, so that one
+    failing output does not stop the batch.
+    """
+    start = time.time()
+    result = {'l1_file': l1_file, 'status': 'success', 'duration_s': 0.0, 'error': ''}
+    try:
+        compute_scalars(l1_file, scalars, compresslevel)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+        print(f"{l1_file} failed:\n{traceback.format_exc()}")
+    result['duration_s'] = round(time.time() - start, 1)
+    return result
+
+def compute_scalars_batch(l1_files, scalars, n_workers=1, compresslevel=6):
+    """
+    Compute scalar maps for many dtifit outputs, in a pool of n_workers
+    processes, each computing the maps of one output at a time.
+
+    Output
+    ======
+    results:
+        list of dicts with 'l1_file', 'status', 'duration_s' and 'error'
+        of each output, in the order of l1_files.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_compute_scalars_safe, l1_file, scalars, compresslevel) for l1_file in l1_files]
+        results = []
+        for l1_file, future in zip(l1_files, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                # The worker process died, e.g. killed because of memory
+                results.append({'l1_file': l1_file, 'status': 'failed', 'duration_s': '', 'error': repr(e)})
+    return results
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Compute scalar maps (e.g. RD, AD) from existing dtifit outputs, '
+        'named like their L1 image.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('paths',
+        nargs='+',
+        help='L1 images, or folders searched recursively for them, e.g. the '
+        'derivatives folder of the pipeline')
+    parser.add_argument('--scalars',
+        nargs='+',
+        choices=sorted(SCALARS),
+        default=PIPELINE_SCALARS,
+        help='scalar maps to compute')
+    parser.add_argument('--n_procs', '--n-procs',
+        type=int,
+        default=1,
+        help='number of dtifit outputs processed in parallel')
+    parser.add_argument('--compression_level', '--compression-level',
+        type=int,
+        choices=range(1,10),
+        metavar='{1..9}',
+        default=6,
+        help='gzip level of .nii.gz maps')
+    return parser.parse_args(args)
+
+def main():
+    opts = parse_args(sys.argv[1:])
+    l1_files = find_l1_files(opts.paths)
+    assert len(l1_files) > 0, "No L1 images found in %s." % ' '.join(opts.paths)
+    results = compute_scalars_batch(l1_files, opts.scalars, max(1, opts.n_procs), opts.compression_level)
+    n_failed = len([result for result in results if result['status'] != 'success'])
+    print(f"Computed {', '.join(opts.scalars)} for {len(results)} dtifit outputs, {n_failed} failed.")
+    if n_failed > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
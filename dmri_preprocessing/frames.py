@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Purpose: Extract frames (volumes) of 4D images in-process, with a cache
+
+import os
+
+from dmri_preprocessing import utils
+from dmri_preprocessing import gzindex
+
+# Frames extracted by this process: (real path of image, frame) ->
+# (modification time of image, path of frame file)
+frame_cache = {}
+
+def get_frame_filename(fname, frame_nr):
+    """
+    Path of the file with frame frame_nr of fname, next to fname, e.g.
+    dwi.nii.gz -> dwi_03.nii.gz.
+    """
+    return utils.add_nifti_suffix(fname, '_%02i' % frame_nr)
+
+def is_up_to_date(output, fname):
+    return os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(fname)
+
+def save_frame(fname, frame_nr, data, affine, header):
+    """
+    Write the data of frame frame_nr of fname to its frame file.
+    """
+    import nibabel as nib
+
+    output = get_frame_filename(fname, frame_nr)
+    # Written next to the output and renamed, so other processes never
+    # read a half written frame
+    tmp_output = utils.add_nifti_suffix(output, '.tmp%d' % os.getpid())
+    nib.save(nib.Nifti1Image(data, affine, header), tmp_output)
+    os.replace(tmp_output, output)
+    return output
+
+def write_frames(fname, frame_nrs):
+    """
+    Read frames of fname and write each to its frame file.
+
+    A gzipped 4D image is read through a seek point index (see
+    gzindex.open_indexed), so each frame is decompressed from the nearest
+    seek point instead of from the start of the file. Other images are
+    read directly (memory mapped for .nii). The frames are read in
+    increasing order, and only the requested frames are held in memory,
+    one at a time.
+    """
+    import nibabel as nib
+
+    img = nib.load(fname, keep_file_open=True)
+    dataobj = img.dataobj
+    fileobj = None
+    if fname.endswith('.gz') and len(img.shape) > 3:
+        from nibabel.arrayproxy import ArrayProxy
+        fileobj = gzindex.open_indexed(fname)
+        # The layout of the proxy read by nibabel, on the indexed file
+        proxy = img.dataobj
+        dataobj = ArrayProxy(
+            fileobj,
+            (proxy.shape, proxy.dtype, proxy.offset, proxy.slope, proxy.inter),
+            mmap=False
+        )
+    try:
+        for frame_nr in sorted(set(frame_nrs)):
+            if len(img.shape) > 3:
+                data = dataobj[..., frame_nr]
+            else:
+                assert frame_nr == 0, "%s is 3D, it has no frame %d" % (fname, frame_nr)
+                data = dataobj[...]
+            save_frame(fname, frame_nr, data, img.affine, img.header)
+    finally:
+        if fileobj is not None:
+            fileobj.close()
+
+def extract_frames(fname, frame_nrs):
+    """
+    Extract frames from a 4D image, e.g. a b0 and a high b-value volume of
+    a dwi file, without running fslroi.
+
+    Frames are cached in memory and on disk: a frame file newer than
+    fname is reused, also by other stages and processes (e.g. the qc
+    plots). The missing frames are read in one pass (see write_frames).
+
+    Input
+    =====
+    fname: full path to 4D image (.nii or .nii.gz).
+    frame_nrs: list of frame numbers to extract. 0 is the first frame.
+
+    Output
+    ======
+    outputs: list with full path of the file of each frame, in the order
+        of frame_nrs. The files have the extension of fname.
+    """
+    path = os.path.realpath(fname)
+    mtime = os.stat(path).st_mtime_ns
+    outputs = [get_frame_filename(fname, frame_nr) for frame_nr in frame_nrs]
+
+    missing = []
+    for frame_nr, output in zip(frame_nrs, outputs):
+        cached = frame_cache.get((path, frame_nr))
+        if cached == (mtime, output) and os.path.exists(output):
+            continue
+        missing.append(frame_nr)
+
+    if len(missing) > 0:
+        # Several workflow nodes can ask for frames of the same file at
+        # the same time
+        with utils.file_lock(utils.split_nifti_ext(fname)[0] + '_frames.lock'):
+            missing = [frame_nr for frame_nr in missing
+                       if not is_up_to_date(get_frame_filename(fname, frame_nr), fname)]
+            if len(missing) > 0:
+                write_frames(fname, missing)
+        for frame_nr, output in zip(frame_nrs, outputs):
+            frame_cache[(path, frame_nr)] = (mtime, output)
+
+    return outputs
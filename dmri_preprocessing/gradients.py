@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Purpose: Gradient table (bvals, bvecs, shells) of the dwi runs of a session
+
+import hashlib
+
+import numpy as np
+
+# b-values closer than this (s/mm^2) are in the same shell
+SHELL_TOLERANCE = 100
+
+class GradientTable:
+    """
+    b-values and b-vectors of a set of dwi volumes, with the run each
+    volume comes from.
+
+    The table is read once per session (see utils.get_overview_of_data)
+    and passed to the stages in data['gradients']. Runs are merged with
+    GradientTable.merge and volumes are selected with subset, both without
+    reading the .bval/.bvec files again.
+
+    Attributes
+    ==========
+    bvals:
+        array with b-value of each volume, shape (n,).
+    bvecs:
+        array with unit b-vector of each volume, shape (n, 3).
+    source_ids:
+        array with index of the run of each volume, shape (n,).
+    b0_threshold:
+        volumes with b-value below b0_threshold are b0 volumes, above it
+        high b-value volumes.
+    """
+    def __init__(self, bvals, bvecs, source_ids, b0_threshold):
+        self.bvals = np.asarray(bvals, dtype=float).reshape(-1)
+        self.bvecs = np.asarray(bvecs, dtype=float).reshape(-1, 3)
+        self.source_ids = np.asarray(source_ids, dtype=int).reshape(-1)
+        self.b0_threshold = b0_threshold
+        assert len(self.bvecs) == len(self.bvals), "bvecs and bvals have different number of volumes"
+        assert len(self.source_ids) == len(self.bvals), "source_ids and bvals have different number of volumes"
+
+    @classmethod
+    def from_files(cls, bval_file, bvec_file, b0_threshold, source_id=0):
+        """
+        Read the gradient table of one run from FSL style .bval (one row)
+        and .bvec (three rows) files.
+        """
+        bvals = np.loadtxt(bval_file, ndmin=1)
+        bvecs = np.loadtxt(bvec_file, ndmin=2)
+        assert bvecs.shape[0] == 3, f"{bvec_file} does not have 3 rows"
+        return cls(bvals, bvecs.T, np.full(len(bvals), source_id), b0_threshold)
+
+    @classmethod
+    def merge(cls, tables):
+        """
+        Concatenate the volumes of several tables, in order. The b0
+        threshold of the first table is kept.
+        """
+        return cls(
+            np.concatenate([table.bvals for table in tables]),
+            np.concatenate([table.bvecs for table in tables]),
+            np.concatenate([table.source_ids for table in tables]),
+            tables[0].b0_threshold
+        )
+
+    def subset(self, volumes):
+        """
+        Table of a selection of volumes, given as indices or boolean mask.
+        """
+        return GradientTable(self.bvals[volumes], self.bvecs[volumes], self.source_ids[volumes],
+                             self.b0_threshold)
+
+    def select_runs(self, source_ids):
+        """
+        Table of the volumes of some runs.
+        """
+        return self.subset(np.isin(self.source_ids, source_ids))
+
+    def to_files(self, output_file_base):
+        """
+        Write the table to output_file_base.bval and output_file_base.bvec.
+
+        Output
+        ======
+        bval_file, bvec_file:
+            paths to the written files.
+        """
+        bval_file = output_file_base + ".bval"
+        bvec_file = output_file_base + ".bvec"
+        with open(bval_file,'w') as f:
+            f.write(" ".join(['%g' % bval for bval in self.bvals]) + "\n")
+        np.savetxt(bvec_file, self.bvecs.T, fmt='%.10g')
+        return bval_file, bvec_file
+
+    def __len__(self):
+        return len(self.bvals)
+
+    def __repr__(self):
+        # Deterministic, nipype hashes the inputs of the nodes by their repr
+        digest = hashlib.sha1()
+        for array in [self.bvals, self.bvecs, self.source_ids]:
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return (f"GradientTable(n_volumes={len(self)}, shells={self.shells.tolist()}, "
+                f"b0_threshold={self.b0_threshold}, sha1={digest.hexdigest()})")
+
+    @property
+    def b0_mask(self):
+        return self.bvals < self.b0_threshold
+
+    @property
+    def bhigh_mask(self):
+        return self.bvals > self.b0_threshold
+
+    @property
+    def b0_idx(self):
+        return np.flatnonzero(self.b0_mask)
+
+    @property
+    def bhigh_idx(self):
+        return np.flatnonzero(self.bhigh_mask)
+
+    @property
+    def shell_ids(self):
+        """
+        Index of the shell of each volume. Sorted b-values are split where
+        consecutive values differ by more than SHELL_TOLERANCE, and all b0
+        volumes are in shell 0.
+        """
+        shell_bvals = np.where(self.b0_mask, 0.0, self.bvals)
+        order = np.argsort(shell_bvals, kind='mergesort')
+        gaps = np.diff(shell_bvals[order]) > SHELL_TOLERANCE
+        shell_ids = np.empty(len(self), dtype=int)
+        shell_ids[order] = np.concatenate([[0], np.cumsum(gaps)])[:len(self)]
+        return shell_ids
+
+    @property
+    def shells(self):
+        """
+        b-value of each shell: the rounded mean b-value of its volumes, 0
+        for the b0 shell.
+        """
+        if len(self) == 0:
+            return np.array([], dtype=int)
+        shell_ids = self.shell_ids
+        shell_bvals = np.where(self.b0_mask, 0.0, self.bvals)
+        sums = np.bincount(shell_ids, weights=shell_bvals)
+        counts = np.bincount(shell_ids)
+        return np.round(sums/counts).astype(int)
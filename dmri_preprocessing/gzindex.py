@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# Purpose: Random access to gzipped images through a seek point index
+
+import io
+import os
+import gzip
+import zlib
+import bisect
+
+from dmri_preprocessing import compression
+
+# Uncompressed bytes between seek points of an indexed_gzip index, the
+# most decompressed to reach any offset
+SPACING = 4 << 20
+
+# Bytes read from the compressed file at a time when indexing members
+CHUNK_SIZE = 1 << 20
+
+def get_index_filename(fname, use_indexed_gzip):
+    """
+    Path of the index of fname, next to it. The two kinds of index have
+    different formats, so they have different extensions.
+    """
+    return fname + ('.gzidx' if use_indexed_gzip else '.gzmembers')
+
+# Warn once per process when indexed_gzip is missing
+warned_no_indexed_gzip = False
+
+def is_up_to_date(index_file, fname):
+    return os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(fname)
+
+def is_block_compressed(fname):
+    """
+    True if fname starts with the member header written by
+    compression.compress_block, i.e. it can have several members. Files
+    written by fsl or nibabel have other headers (OS, name or mtime).
+    """
+    with open(fname,'rb') as f:
+        return f.read(len(compression.GZIP_HEADER)) == compression.GZIP_HEADER
+
+def find_members(fname):
+    """
+    Find the gzip members of fname, in one pass.
+
+    A file written by compression.compress_file has one member per block,
+    which can be decompressed independently. Most other gzip files (fsl,
+    nibabel) have one member, and can then only be read from the start.
+
+    Output
+    ======
+    members:
+        list of (compressed offset, uncompressed offset) of the start of
+        each member.
+    """
+    members = []
+    compressed_offset = 0
+    uncompressed_offset = 0
+    with open(fname,'rb') as f:
+        data = b''
+        while True:
+            if len(data) == 0:
+                data = f.read(CHUNK_SIZE)
+                if len(data) == 0:
+                    break
+            # Start of a member
+            members.append((compressed_offset, uncompressed_offset))
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            while not decompressor.eof:
+                if len(data) == 0:
+                    data = f.read(CHUNK_SIZE)
+                    assert len(data) > 0, f"{fname} is truncated"
+                compressed_offset += len(data)
+                # Bounded output, a block of zeros can expand a lot
+                output = decompressor.decompress(data, CHUNK_SIZE)
+                uncompressed_offset += len(output)
+                # At the end of the member the rest of the input is in
+                # unused_data, and unconsumed_tail is stale
+                while len(decompressor.unconsumed_tail) > 0 and not decompressor.eof:
+                    output = decompressor.decompress(decompressor.unconsumed_tail, CHUNK_SIZE)
+                    uncompressed_offset += len(output)
+                data = decompressor.unused_data
+                compressed_offset -= len(data)
+    return members
+
+def write_members(members, index_file):
+    # Written next to the index and renamed, so other processes never
+    # read a half written index
+    tmp_index_file = index_file + '.tmp%d' % os.getpid()
+    with open(tmp_index_file,'w') as f:
+        for compressed_offset, uncompressed_offset in members:
+            f.write(f"{compressed_offset} {uncompressed_offset}\n")
+    os.replace(tmp_index_file, index_file)
+
+def read_members(index_file):
+    with open(index_file) as f:
+        return [tuple([int(offset) for offset in line.split()]) for line in f if line.strip()]
+
+class MemberGzipFile(io.RawIOBase):
+    """
+    Read-only file object over a gzip file, which seeks by starting to
+    decompress at the member before the offset.
+    """
+    def __init__(self, fname, members):
+        super().__init__()
+        self.name = fname
+        self.compressed_offsets = [member[0] for member in members]
+        self.uncompressed_offsets = [member[1] for member in members]
+        self._file = open(fname,'rb')
+        self._stream = None
+        self._member = 0
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("can only seek from the start or the current position")
+        member = max(bisect.bisect_right(self.uncompressed_offsets, offset) - 1, 0)
+        current_member = bisect.bisect_right(self.uncompressed_offsets, self._pos) - 1
+        # Reading on is cheaper than restarting, within the same member
+        if self._stream is None or offset < self._pos or member > current_member:
+            self._file.seek(self.compressed_offsets[member])
+            self._stream = gzip.GzipFile(fileobj=self._file, mode='rb')
+            self._member = member
+        self._stream.seek(offset - self.uncompressed_offsets[self._member])
+        self._pos = offset
+        return self._pos
+
+    def read(self, size=-1):
+        if self._stream is None:
+            self.seek(self._pos)
+        data = self._stream.read(size)
+        self._pos += len(data)
+        return data
+
+    def readinto(self, buffer):
+        # In bytes, buffer can be a view of an array of larger items
+        buffer = memoryview(buffer).cast('B')
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+        self._file.close()
+        super().close()
+
+def open_indexed(fname):
+    """
+    Open a gzip file for random access, with an index stored next to it.
+
+    The index is built once per file, in one pass, and reused by every
+    later read until the file changes. With indexed_gzip installed, the
+    index has a seek point every SPACING bytes, so reading the last frame
+    of an image costs about the same as reading the first. Without it,
+    the seek points are the starts of the gzip members (see find_members).
+
+    The caller must hold a lock on fname (see frames.extract_frames), as
+    the index can be written.
+
+    Without indexed_gzip, a file which is not block compressed (see
+    is_block_compressed) has a single member, so it is not indexed and is
+    read from the start, as nibabel would. A file with a single member
+    gets no index either.
+
+    Input
+    =====
+    fname: full path to gzip file.
+
+    Output
+    ======
+    fileobj: read-only, seekable file object with the uncompressed data.
+    """
+    try:
+        import indexed_gzip
+    except ImportError:
+        indexed_gzip = None
+
+    index_file = get_index_filename(fname, indexed_gzip is not None)
+    if indexed_gzip is not None:
+        fileobj = indexed_gzip.IndexedGzipFile(fname, spacing=SPACING)
+        if is_up_to_date(index_file, fname):
+            fileobj.import_index(index_file)
+        else:
+            fileobj.build_full_index()
+            tmp_index_file = index_file + '.tmp%d' % os.getpid()
+            fileobj.export_index(tmp_index_file)
+            os.replace(tmp_index_file, index_file)
+        return fileobj
+
+    if is_up_to_date(index_file, fname):
+        return MemberGzipFile(fname, read_members(index_file))
+    global warned_no_indexed_gzip
+    if not warned_no_indexed_gzip:
+        print("Warning: indexed_gzip is not installed, frames of gzipped images written by "
+              "fsl or nibabel are decompressed from the start")
+        warned_no_indexed_gzip = True
+    if not is_block_compressed(fname):
+        return gzip.GzipFile(fname, 'rb')
+    members = find_members(fname)
+    if len(members) > 1:
+        write_members(members, index_file)
+    return MemberGzipFile(fname, members)
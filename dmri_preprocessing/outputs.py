@@ -3,12 +3,11 @@
 
 import shutil
 import os
-import numpy as np
-import pandas as pd
 import json
 import glob
 
-from dmri_preprocessing.report.plots import plot_dMRI_confounds_carpet, plot_gradients
+# Files transferred to the derivatives at the same time
+MAX_TRANSFERS = 4
 
 def create_confounds_tsv(output_dir_dwi,sub_ses_basename,eddy_output_dir,eddy_input):
     """
@@ -31,6 +30,9 @@ def create_confounds_tsv(output_dir_dwi,sub_ses_basename,eddy_output_dir,eddy_in
     confound_derivatives:
         path to created .tsv file containing estimations and statistics
     """
+    import numpy as np
+    import pandas as pd
+
     # confounds.tsv
     confound_derivatives = os.path.join(output_dir_dwi,sub_ses_basename+"confounds.tsv")
     files_to_extract_data = [os.path.join(eddy_output_dir,"eddy_corrected.eddy_movement_rms"),
@@ -97,7 +99,41 @@ def create_dataset_description(data_raw,output_dir,application_name):
         with open(filename,'w') as json_file:
             json_file.write(json.dumps(dataset_description, sort_keys=True, indent=4, separators=(',', ': ')))
 
-def to_derivatives(data, data_raw, derivatives_dir, application_name, eddy_output_dir, dtifit_dir, eddy_input, figures):
+def export_file(src, dst, compresslevel, n_threads):
+    """
+    Place a work directory file in the derivatives. NIfTI files which
+    have to be compressed are copied with compression, other files are
+    reflinked when possible, else copied (see utils.link_file). Hardlinks
+    are not used, as a stage run again could rewrite its outputs in place
+    and change the published derivatives, nor symlinks, as the work
+    directory can be removed.
+    """
+    from dmri_preprocessing import utils
+
+    if src.endswith('.nii') and dst.endswith('.nii.gz'):
+        utils.copy_nifti(src, dst, compresslevel, n_threads)
+    else:
+        utils.link_file(src, dst, symlink=False, hardlink=False)
+    return dst
+
+def export_zarr(src, store_dir, attributes, compresslevel, n_threads):
+    """
+    Write a 4D derivative as a chunked Zarr array as well (see
+    zarrstore.write_zarr), for reading single volumes or regions.
+    """
+    from dmri_preprocessing import zarrstore
+
+    return zarrstore.write_zarr(src, store_dir, attributes, compresslevel, n_threads)
+
+def get_runtime_basename(output_dir_session, data_raw):
+    """
+    Prefix of the runtime files of a session (see telemetry.write_runtime).
+    """
+    return os.path.join(output_dir_session,
+        "sub-" + str(data_raw['subject']) + "_ses-" + str(data_raw['session']) + "_desc-")
+
+def to_derivatives(data, data_raw, derivatives_dir, application_name, eddy_output_dir, dtifit_dir, eddy_input, figures,
+                   eddy_quad_dir, n_cpus=1):
     """
     Copy all processed data from work directory to derivatives directory.
 
@@ -121,16 +157,42 @@ def to_derivatives(data, data_raw, derivatives_dir, application_name, eddy_outpu
         dict containing inputs to eddy.
     figures:
         list of figure paths that will be copied to derivatives directory.
+    eddy_quad_dir:
+        path to eddy_quad output directory, copied to the qc folder.
+    n_cpus:
+        number of threads compressing the images, with the compression
+        level data_raw['compression_level'].
+
+    With data_raw['zarr_derivatives'], the preprocessed dwi and the cnr
+    maps are also written as Zarr arrays (see export_zarr).
+
+    Output
+    ======
+    output_dir_session:
+        path to derivatives directory of this subject and session.
     """
+    # numpy and the plotting stack are only imported when they are needed,
+    # see 'Startup time' in README.md
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    from dmri_preprocessing import utils, staging
+    from dmri_preprocessing.report.plots import plot_dMRI_confounds_carpet, plot_gradients
+
     # Output data to bids/derivatives
     output_dir_base = os.path.join(derivatives_dir, application_name)
     sub = "sub-" + str(data_raw['subject'])
     ses = "ses-" + str(data_raw['session'])
 
+    # The session folder is written next to its final location, and swapped
+    # in when it is complete, so an interrupted run never leaves a half
+    # written session folder. Hidden, so BIDS tools do not see it.
     output_dir_session = os.path.join(output_dir_base,sub,ses)
-    output_dir_dwi = os.path.join(output_dir_session,"dwi")
-    output_dir_figures = os.path.join(output_dir_session,"figures")
-    output_dir_eddy = os.path.join(output_dir_session,"eddy")
+    partial_dir_session = os.path.join(output_dir_base,sub,'.' + ses + '.partial')
+    if os.path.exists(partial_dir_session):
+        shutil.rmtree(partial_dir_session)
+    output_dir_dwi = os.path.join(partial_dir_session,"dwi")
+    output_dir_figures = os.path.join(partial_dir_session,"figures")
+    output_dir_eddy = os.path.join(partial_dir_session,"eddy")
 
     os.makedirs(output_dir_dwi,exist_ok=True)
     os.makedirs(output_dir_figures,exist_ok=True)
@@ -140,12 +202,18 @@ def to_derivatives(data, data_raw, derivatives_dir, application_name, eddy_outpu
     create_dataset_description(data_raw,output_dir_base,application_name)
 
     sub_ses_basename = sub + "_" + ses + "_space-orig_desc-"
+    compresslevel = data_raw['compression_level']
+    # Files from the work directory to the derivatives, (source, derivative)
+    transfers = []
 
     # Outputs to take care of:
-    # keep all eddy output and save to output_dir_eddy
+    # keep all eddy output and save to output_dir_eddy. The images are
+    # compressed here if the work directory is uncompressed.
     for eddy_output_p in glob.glob(os.path.join(eddy_output_dir,'eddy_corrected.*')):
         eddy_derivative = os.path.join(output_dir_eddy,os.path.basename(eddy_output_p))
-        shutil.copy(eddy_output_p,eddy_derivative)
+        if eddy_derivative.endswith('.nii'):
+            eddy_derivative += '.gz'
+        transfers.append((eddy_output_p,eddy_derivative))
     
     # create links from eddy to dwi dir
     eddy_output_dict = {
@@ -155,6 +223,8 @@ def to_derivatives(data, data_raw, derivatives_dir, application_name, eddy_outpu
     for eddy_output in eddy_output_dict:
         eddy_output_p = os.path.join('..',os.path.basename(output_dir_eddy),eddy_output)
         eddy_derivative = os.path.join(output_dir_dwi,eddy_output_dict[eddy_output])
+        if os.path.lexists(eddy_derivative):
+            os.remove(eddy_derivative)
         os.symlink(eddy_output_p,eddy_derivative)
 
     other_outputs_dict = {
@@ -165,10 +235,45 @@ def to_derivatives(data, data_raw, derivatives_dir, application_name, eddy_outpu
 
     for other_output in other_outputs_dict:
         other_derivative = os.path.join(output_dir_dwi,other_outputs_dict[other_output])
-        shutil.copy(other_output,other_derivative)
-    
-    # Copy eddy_quad qc folder 
-    shutil.copytree(os.path.join(eddy_output_dir,'qc'),os.path.join(output_dir_session,"qc"))
+        transfers.append((other_output,other_derivative))
+
+    # Copy dtifit data to derivatives directory
+    for dtifit_file in utils.glob_nifti(os.path.join(dtifit_dir,"dtifit_*")):
+        dtifit_basename = os.path.basename(dtifit_file)
+        dtifit_derivative = dtifit_basename.replace(
+            "dtifit__",
+            sub_ses_basename+"preproc_model-DTI_parameter-"
+        )
+        dtifit_derivative = utils.replace_nifti_ext(
+            dtifit_derivative,
+            '_diffmodel.nii.gz'
+        )
+        dtifit_derivative_p = os.path.join(output_dir_dwi,dtifit_derivative)
+        transfers.append((dtifit_file,dtifit_derivative_p))
+
+    # Create json files
+    create_json(data_raw,os.path.join(output_dir_dwi,sub_ses_basename))
+
+    # Transfer the files in parallel, while the plots below are made. The
+    # threads of the stage are shared by the transfers compressing images.
+    n_transfers = max(1, min(MAX_TRANSFERS, n_cpus))
+    n_threads = max(1, n_cpus // n_transfers)
+    executor = ThreadPoolExecutor(max_workers=n_transfers)
+    pending = [executor.submit(export_file, src, dst, compresslevel, n_threads) for src, dst in transfers]
+
+    # The preprocessed dwi and the cnr maps as Zarr arrays, with the
+    # gradients and the sidecar as attributes
+    if data_raw['zarr_derivatives']:
+        with open(os.path.join(output_dir_dwi,sub_ses_basename+"preproc_dwi.json")) as json_file:
+            dwi_attributes = {'sidecar': json.load(json_file)}
+        dwi_attributes['bvals'] = np.loadtxt(eddy_input['in_bval'], ndmin=1).tolist()
+        dwi_attributes['bvecs'] = np.loadtxt(os.path.join(eddy_output_dir,'eddy_corrected.eddy_rotated_bvecs'), ndmin=2).T.tolist()
+        zarr_exports = [(data['dwi'][0]['filename'], sub_ses_basename+"preproc_dwi.zarr", dwi_attributes)]
+        for cnr_file in glob.glob(os.path.join(eddy_output_dir,'eddy_corrected.eddy_cnr_maps.nii*')):
+            zarr_exports.append((cnr_file, sub_ses_basename+"preproc_cnr.zarr", {}))
+        for src, store_name, attributes in zarr_exports:
+            pending.append(executor.submit(export_zarr, src, os.path.join(output_dir_dwi,store_name),
+                                           attributes, compresslevel, n_threads))
 
     # Create confounds tsv parameters.
     confounds_file = create_confounds_tsv(output_dir_dwi,sub_ses_basename,eddy_output_dir,eddy_input)
@@ -182,12 +287,11 @@ def to_derivatives(data, data_raw, derivatives_dir, application_name, eddy_outpu
     final_bvec = os.path.join(eddy_output_dir,'eddy_corrected.eddy_rotated_bvecs')
     output_bvecs_plot = os.path.join(output_dir_figures,sub_ses_basename+"bvecs_plot.gif")
 
-    bvals = np.loadtxt(fname=eddy_input['in_bval']).T
-    orig_bvecs = np.loadtxt(fname=eddy_input['in_bvec']).T
-    source_filenums = np.ones_like(bvals)
+    gradients = data['gradients']
     final_bvecs = np.loadtxt(fname=final_bvec).T
 
-    plot_gradients(bvals, orig_bvecs, source_filenums, output_bvecs_plot, final_bvecs=final_bvecs,frames=80)
+    plot_gradients(gradients.bvals, gradients.bvecs, gradients.source_ids, output_bvecs_plot,
+                   final_bvecs=final_bvecs,frames=80)
 
     # Copy over other figures:
     for figure in figures:
@@ -216,24 +320,65 @@ def to_derivatives(data, data_raw, derivatives_dir, application_name, eddy_outpu
         # topup
         elif "AP_PA_corrected" in figure:
             output_name = os.path.join(output_dir_figures,sub_ses_basename+"sdc_plot.svg")
-        shutil.copy(figure,output_name)
-    
-    # Copy dtifit data to derivatives directory
-    for dtifit_file in glob.glob(os.path.join(dtifit_dir,"dtifit_*.nii.gz")):
-        dtifit_basename = os.path.basename(dtifit_file)
-        dtifit_derivative = dtifit_basename.replace(
-            "dtifit__",
-            sub_ses_basename+"preproc_model-DTI_parameter-"
-        )
-        dtifit_derivative = dtifit_derivative.replace(
-            '.nii.gz',
-            '_diffmodel.nii.gz'
-        )
-        dtifit_derivative_p = os.path.join(output_dir_dwi,dtifit_derivative)
-        shutil.copy(dtifit_file, dtifit_derivative_p)
+        pending.append(executor.submit(export_file, figure, output_name, compresslevel, n_threads))
 
-    # Create json files
-    create_json(data_raw,os.path.join(output_dir_dwi,sub_ses_basename))
+    # Raises the first error of the transfers
+    for future in pending:
+        future.result()
+    executor.shutdown()
+
+    # The qc folder is part of the session folder when it is swapped in
+    copy_eddy_quad(eddy_quad_dir,partial_dir_session)
+
+    staging.swap_tree(partial_dir_session,output_dir_session)
+
+    return output_dir_session
+
+def write_runtime(telemetry_dir, output_dir_session, data_raw):
+    """
+    Write the runtime files of a session (see telemetry.write_runtime) to
+    its derivatives folder. Called after the to_derivatives stage, whose
+    own measurement is only saved when it returns, also when it was
+    skipped by its checkpoint. The files are written under hidden names in
+    the folder and renamed, so they are never half written.
+
+    Output
+    ======
+    runtime_tsv:
+        path to .tsv file, one row per stage.
+    """
+    from dmri_preprocessing import telemetry
+
+    os.makedirs(output_dir_session,exist_ok=True)
+    runtime_basename = get_runtime_basename(output_dir_session,data_raw)
+    tmp_basename = os.path.join(output_dir_session,'.tmp%d_' % os.getpid())
+    telemetry.write_runtime(telemetry_dir,tmp_basename)
+    for extension in ['runtime.json','runtime.tsv']:
+        os.replace(tmp_basename + extension, runtime_basename + extension)
+    return runtime_basename + 'runtime.tsv'
+
+def copy_eddy_quad(eddy_quad_dir, output_dir_session):
+    """
+    Copy eddy_quad qc folder to derivatives directory.
+
+    Input
+    =====
+    eddy_quad_dir:
+        path to eddy_quad output directory.
+    output_dir_session:
+        path to derivatives directory of this subject and session.
+
+    Output
+    ======
+    qc_dir:
+        path to qc folder in derivatives directory.
+    """
+    qc_dir = os.path.join(output_dir_session,"qc")
+    if os.path.exists(qc_dir):
+        shutil.rmtree(qc_dir)
+    shutil.copytree(eddy_quad_dir,qc_dir)
+
+    return qc_dir
 
 def get_raw_sources(data_raw):
     """
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# Purpose: Plan the processing of a session without running it (--dry-run)
+
+import os
+import tempfile
+
+from dmri_preprocessing import scheduler
+
+# Versions used in the plan, the tools are not run in a dry run
+UNKNOWN_VERSIONS = {'fsl': 'unknown', 'mrtrix3': 'unknown', 'ants': 'unknown'}
+
+# Rough cost of each stage, per million voxels (voxels per volume times
+# number of volumes processed by the stage) with one thread:
+# - seconds: cpu time
+# - memory: peak memory (MB)
+# - disk: size of the files written to the work directory (MB)
+# plus a fixed cost. The numbers can be calibrated with the
+# *_desc-runtime.tsv files of processed sessions (see telemetry.py).
+COST_MODEL = {
+    'gather_inputs': {'seconds': 0.3, 'memory': 8.0, 'disk': 2.5, 'fixed_seconds': 2},
+    'dwidenoise': {'seconds': 3.0, 'memory': 12.0, 'disk': 2.5, 'fixed_seconds': 1},
+    'plot_dwidenoise': {'seconds': 0.0, 'memory': 4.0, 'disk': 2.0, 'fixed_seconds': 15},
+    'mrdegibbs': {'seconds': 1.5, 'memory': 12.0, 'disk': 2.5, 'fixed_seconds': 1},
+    'plot_mrdegibbs': {'seconds': 0.0, 'memory': 4.0, 'disk': 2.0, 'fixed_seconds': 15},
+    'topup': {'seconds': 400.0, 'memory': 150.0, 'disk': 8.0, 'fixed_seconds': 10},
+    'plot_topup': {'seconds': 0.0, 'memory': 4.0, 'disk': 2.0, 'fixed_seconds': 10},
+    'prepare_eddy': {'seconds': 0.5, 'memory': 4.0, 'disk': 0.5, 'fixed_seconds': 5},
+    'eddy': {'seconds': 90.0, 'memory': 20.0, 'disk': 8.0, 'fixed_seconds': 30},
+    'eddy_quad': {'seconds': 0.5, 'memory': 8.0, 'disk': 0.5, 'fixed_seconds': 30},
+    'n4biasfieldcorrection': {'seconds': 0.5, 'memory': 12.0, 'disk': 5.0, 'fixed_seconds': 30},
+    'plot_n4biasfieldcorrection': {'seconds': 0.0, 'memory': 4.0, 'disk': 2.0, 'fixed_seconds': 15},
+    'dtifit': {'seconds': 1.0, 'memory': 8.0, 'disk': 0.5, 'fixed_seconds': 2},
+    'rd': {'seconds': 0.0, 'memory': 2.0, 'disk': 0.1, 'fixed_seconds': 2},
+    'to_derivatives': {'seconds': 0.3, 'memory': 8.0, 'disk': 0.0, 'fixed_seconds': 60},
+}
+
+# Cost of the nodes which are not in COST_MODEL, e.g. merge_figures
+DEFAULT_COST = {'seconds': 0.0, 'memory': 0.0, 'disk': 0.0, 'fixed_seconds': 1}
+
+def get_image_info(filename):
+    """
+    Read the dimensions of an image from its NIfTI header, without
+    reading the image data.
+
+    Output
+    ======
+    info:
+        dict with 'shape' (first 3 dimensions), 'n_volumes' and
+        'n_voxels' (voxels per volume).
+    """
+    import nibabel as nib
+    shape = nib.load(filename).header.get_data_shape()
+    n_volumes = shape[3] if len(shape) > 3 else 1
+    n_voxels = 1
+    for dim in shape[:3]:
+        n_voxels *= dim
+    return {'shape': tuple(shape[:3]), 'n_volumes': n_volumes, 'n_voxels': n_voxels}
+
+def get_topup_branch(topup_options):
+    """
+    Which data topup is run on, in the order run_topup checks them.
+    """
+    if not topup_options['do_topup']:
+        return None
+    for branch in ['only_sbref', 'only_fmap', 'dwi_fmap_combined']:
+        if topup_options[branch]:
+            return branch
+    return None
+
+def get_stage_volumes(data, topup_options):
+    """
+    Number of volumes and voxels per volume processed by each stage.
+
+    The dwi files with the same phase encoding direction as the first one
+    are merged (see workflows.gather_inputs).
+    """
+    dwi_info = [get_image_info(dwi['filename']) for dwi in data['dwi']]
+    first_direction = data['dwi'][0]['metadata']['PhaseEncodingDirection']
+    n_dwi = sum([
+        info['n_volumes'] for dwi, info in zip(data['dwi'], dwi_info)
+        if dwi['metadata']['PhaseEncodingDirection'] == first_direction
+    ])
+    n_voxels = dwi_info[0]['n_voxels']
+
+    branch = get_topup_branch(topup_options)
+    n_topup = 0
+    if branch == 'only_sbref':
+        n_topup = sum([get_image_info(sbref['filename'])['n_volumes'] for sbref in data['sbref']])
+    elif branch == 'only_fmap':
+        n_topup = sum([get_image_info(fmap['filename'])['n_volumes'] for fmap in data['fmap']])
+    elif branch == 'dwi_fmap_combined':
+        n_topup = 1 + sum([get_image_info(fmap['filename'])['n_volumes'] for fmap in data['fmap']])
+
+    volumes = {}
+    for stage in COST_MODEL:
+        volumes[stage] = n_dwi
+    # The plots use a low and a high b-value frame, before and after
+    for stage in ['plot_dwidenoise', 'plot_mrdegibbs', 'plot_n4biasfieldcorrection']:
+        volumes[stage] = 4
+    volumes['topup'] = n_topup
+    volumes['plot_topup'] = 2
+    # dtifit outputs are 3D maps
+    volumes['rd'] = 3
+    return volumes, n_voxels, dwi_info[0]['shape']
+
+def estimate_stage(stage_name, n_volumes, n_voxels, n_cpus):
+    """
+    Estimate the wall time (s), peak memory (MB) and work-dir disk usage
+    (MB) of a stage. The wall time uses the threads the stage gets from
+    the cpu budget (see scheduler.get_max_threads) and Amdahl's law.
+    """
+    cost = COST_MODEL.get(stage_name, DEFAULT_COST)
+    mvoxels = n_volumes * n_voxels / 1e6
+    n_threads = min(n_cpus, scheduler.get_max_threads(stage_name))
+    p = scheduler.PARALLEL_FRACTION.get(stage_name, 0.0)
+    cpu_time = cost['seconds'] * mvoxels
+    wall_time = cost['fixed_seconds'] + cpu_time * ((1.0 - p) + p/n_threads)
+    return {
+        'n_threads': n_threads,
+        'wall_time_s': round(wall_time),
+        'peak_memory_mb': round(cost['memory'] * mvoxels),
+        'disk_mb': round(cost['disk'] * mvoxels)
+    }
+
+def estimate_session_disk(cost):
+    """
+    Estimate the work-dir disk usage (MB) of a session from its cost (dwi
+    volumes times voxels, see batch.get_session_cost), without indexing
+    the session. Only the stages processing the whole dwi series are
+    counted, the plots, topup and rd write little (see get_stage_volumes).
+    """
+    small_stages = ['plot_dwidenoise', 'plot_mrdegibbs', 'plot_n4biasfieldcorrection', 'topup', 'plot_topup', 'rd']
+    disk = sum([COST_MODEL[stage]['disk'] for stage in COST_MODEL if stage not in small_stages])
+    return round(disk * cost / 1e6)
+
+def get_dag(data, data_raw, topup_options, phase_encoding_directions, denoise_filter_length):
+    """
+    Build the workflow of the session (without running it) and return its
+    stages in execution order with their dependencies.
+
+    Output
+    ======
+    dag:
+        list of (stage name, list of stages it depends on).
+    """
+    import networkx as nx
+    from dmri_preprocessing import workflows
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        wf = workflows.init_dmri_preprocessing_wf(
+            data, data_raw, topup_options, phase_encoding_directions,
+            denoise_filter_length, None, tmp_dir, os.path.join(tmp_dir,'derivatives'),
+            'dmri_preprocessing'
+        )
+        graph = wf._create_flat_graph()
+
+    dag = []
+    for node in nx.topological_sort(graph):
+        dependencies = sorted([predecessor.name for predecessor in graph.predecessors(node)])
+        dag.append((node.name, dependencies))
+    return dag
+
+def plan_session(data, data_raw, topup_options, phase_encoding_directions, denoise_filter_length, n_cpus):
+    """
+    Plan the processing of one session: which stages run, on how many
+    volumes, and their estimated cost. Only the NIfTI headers are read,
+    no tool is run.
+
+    Inputs
+    ======
+    data: dict with information about the data we are going to process.
+    data_raw: dict with information about all data and the processing.
+    topup_options: dict containing info on how to apply topup
+    phase_encoding_directions: dict with phase encoding directions for data.
+    denoise_filter_length: tuple with 3 ints, e.g: (7,7,7)
+    n_cpus: cpu budget of the run.
+
+    Outputs
+    =======
+    plan: dict with 'subject', 'session', 'shape', 'mrdegibbs',
+        'topup_branch', 'stages' (list of dicts, in execution order) and
+        totals: 'wall_time_s' (critical path), 'peak_memory_mb' and
+        'disk_mb'.
+    """
+    volumes, n_voxels, shape = get_stage_volumes(data, topup_options)
+    dag = get_dag(data, data_raw, topup_options, phase_encoding_directions, denoise_filter_length)
+
+    stages = []
+    finish_time = {}
+    for stage_name, dependencies in dag:
+        estimate = estimate_stage(stage_name, volumes.get(stage_name, 0), n_voxels, n_cpus)
+        # Earliest finish time, when the stages it depends on are finished
+        start_time = max([finish_time[dependency] for dependency in dependencies] + [0])
+        finish_time[stage_name] = start_time + estimate['wall_time_s']
+        estimate['stage'] = stage_name
+        estimate['depends_on'] = dependencies
+        estimate['n_volumes'] = volumes.get(stage_name, 0)
+        stages.append(estimate)
+
+    return {
+        'subject': data_raw['subject'],
+        'session': data_raw['session'],
+        'shape': shape,
+        'mrdegibbs': 'mrdegibbs' in [stage['stage'] for stage in stages],
+        'topup_branch': get_topup_branch(topup_options),
+        'stages': stages,
+        'wall_time_s': max(finish_time.values()),
+        'peak_memory_mb': max([stage['peak_memory_mb'] for stage in stages]),
+        'disk_mb': sum([stage['disk_mb'] for stage in stages])
+    }
+
+def format_seconds(seconds):
+    return '%d:%02d:%02d' % (seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+def print_plan(plan):
+    """
+    Print the stages of a plan with their estimated cost.
+    """
+    print(f"sub-{plan['subject']} ses-{plan['session']}: "
+          f"dwi {'x'.join([str(dim) for dim in plan['shape']])}, "
+          f"mrdegibbs: {plan['mrdegibbs']}, topup: {plan['topup_branch']}")
+    print(f"  {'stage':28s} {'volumes':>7s} {'threads':>7s} {'time':>8s} {'memory':>9s} {'disk':>9s}  depends on")
+    for stage in plan['stages']:
+        print(f"  {stage['stage']:28s} {stage['n_volumes']:7d} {stage['n_threads']:7d} "
+              f"{format_seconds(stage['wall_time_s']):>8s} {stage['peak_memory_mb']:6d} MB "
+              f"{stage['disk_mb']:6d} MB  {', '.join(stage['depends_on'])}")
+    print(f"  Estimated time: {format_seconds(plan['wall_time_s'])} (critical path), "
+          f"peak memory: {plan['peak_memory_mb']} MB, work dir: {plan['disk_mb']} MB")
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# Purpose: Check the inputs of all sessions before processing (--preflight)
+
+import os
+import csv
+import glob
+
+from concurrent.futures import ThreadPoolExecutor
+
+from dmri_preprocessing import planner, utils
+from dmri_preprocessing.gradients import GradientTable
+
+# Sessions checked at the same time. Only headers, sidecars and gradient
+# files are read, so the check is bound by the file system, not the cpus.
+N_THREADS = 8
+
+# Columns of the manifest .tsv file
+COLUMNS = [
+    'subject',
+    'session',
+    'status',
+    'topup_branch',
+    'n_dwi_runs',
+    'n_dwi_volumes',
+    'shells',
+    'n_fmap',
+    'n_sbref',
+    'errors'
+]
+
+def find_session_files(bids_dir, subject, session):
+    """
+    Find the dwi, fmap (epi) and sbref files of a session, like the pybids
+    query in utils.get_bids_layout, without indexing the dataset.
+    """
+    session_dir = os.path.join(bids_dir, 'sub-' + subject, 'ses-' + session)
+    session_files = {'subject': subject, 'session': session}
+    for data_type, suffix in [('dwi','dwi'), ('fmap','epi'), ('sbref','sbref')]:
+        filenames = []
+        for extension in ['.nii.gz','.nii']:
+            filenames.extend(glob.glob(os.path.join(session_dir, '*', '*_' + suffix + extension)))
+        session_files[data_type] = sorted(filenames)
+    return session_files
+
+def check_gradients(dwi_file, errors):
+    """
+    Check that a dwi file has .bval and .bvec files with one entry per
+    volume. Errors are appended to errors.
+    """
+    name = os.path.basename(dwi_file)
+    for extension in ['.bval','.bvec']:
+        if not os.path.exists(utils.replace_nifti_ext(dwi_file, extension)):
+            errors.append(f"{name}: missing {extension} file")
+            return
+    try:
+        gradients = GradientTable.from_files(
+            utils.replace_nifti_ext(dwi_file,'.bval'), utils.replace_nifti_ext(dwi_file,'.bvec'), 0
+        )
+        n_volumes = planner.get_image_info(dwi_file)['n_volumes']
+    except Exception as e:
+        errors.append(f"{name}: could not read header or gradients: {e}")
+        return
+    if n_volumes != len(gradients):
+        errors.append(f"{name}: {n_volumes} volumes, but {len(gradients)} b-values and b-vectors")
+
+def check_session(bids_dir, subject, session, b0_threshold, metadata_cache=None):
+    """
+    Check that a session can be processed, reading only NIfTI headers,
+    sidecars and gradient files.
+
+    The checks are the ones that otherwise make a session fail in the
+    middle of the workflow: gradient files which do not match the dwi
+    file, missing PhaseEncodingDirection or TotalReadoutTime (for the
+    files used by topup and eddy, see utils.check_if_dataset_compatible_with_topup),
+    and merged dwi data without b0 or high b-value volumes.
+
+    Output
+    ======
+    row:
+        dict with the COLUMNS of the manifest. status is 'ok' or 'error',
+        errors is a '; ' separated list of blocking errors.
+    """
+    row = {column: '' for column in COLUMNS}
+    row['subject'] = subject
+    row['session'] = session
+    errors = []
+    try:
+        check_session_inputs(bids_dir, subject, session, b0_threshold, metadata_cache, row, errors)
+    except Exception as e:
+        errors.append(repr(e))
+    row['status'] = 'error' if len(errors) > 0 else 'ok'
+    row['errors'] = '; '.join(errors)
+    return row
+
+def check_session_inputs(bids_dir, subject, session, b0_threshold, metadata_cache, row, errors):
+    """
+    Checks of check_session. Fills row and appends to errors, and stops at
+    the first check whose errors block the next ones.
+    """
+    session_files = find_session_files(bids_dir, subject, session)
+    row['n_dwi_runs'] = len(session_files['dwi'])
+    if len(session_files['dwi']) == 0:
+        errors.append("no dwi files")
+        return
+    for dwi_file in session_files['dwi']:
+        check_gradients(dwi_file, errors)
+    if len(errors) > 0:
+        return
+
+    data = utils.get_overview_of_data(session_files, bids_dir, b0_threshold, metadata_cache)
+    row['n_fmap'] = len(data['fmap'])
+    row['n_sbref'] = len(data['sbref'])
+    for data_type in ['dwi','fmap','sbref']:
+        for entry in data[data_type]:
+            if 'PhaseEncodingDirection' not in entry['metadata']:
+                errors.append(f"{os.path.basename(entry['filename'])}: missing PhaseEncodingDirection")
+    if len(errors) > 0:
+        return
+
+    topup_options, phase_encoding_directions = utils.check_if_dataset_compatible_with_topup(data)
+    branch = planner.get_topup_branch(topup_options)
+    row['topup_branch'] = branch if branch is not None else 'none'
+
+    # Files whose TotalReadoutTime goes into the topup or eddy parameters
+    readout_files = {
+        None: data['dwi'][:1],
+        'only_sbref': data['sbref'],
+        'only_fmap': data['fmap'],
+        'dwi_fmap_combined': data['dwi'][:1] + data['fmap']
+    }[branch]
+    for entry in readout_files:
+        if 'TotalReadoutTime' not in entry['metadata']:
+            errors.append(f"{os.path.basename(entry['filename'])}: missing TotalReadoutTime")
+
+    # The dwi runs with the phase encoding direction of the first one are
+    # merged (see workflows.gather_inputs)
+    first_direction = data['dwi'][0]['metadata']['PhaseEncodingDirection']
+    gradients = GradientTable.merge([
+        dwi['gradients'] for dwi in data['dwi']
+        if dwi['metadata']['PhaseEncodingDirection'] == first_direction
+    ])
+    row['n_dwi_volumes'] = len(gradients)
+    row['shells'] = ','.join([str(shell) for shell in gradients.shells])
+    if len(gradients.b0_idx) == 0:
+        errors.append(f"no b0 volume (b < {b0_threshold})")
+    if len(gradients.bhigh_idx) == 0:
+        errors.append(f"no high b-value volume (b > {b0_threshold})")
+
+def write_manifest(rows, manifest_file):
+    """
+    Write a .tsv file with one row per session.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_file)), exist_ok=True)
+    with open(manifest_file, 'w', newline='') as tsv_file:
+        writer = csv.DictWriter(tsv_file, fieldnames=COLUMNS, delimiter='\t')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+def read_manifest(manifest_file):
+    """
+    Read a manifest .tsv file into a list of dicts.
+    """
+    with open(manifest_file, newline='') as tsv_file:
+        return list(csv.DictReader(tsv_file, delimiter='\t'))
+
+def run_preflight(bids_dir, sessions, b0_threshold, manifest_file):
+    """
+    Check all sessions in parallel and write the manifest.
+
+    Input
+    =====
+    bids_dir:
+        root folder of BIDS dataset.
+    sessions:
+        list of (subject, session) tuples.
+    b0_threshold:
+        b-values below are b0 volumes.
+    manifest_file:
+        path to .tsv file with one row per session.
+
+    Output
+    ======
+    rows:
+        list of dicts with the result of each session, in the order of
+        sessions.
+    """
+    # The sidecars at the top level are shared by all sessions
+    metadata_cache = {}
+    with ThreadPoolExecutor(max_workers=N_THREADS) as executor:
+        rows = list(executor.map(
+            lambda session: check_session(bids_dir, session[0], session[1], b0_threshold, metadata_cache),
+            sessions
+        ))
+    write_manifest(rows, manifest_file)
+    return rows
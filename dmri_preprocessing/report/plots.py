@@ -317,8 +317,9 @@ def plot_gradients(bvals, orig_bvecs, source_filenums, output_fname, final_bvecs
     maxvals = qvecs.max(0)
     minvals = qvecs.min(0)
     color_list = ['b','k','g','y','m','c']
-    for i in range(0,len(np.unique(source_filenums))):
-        source_filenums = np.where(source_filenums==i,color_list[i],source_filenums)
+    # One color per source file
+    source_idx = np.unique(source_filenums, return_inverse=True)[1]
+    source_filenums = np.array(color_list)[source_idx % len(color_list)]
     def add_lines(ax):
         labels = ['L', 'P', 'S']
         for axnum in range(3):
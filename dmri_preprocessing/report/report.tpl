@@ -24,6 +24,15 @@ div.elem-image {
     width: 100%;
     padding-bottom: 5px;
 }
+table.elem-table {
+    border-collapse: collapse;
+    margin-bottom: 10px;
+}
+table.elem-table th, table.elem-table td {
+    border: 1px solid #ccc;
+    padding: 2px 8px;
+    text-align: right;
+}
 body {
     padding: 10px 10px 10px;
 }
@@ -64,6 +73,27 @@ body {
                     Get figure file: <a href="./{{ figure }}" target="_blank">{{ figure }}</a>
                 </div>
             {% endfor %} 
+            {% if 'table' in sections[section][sub_section] %}
+                <table class="elem-table">
+                    <tr>
+                    {% for column in sections[section][sub_section]['table']['columns'] %}
+                        <th>{{ column }}</th>
+                    {% endfor %}
+                    </tr>
+                {% for row in sections[section][sub_section]['table']['rows'] %}
+                    <tr>
+                    {% for value in row %}
+                        <td>{{ value }}</td>
+                    {% endfor %}
+                    </tr>
+                {% endfor %}
+                </table>
+            {% endif %}
+            {% for file in sections[section][sub_section]['files'] %}
+                <div class="elem-filename">
+                    Get file: <a href="./{{ file }}" target="_blank">{{ file }}</a>
+                </div>
+            {% endfor %}
         {% endfor %}
     </div>
 {% endfor %}
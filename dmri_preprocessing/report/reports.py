@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 # Purpose: Handle the report generation, taken from fmriprep
 
-from jinja2 import Environment, FileSystemLoader
 import glob
 import os
 
@@ -9,9 +8,20 @@ TEMPLATE_FILE = "report.tpl"
 dirname = os.path.dirname(__file__)
 #print(dirname)
 
-templateLoader = FileSystemLoader(searchpath=dirname)
-templateEnv = Environment(loader=templateLoader)
-template = templateEnv.get_template(TEMPLATE_FILE)
+_template = None
+
+def get_template():
+    """
+    Load the jinja template of the report. It is loaded the first time a
+    report is created, not when the module is imported.
+    """
+    global _template
+    if _template is None:
+        from jinja2 import Environment, FileSystemLoader
+        templateLoader = FileSystemLoader(searchpath=dirname)
+        templateEnv = Environment(loader=templateLoader)
+        _template = templateEnv.get_template(TEMPLATE_FILE)
+    return _template
 
 def get_data_info(data_type):
     data_summary = ""
@@ -25,9 +35,53 @@ def get_data_info(data_type):
         i += 1
     return data_summary
 
-def create_report(data, data_raw, derivatives_dir, application_name):
+def get_resource_usage(runtime_file, ses):
+    """
+    Create the 'Resource usage' section from the runtime .tsv file, with a
+    table of the time and resources used by each stage.
+    """
+    from dmri_preprocessing import telemetry
+
+    records = telemetry.read_runtime(runtime_file)
+    columns = ['stage', 'status', 'n_threads', 'wait_time_s', 'wall_time_s',
+               'cpu_time_s', 'peak_rss_mb', 'read_mb', 'written_mb']
+    rows = [[record[column] for column in columns] for record in records]
+
+    wall_times = [float(record['wall_time_s']) for record in records]
+    cpu_times = [float(record['cpu_time_s']) for record in records]
+    bullets = {
+        'total wall time of stages (s)': round(sum(wall_times), 1),
+        'total cpu time (s)': round(sum(cpu_times), 1)
+    }
+    if len(records) > 0:
+        slowest = records[wall_times.index(max(wall_times))]
+        bullets['slowest stage'] = slowest['stage'] + ' (' + slowest['wall_time_s'] + ' s)'
+
+    return {
+        'Stages':{
+            'description': 'Time and resources used by each processing stage. \
+                Stages run in parallel, so the total wall time of the stages can be \
+                longer than the time of the session. Cached stages were not run again \
+                (see the checkpoints in the work directory). Peak memory is for the stage \
+                and the tools it runs, read and written are bytes on disk.',
+            'bullets': bullets,
+            'table': {
+                'columns': columns,
+                'rows': rows
+            },
+            'files': [
+                ses + '/' + os.path.basename(runtime_file),
+                ses + '/' + os.path.basename(runtime_file).replace('.tsv','.json')
+            ]
+        }
+    }
+
+def create_report(data, data_raw, derivatives_dir, application_name, runtime_file=None):
     """
     Create .html report for all processing steps.
+
+    If runtime_file (.tsv written by telemetry.write_runtime) is given, the
+    report has a 'Resource usage' section.
     """
 
     output_dir_base = os.path.join(derivatives_dir, application_name)
@@ -167,6 +221,10 @@ def create_report(data, data_raw, derivatives_dir, application_name):
             }
         }
     }
+    if runtime_file is not None:
+        sections['Resource usage'] = get_resource_usage(runtime_file, ses)
+        sections['About'] = sections.pop('About')
+
     # Delete sections which are not relevant for subject
     if degibbs is False:
         del sections['Denoising']['Removal of Gibbs ringing artifacts']
@@ -175,4 +233,6 @@ def create_report(data, data_raw, derivatives_dir, application_name):
 
     output_html_file = os.path.join(output_dir_base,sub,ses+".html")
     with open(output_html_file,'w') as htmlFile:
-        htmlFile.write(template.render(summary=summary,sections=sections))
\ No newline at end of file
+        htmlFile.write(get_template().render(summary=summary,sections=sections))
+
+    return output_html_file
\ No newline at end of file
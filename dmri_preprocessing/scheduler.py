@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# Purpose: Share the cpu budget (--n_cpus) between all running stages
+
+import os
+import json
+import time
+import socket
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+from dmri_preprocessing import utils
+
+# Fraction of the work in a stage that runs in parallel (Amdahl's law).
+# Rough estimates; stages which are not listed are single threaded.
+PARALLEL_FRACTION = {
+    'dwidenoise': 0.95,
+    'mrdegibbs': 0.9,
+    'eddy': 0.9,
+    'n4biasfieldcorrection': 0.7,
+    # compression of the maps
+    'rd': 0.8,
+    # compression of the images, the plots are single threaded
+    'to_derivatives': 0.8,
+}
+
+# While other stages wait for cpus, a stage does not get more threads than
+# it can use with this efficiency
+MIN_EFFICIENCY = 0.6
+
+# Environment variables controlling the number of threads of the tools
+THREAD_ENVIRONMENT = [
+    'OMP_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'MRTRIX_NTHREADS',
+    'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'
+]
+
+def get_max_threads(stage_name):
+    """
+    Maximum number of threads a stage can use efficiently.
+
+    With a parallel fraction p, the efficiency with n threads is
+    1/(n*(1-p) + p). We give the stage the largest n where the efficiency
+    is at least MIN_EFFICIENCY.
+    """
+    p = PARALLEL_FRACTION.get(stage_name, 0.0)
+    return max(1, int((1.0/MIN_EFFICIENCY - p)/(1.0 - p)))
+
+def create_cpu_budget(n_cpus):
+    """
+    Create the file holding the cpu budget of this run. All processes
+    started by this run (sessions in batch mode and nipype workers) take
+    their threads from it.
+
+    Output
+    ======
+    budget_file:
+        path to cpu budget file.
+    """
+    budget_file = os.path.join(
+        tempfile.gettempdir(),
+        'dmri_preprocessing_cpu_budget_%s_%d.json' % (socket.gethostname(), os.getpid())
+    )
+    budget = {
+        'n_cpus': n_cpus,
+        'allocations': {},
+        'queue': []
+    }
+    with utils.file_lock(budget_file + '.lock'):
+        _write_budget(budget_file, budget)
+    return budget_file
+
+def remove_cpu_budget(budget_file):
+    """
+    Remove the cpu budget files when the run is finished.
+    """
+    for filename in [budget_file, budget_file + '.lock']:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+def _write_budget(budget_file, budget):
+    tmp_file = budget_file + '.tmp'
+    with open(tmp_file,'w') as f:
+        json.dump(budget, f)
+    os.replace(tmp_file, budget_file)
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _remove_dead(budget):
+    """
+    Free cpus held by processes that have died, e.g. a crashed nipype node.
+    """
+    budget['allocations'] = {
+        request_id: allocation
+        for request_id, allocation in budget['allocations'].items()
+        if _pid_exists(allocation['pid'])
+    }
+    budget['queue'] = [
+        request for request in budget['queue'] if _pid_exists(request['pid'])
+    ]
+
+def acquire(budget_file, stage_name, poll_interval=1.0):
+    """
+    Wait until cpus are free in the budget and allocate threads to a stage.
+
+    Stages are served in the order they asked. A stage gets the free cpus,
+    but while other stages are waiting not more than it can use
+    efficiently (see get_max_threads), so the rest goes to them. The tools
+    cannot get more threads once they are started, so a stage nobody waits
+    behind gets all free cpus. Cpus are given to the waiting stages when
+    running stages finish.
+
+    Input
+    =====
+    budget_file:
+        path to cpu budget file.
+    stage_name:
+        name of the stage.
+
+    Output
+    ======
+    request_id:
+        id of the allocation, used to release it.
+    n_threads:
+        number of threads allocated to the stage.
+    """
+    request_id = '%d-%d-%s' % (os.getpid(), threading.get_ident(), stage_name)
+    max_threads = get_max_threads(stage_name)
+    while True:
+        with utils.file_lock(budget_file + '.lock'):
+            with open(budget_file) as f:
+                budget = json.load(f)
+            _remove_dead(budget)
+            if request_id not in [request['id'] for request in budget['queue']]:
+                budget['queue'].append({'id': request_id, 'pid': os.getpid()})
+
+            n_used = sum([allocation['n_threads'] for allocation in budget['allocations'].values()])
+            n_free = budget['n_cpus'] - n_used
+            if n_free > 0 and budget['queue'][0]['id'] == request_id:
+                n_threads = n_free
+                if len(budget['queue']) > 1:
+                    n_threads = min(n_free, max_threads)
+                budget['queue'].pop(0)
+                budget['allocations'][request_id] = {
+                    'pid': os.getpid(),
+                    'stage': stage_name,
+                    'n_threads': n_threads
+                }
+                _write_budget(budget_file, budget)
+                return request_id, n_threads
+            _write_budget(budget_file, budget)
+        time.sleep(poll_interval)
+
+def release(budget_file, request_id):
+    """
+    Give the cpus of a finished stage back to the budget.
+    """
+    with utils.file_lock(budget_file + '.lock'):
+        with open(budget_file) as f:
+            budget = json.load(f)
+        budget['allocations'].pop(request_id, None)
+        _write_budget(budget_file, budget)
+
+@contextmanager
+def allocate(budget_file, stage_name):
+    """
+    Allocate threads to a stage for the duration of the context, and set
+    the thread environment variables of the tools.
+
+    Without a budget file the stage gets one thread.
+    """
+    if budget_file is None:
+        request_id, n_threads = None, 1
+    else:
+        request_id, n_threads = acquire(budget_file, stage_name)
+
+    old_environment = {name: os.environ.get(name) for name in THREAD_ENVIRONMENT}
+    for name in THREAD_ENVIRONMENT:
+        os.environ[name] = str(n_threads)
+    try:
+        yield n_threads
+    finally:
+        for name, value in old_environment.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+        if request_id is not None:
+            release(budget_file, request_id)
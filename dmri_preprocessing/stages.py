@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# Purpose: Run processing stages with checkpointing
+
+import os
+import json
+import time
+import pickle
+import hashlib
+import inspect
+
+from dmri_preprocessing import scheduler, telemetry, cleanup
+
+def fingerprint(path):
+    """
+    Cheap fingerprint of a file: size and modification time. Directories
+    are fingerprinted by all files inside them.
+
+    Input
+    =====
+    path:
+        path to file or directory.
+
+    Output
+    ======
+    fingerprint:
+        list with size and modification time (ns), or None if path does
+        not exist.
+    """
+    if os.path.isdir(path):
+        fingerprints = {}
+        for root, dirs, files in os.walk(path):
+            for filename in files:
+                filepath = os.path.join(root,filename)
+                fingerprints[os.path.relpath(filepath,path)] = fingerprint(filepath)
+        return fingerprints
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def get_paths(result):
+    """
+    Find all existing files in a stage result (str, dict, list or tuple).
+    Directories in the result (e.g. the work directory of eddy) give the
+    files inside them, except the frames and gzip indexes read from the
+    images (see cleanup.get_derived_files), which are made again when they
+    are missing.
+    """
+    paths = []
+    if isinstance(result, str):
+        if os.path.isfile(result):
+            paths.append(result)
+        elif os.path.isdir(result):
+            files = []
+            for root, dirs, filenames in os.walk(result):
+                files.extend([os.path.join(root, filename) for filename in filenames])
+            derived = set()
+            for path in files:
+                derived.update(cleanup.get_derived_files(path))
+            paths.extend(sorted([path for path in files if path not in derived]))
+    elif isinstance(result, dict):
+        for value in result.values():
+            paths.extend(get_paths(value))
+    elif isinstance(result, (list, tuple)):
+        for value in result:
+            paths.extend(get_paths(value))
+    return paths
+
+def relocate(result, old_roots, new_roots):
+    """
+    Replace the root of all paths in a stage result (str, dict, list or
+    tuple), e.g. '$WORK_DIR/eddy' -> '/scratch/work/eddy'.
+
+    Input
+    =====
+    result:
+        stage result.
+    old_roots, new_roots:
+        dicts with the old and new path of each root.
+    """
+    if isinstance(result, str):
+        for name in sorted(old_roots, key=lambda name: -len(old_roots[name])):
+            old_root = old_roots[name]
+            if result == old_root or result.startswith(old_root.rstrip(os.sep) + os.sep):
+                return new_roots[name] + result[len(old_root.rstrip(os.sep)):]
+        return result
+    elif isinstance(result, dict):
+        return {key: relocate(value, old_roots, new_roots) for key, value in result.items()}
+    elif isinstance(result, list):
+        return [relocate(value, old_roots, new_roots) for value in result]
+    elif isinstance(result, tuple):
+        return tuple([relocate(value, old_roots, new_roots) for value in result])
+    return result
+
+def get_roots(stage):
+    """
+    Root directories of a stage, e.g. {'WORK_DIR': '/work/sub-01_ses-01_wf'},
+    and their placeholders in the checkpoint, e.g. {'WORK_DIR': '$WORK_DIR'}.
+
+    Paths under the roots are saved relative to them, so that checkpoints
+    stay valid when the directories are moved, e.g. when a session is run
+    in a scratch directory (see staging.py).
+    """
+    roots = {name: os.path.abspath(path) for name, path in stage.get('roots', {}).items()}
+    placeholders = {name: '$' + name for name in roots}
+    return roots, placeholders
+
+def get_stage_key(stage, input_files):
+    """
+    Compute the provenance key of a stage.
+
+    Input
+    =====
+    stage:
+        dict with 'name' and 'params' (options and tool versions) of the stage.
+    input_files:
+        list of input files to the stage.
+
+    Output
+    ======
+    key:
+        sha1 hash of the provenance.
+    provenance:
+        dict with the content of the key.
+    """
+    provenance = {
+        'stage': stage['name'],
+        'params': stage['params'],
+        'inputs': [fingerprint(input_file) for input_file in input_files]
+    }
+    provenance_str = json.dumps(provenance, sort_keys=True, default=str)
+    key = hashlib.sha1(provenance_str.encode()).hexdigest()
+    return key, provenance
+
+def load_checkpoint(stage, key):
+    """
+    Load the result of a stage if it has been run with the same key and
+    its output files are unchanged.
+
+    Output
+    ======
+    found:
+        True if a valid checkpoint exists.
+    result:
+        result of the stage, None if not found.
+    """
+    checkpoint_file = os.path.join(stage['checkpoint_dir'], stage['name'] + '.json')
+    result_file = os.path.join(stage['checkpoint_dir'], stage['name'] + '_result.pkl')
+    if not os.path.exists(checkpoint_file) or not os.path.exists(result_file):
+        return False, None
+
+    with open(checkpoint_file) as f:
+        checkpoint = json.load(f)
+    if checkpoint['key'] != key:
+        return False, None
+    roots, placeholders = get_roots(stage)
+    for output_file, output_fingerprint in checkpoint['outputs'].items():
+        if fingerprint(relocate(output_file, placeholders, roots)) != output_fingerprint:
+            return False, None
+
+    with open(result_file,'rb') as f:
+        result = pickle.load(f)
+    return True, relocate(result, placeholders, roots)
+
+def save_checkpoint(stage, key, provenance, result):
+    """
+    Save the provenance key and the result of a stage.
+    """
+    os.makedirs(stage['checkpoint_dir'], exist_ok=True)
+    checkpoint_file = os.path.join(stage['checkpoint_dir'], stage['name'] + '.json')
+    result_file = os.path.join(stage['checkpoint_dir'], stage['name'] + '_result.pkl')
+
+    roots, placeholders = get_roots(stage)
+    outputs = {}
+    for output_file in get_paths(result):
+        outputs[relocate(output_file, roots, placeholders)] = fingerprint(output_file)
+
+    with open(result_file,'wb') as f:
+        pickle.dump(relocate(result, roots, placeholders), f)
+    checkpoint = {
+        'key': key,
+        'provenance': provenance,
+        'outputs': outputs
+    }
+    with open(checkpoint_file,'w') as f:
+        f.write(json.dumps(checkpoint, sort_keys=True, indent=4, separators=(',', ': '), default=str))
+
+def run_stage(stage, input_files, func, *args, **kwargs):
+    """
+    Run func(*args, **kwargs), unless the stage has been run before with
+    the same provenance key.
+
+    The key contains the fingerprints of the input files, the options and
+    the tool versions of the stage. When an upstream stage is run again, it
+    rewrites its outputs, which changes the key of the stages downstream.
+
+    The stage takes its threads from the cpu budget. If func has an n_cpus
+    argument, it gets the number of threads allocated to the stage.
+
+    With a 'telemetry_dir' in stage, the time and resources used by the
+    stage are saved there (see telemetry.measure).
+
+    The node running the stage passes its outputs to release_outputs when
+    it is done.
+
+    Input
+    =====
+    stage:
+        dict with 'name', 'checkpoint_dir', 'params' and (optional)
+        'cpu_budget', 'telemetry_dir', 'roots' (see get_roots) and 'gc' of
+        the stage.
+    input_files:
+        list of input files to the stage.
+    func:
+        function running the stage.
+    args, kwargs:
+        arguments to func.
+
+    Output
+    ======
+    result:
+        return value of func.
+    """
+    with telemetry.measure(stage['name'], stage.get('telemetry_dir')) as record:
+        key, provenance = get_stage_key(stage, input_files)
+        found, result = load_checkpoint(stage, key)
+        if found:
+            print(f"Stage {stage['name']} is up to date, skipping.")
+            record['status'] = 'cached'
+        else:
+            start_wait = time.time()
+            with scheduler.allocate(stage.get('cpu_budget'), stage['name']) as n_threads:
+                record['wait_time_s'] = round(time.time() - start_wait, 2)
+                record['n_threads'] = n_threads
+                if 'n_cpus' in inspect.signature(func).parameters:
+                    kwargs['n_cpus'] = n_threads
+                result = func(*args, **kwargs)
+            save_checkpoint(stage, key, provenance, result)
+    return result
+
+def release_outputs(stage, outputs):
+    """
+    Called by the node of a stage when it is done (run or cached), with
+    everything the node passes on: the result of run_stage, and the files
+    the node adds to it (e.g. the eddy corrected dwi in data). With a
+    'gc' in stage, the work directory files in outputs, and inside the
+    folders in outputs, are registered with the stages getting them, and
+    the files which no stage needs anymore are deleted (see
+    cleanup.release).
+
+    Output
+    ======
+    outputs:
+        unchanged, so the node can return release_outputs(stage, outputs).
+    """
+    if stage.get('gc') is not None:
+        roots, _ = get_roots(stage)
+        cleanup.release(stage['gc'], stage['name'], get_paths(outputs), roots['WORK_DIR'])
+    return outputs
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# Purpose: Run a session in node-local scratch (--scratch_dir)
+
+import os
+import copy
+import glob
+import shutil
+import tempfile
+
+from contextlib import contextmanager
+
+def copy_tree(src, dst):
+    """
+    Copy a directory, keeping symlinks and modification times (which the
+    checkpoints depend on). Merges into dst if it exists.
+    """
+    for root, dirs, files in os.walk(src):
+        dst_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(dst_root, exist_ok=True)
+        for name in dirs + files:
+            src_path = os.path.join(root, name)
+            dst_path = os.path.join(dst_root, name)
+            if os.path.islink(src_path):
+                if os.path.lexists(dst_path):
+                    os.remove(dst_path)
+                os.symlink(os.readlink(src_path), dst_path)
+            elif os.path.isfile(src_path):
+                shutil.copy2(src_path, dst_path)
+        # Do not follow symlinks to directories, they are copied as links
+        dirs[:] = [name for name in dirs if not os.path.islink(os.path.join(root, name))]
+
+def swap_tree(src, dst):
+    """
+    Replace dst by src, a complete folder on the same filesystem (e.g. next
+    to dst). Both are renamed, so there is never a half written dst: it is
+    the old folder, the new folder, or missing between the two renames.
+    """
+    old_dst = os.path.join(os.path.dirname(dst), '.' + os.path.basename(dst) + '.old')
+    if os.path.exists(old_dst):
+        shutil.rmtree(old_dst)
+    if os.path.exists(dst):
+        os.rename(dst, old_dst)
+    os.rename(src, dst)
+    if os.path.exists(old_dst):
+        shutil.rmtree(old_dst)
+
+def replace_tree(src, dst):
+    """
+    Replace dst by a copy of src. The copy is made next to dst and renamed,
+    so dst is never left half copied.
+    """
+    tmp_dst = dst + '.staging'
+    if os.path.exists(tmp_dst):
+        shutil.rmtree(tmp_dst)
+    copy_tree(src, tmp_dst)
+    swap_tree(tmp_dst, dst)
+
+def copy_file(src, dst):
+    """
+    Copy a file through a temporary file, so dst is never left half copied.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    shutil.copy2(src, dst + '.staging')
+    os.replace(dst + '.staging', dst)
+
+def stage_bids_inputs(bids_dir, subject, session, staged_bids_dir):
+    """
+    Copy the inputs of one session to the staged BIDS directory: the
+    session folder, and the files at the top level of the dataset and the
+    subject folder (e.g. dataset_description.json and inherited sidecars).
+    """
+    sub = 'sub-' + subject
+    ses = 'ses-' + session
+    for folder in [bids_dir, os.path.join(bids_dir, sub)]:
+        for filename in glob.glob(os.path.join(folder, '*')):
+            if os.path.isfile(filename):
+                copy_file(filename, os.path.join(staged_bids_dir, os.path.relpath(filename, bids_dir)))
+    copy_tree(os.path.join(bids_dir, sub, ses), os.path.join(staged_bids_dir, sub, ses))
+
+def has_derivatives(session_dir, subject, session):
+    """
+    True if a session folder has the derivatives of the session (the
+    preprocessed dwi, see outputs.to_derivatives), and not only files
+    written when the export was skipped.
+    """
+    preproc_dwi = 'sub-' + subject + '_ses-' + session + '_space-orig_desc-preproc_dwi.nii.gz'
+    return os.path.exists(os.path.join(session_dir, 'dwi', preproc_dwi))
+
+def export_derivatives(staged_output_dir, output_dir, application_name, subject, session):
+    """
+    Move the derivatives of one session (folder and report) from scratch
+    to the output directory.
+
+    The session folder in the output directory is only replaced by a
+    staged folder with the derivatives. Otherwise (e.g. the export was
+    skipped by its checkpoint) the staged files are merged into it, so
+    published derivatives are never replaced by an incomplete folder.
+    """
+    sub = 'sub-' + subject
+    ses = 'ses-' + session
+    staged_base = os.path.join(staged_output_dir, application_name)
+    output_base = os.path.join(output_dir, application_name)
+
+    staged_session = os.path.join(staged_base, sub, ses)
+    if os.path.exists(staged_session):
+        os.makedirs(os.path.join(output_base, sub), exist_ok=True)
+        if has_derivatives(staged_session, subject, session):
+            replace_tree(staged_session, os.path.join(output_base, sub, ses))
+        else:
+            print(f"The staged folder of {sub} {ses} has no derivatives, merging it into {output_base}")
+            copy_tree(staged_session, os.path.join(output_base, sub, ses))
+    staged_report = os.path.join(staged_base, sub, ses + '.html')
+    if os.path.exists(staged_report):
+        copy_file(staged_report, os.path.join(output_base, sub, ses + '.html'))
+    # Written once for the dataset
+    staged_description = os.path.join(staged_base, 'dataset_description.json')
+    if (os.path.exists(staged_description)
+        and not os.path.exists(os.path.join(output_base, 'dataset_description.json'))):
+        copy_file(staged_description, os.path.join(output_base, 'dataset_description.json'))
+
+def get_scratch_prefix(application_name, subject, session):
+    """
+    Prefix of the scratch folder of a session (see staged_session).
+    """
+    return application_name + '_sub-' + subject + '_ses-' + session + '_'
+
+@contextmanager
+def staged_session(opts, subject, session, application_name):
+    """
+    Stage one session to node-local scratch, and run it there.
+
+    The inputs of the session are copied to a new folder in
+    opts.scratch_dir. Inside the context, the session is processed with
+    the bids, work and output directories in scratch. When the session is
+    done, the derivatives are moved to the output directory. With
+    opts.sync_work_dir, the work directory of the session (checkpoints)
+    is copied in before and back after, also if the session fails, so that
+    the session can be resumed. The scratch folder is always removed.
+
+    Output
+    ======
+    staged_opts:
+        copy of opts with bids_dir, output_dir and work_dir in scratch.
+    """
+    wf_dir = application_name + '_wf'
+    session_wf_dir = 'sub-' + subject + '_ses-' + session + '_wf'
+    versions_file = os.path.join(wf_dir, 'tool_versions.json')
+
+    os.makedirs(opts.scratch_dir, exist_ok=True)
+    scratch = tempfile.mkdtemp(prefix=get_scratch_prefix(application_name, subject, session),
+                               dir=opts.scratch_dir)
+    staged_opts = copy.copy(opts)
+    staged_opts.bids_dir = os.path.join(scratch, 'bids')
+    staged_opts.output_dir = os.path.join(scratch, 'out')
+    staged_opts.work_dir = os.path.join(scratch, 'work')
+    succeeded = False
+    try:
+        print(f"Staging sub-{subject} ses-{session} to {scratch}")
+        stage_bids_inputs(opts.bids_dir, subject, session, staged_opts.bids_dir)
+        if os.path.exists(os.path.join(opts.work_dir, versions_file)):
+            copy_file(os.path.join(opts.work_dir, versions_file), os.path.join(staged_opts.work_dir, versions_file))
+        shared_session_wf = os.path.join(opts.work_dir, wf_dir, session_wf_dir)
+        if opts.sync_work_dir and os.path.exists(shared_session_wf):
+            copy_tree(shared_session_wf, os.path.join(staged_opts.work_dir, wf_dir, session_wf_dir))
+
+        yield staged_opts
+        succeeded = True
+
+        export_derivatives(staged_opts.output_dir, opts.output_dir, application_name, subject, session)
+    finally:
+        if opts.sync_work_dir:
+            staged_session_wf = os.path.join(staged_opts.work_dir, wf_dir, session_wf_dir)
+            if os.path.exists(staged_session_wf):
+                print(f"Copying work dir of sub-{subject} ses-{session} back to {opts.work_dir}")
+                os.makedirs(os.path.join(opts.work_dir, wf_dir), exist_ok=True)
+                replace_tree(staged_session_wf, os.path.join(opts.work_dir, wf_dir, session_wf_dir))
+        if succeeded and os.path.exists(os.path.join(staged_opts.work_dir, versions_file)):
+            copy_file(os.path.join(staged_opts.work_dir, versions_file), os.path.join(opts.work_dir, versions_file))
+        shutil.rmtree(scratch, ignore_errors=True)
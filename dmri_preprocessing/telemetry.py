@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# Purpose: Measure time and resource usage of the processing stages
+
+import os
+import csv
+import json
+import time
+import resource
+import threading
+
+from contextlib import contextmanager
+
+# Seconds between samples of the memory usage of a stage
+SAMPLE_INTERVAL = 0.5
+
+# Columns of the runtime .tsv file
+COLUMNS = [
+    'stage',
+    'status',
+    'start_time',
+    'n_threads',
+    'wait_time_s',
+    'wall_time_s',
+    'cpu_time_s',
+    'peak_rss_mb',
+    'read_mb',
+    'written_mb'
+]
+
+def read_io(pid='self'):
+    """
+    Bytes read from and written to storage by a process, including its
+    finished child processes. Returns (0, 0) if /proc/<pid>/io is not
+    available, e.g. on mac.
+    """
+    io = {}
+    try:
+        with open(os.path.join('/proc',str(pid),'io')) as f:
+            for line in f:
+                name, value = line.split(':')
+                io[name] = int(value)
+    except (OSError, ValueError):
+        return 0, 0
+    return io.get('read_bytes',0), io.get('write_bytes',0)
+
+def get_cpu_time():
+    """
+    User and system cpu time of this process and its finished child
+    processes, i.e. the tools run by a stage.
+    """
+    cpu_time = 0.0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        cpu_time += usage.ru_utime + usage.ru_stime
+    return cpu_time
+
+def get_process_tree(pid):
+    """
+    List pid and all its descendant processes, from /proc.
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc',entry,'stat')) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The process name is in parentheses and can contain spaces
+        ppid = int(stat[stat.rfind(')')+2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    tree = [pid]
+    i = 0
+    while i < len(tree):
+        tree.extend(children.get(tree[i], []))
+        i += 1
+    return tree
+
+def get_tree_rss(pid):
+    """
+    Resident memory (bytes) of a process and all its descendants.
+    """
+    rss = 0
+    for tree_pid in get_process_tree(pid):
+        try:
+            with open(os.path.join('/proc',str(tree_pid),'status')) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1]) * 1024
+                        break
+        except (OSError, ValueError):
+            continue
+    return rss
+
+def _sample_rss(record, stop):
+    while True:
+        record['peak_rss_bytes'] = max(record['peak_rss_bytes'], get_tree_rss(os.getpid()))
+        if stop.wait(SAMPLE_INTERVAL):
+            return
+
+@contextmanager
+def measure(stage_name, telemetry_dir):
+    """
+    Measure wall time, cpu time, peak memory of the process tree and bytes
+    read and written while the context runs, and save them to
+    <telemetry_dir>/<stage_name>.json.
+
+    The memory is sampled every SAMPLE_INTERVAL seconds in a thread, so
+    very short peaks can be missed. Without telemetry_dir nothing is
+    measured.
+
+    Output
+    ======
+    record:
+        dict with the measurements. The caller can set 'status',
+        'n_threads' and 'wait_time_s' (time spent waiting for cpus, which
+        is included in the wall time).
+    """
+    record = {
+        'stage': stage_name,
+        'status': 'run',
+        'start_time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'n_threads': 1,
+        'wait_time_s': 0.0,
+        'peak_rss_bytes': 0
+    }
+    if telemetry_dir is None:
+        yield record
+        return
+
+    sample_rss = os.path.exists('/proc/self/status')
+    stop = threading.Event()
+    if sample_rss:
+        sampler = threading.Thread(target=_sample_rss, args=(record, stop), daemon=True)
+        sampler.start()
+    start_wall = time.time()
+    start_cpu = get_cpu_time()
+    start_read, start_written = read_io()
+    try:
+        yield record
+    finally:
+        end_read, end_written = read_io()
+        record['wall_time_s'] = round(time.time() - start_wall, 2)
+        record['cpu_time_s'] = round(get_cpu_time() - start_cpu, 2)
+        record['read_mb'] = round((end_read - start_read)/1e6, 1)
+        record['written_mb'] = round((end_written - start_written)/1e6, 1)
+        if sample_rss:
+            stop.set()
+            sampler.join()
+            record['peak_rss_mb'] = round(record['peak_rss_bytes']/1e6, 1)
+        else:
+            record['peak_rss_mb'] = ''
+        del record['peak_rss_bytes']
+
+        os.makedirs(telemetry_dir, exist_ok=True)
+        with open(os.path.join(telemetry_dir, stage_name + '.json'),'w') as f:
+            json.dump(record, f)
+
+def load_telemetry(telemetry_dir):
+    """
+    Load the measurements of all stages in telemetry_dir, in the order
+    the stages were started.
+    """
+    records = []
+    if not os.path.isdir(telemetry_dir):
+        return records
+    for filename in os.listdir(telemetry_dir):
+        if filename.endswith('.json'):
+            with open(os.path.join(telemetry_dir,filename)) as f:
+                records.append(json.load(f))
+    return sorted(records, key=lambda record: (record['start_time'], record['stage']))
+
+def write_runtime(telemetry_dir, output_basename):
+    """
+    Write the measurements of all stages to <output_basename>runtime.tsv
+    and <output_basename>runtime.json.
+
+    Output
+    ======
+    runtime_tsv:
+        path to .tsv file, one row per stage.
+    """
+    records = load_telemetry(telemetry_dir)
+    runtime_tsv = output_basename + 'runtime.tsv'
+    runtime_json = output_basename + 'runtime.json'
+
+    with open(runtime_tsv,'w', newline='') as tsv_file:
+        writer = csv.DictWriter(tsv_file, fieldnames=COLUMNS, delimiter='\t', extrasaction='ignore')
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+
+    with open(runtime_json,'w') as json_file:
+        json_file.write(json.dumps({'stages': records}, indent=4, separators=(',', ': ')))
+
+    return runtime_tsv
+
+def read_runtime(runtime_tsv):
+    """
+    Read a runtime .tsv file into a list of dicts.
+    """
+    with open(runtime_tsv, newline='') as tsv_file:
+        return list(csv.DictReader(tsv_file, delimiter='\t'))
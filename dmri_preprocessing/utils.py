@@ -1,15 +1,178 @@
 #!/usr/bin/env python
 # Purpose: Gather all utility functions
 
-from bids.layout import BIDSLayout
-import numpy as np
+# pybids and numpy are imported in the functions using them, so that
+# importing utils (e.g. for file_lock) is fast.
+from contextlib import contextmanager
+import hashlib
+import inspect
+import shutil
+import fcntl
+import glob
+import json
 import os
 
-def get_bids_layout(bids_dir, subject_id, session_id):
+def get_tree_key(paths, root, walk=True):
+    """
+    Key of a set of files and folders: sha1 of their paths (relative to
+    root), sizes and modification times. Folders are walked, or with
+    walk=False only their own modification times are used (they change
+    when entries are added, removed or renamed).
+    """
+    entries = []
+    for path in paths:
+        if not walk and os.path.isdir(path):
+            entries.append([os.path.relpath(path, root), 0, os.stat(path).st_mtime_ns])
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                filepath = os.path.join(dirpath, filename)
+                stat = os.stat(filepath)
+                entries.append([os.path.relpath(filepath, root), stat.st_size, stat.st_mtime_ns])
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            entries.append([os.path.relpath(path, root), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(json.dumps(entries).encode()).hexdigest()
+
+def get_session_files(bids_dir, subject_id, session_id):
+    """
+    Files and folders of the dataset that one session depends on: the
+    session folder, and the files at the top level of the dataset and of
+    the subject folder (dataset_description.json, inherited sidecars).
+    """
+    paths = []
+    for folder in [bids_dir, os.path.join(bids_dir, 'sub-' + subject_id)]:
+        paths.extend(sorted([path for path in glob.glob(os.path.join(folder, '*')) if os.path.isfile(path)]))
+    paths.append(os.path.join(bids_dir, 'sub-' + subject_id, 'ses-' + session_id))
+    return paths
+
+def get_dataset_key(bids_dir):
+    """
+    Key of the folders of a dataset which pybids indexes (see
+    get_indexed_layout), without walking the sessions: the top level
+    files, and the modification times of the dataset and subject folders,
+    which change when subjects or sessions are added or removed.
+    """
+    paths = [bids_dir] + sorted([path for path in glob.glob(os.path.join(bids_dir, '*'))
+                                 if os.path.isfile(path) or os.path.basename(path).startswith('sub-')])
+    return get_tree_key(paths, bids_dir, walk=False)
+
+def get_session_keys(bids_dir):
+    """
+    Key of the files of each session of a dataset (see get_session_files),
+    by sub-<label>_ses-<label>.
+    """
+    session_keys = {}
+    for session_dir in sorted(glob.glob(os.path.join(bids_dir, 'sub-*', 'ses-*'))):
+        if not os.path.isdir(session_dir):
+            continue
+        subject_id = os.path.basename(os.path.dirname(session_dir))[len('sub-'):]
+        session_id = os.path.basename(session_dir)[len('ses-'):]
+        paths = get_session_files(bids_dir, subject_id, session_id)
+        session_keys['sub-' + subject_id + '_ses-' + session_id] = get_tree_key(paths, bids_dir)
+    return session_keys
+
+def create_session_view(bids_dir, paths, view_dir):
+    """
+    Create a BIDS dataset with only the given files and folders, as
+    symlinks to the files in bids_dir.
+    """
+    for path in paths:
+        if os.path.isfile(path):
+            filepaths = [path]
+        else:
+            filepaths = [os.path.join(dirpath, filename)
+                         for dirpath, dirnames, filenames in os.walk(path) for filename in filenames]
+        for filepath in filepaths:
+            link = os.path.join(view_dir, os.path.relpath(filepath, bids_dir))
+            os.makedirs(os.path.dirname(link), exist_ok=True)
+            os.symlink(os.path.abspath(filepath), link)
+
+def load_bids_layout(root, database_dir=None):
+    """
+    Create a pybids layout of root. With database_dir, the index is saved
+    there, or loaded from there if it exists.
+    """
+    from bids.layout import BIDSLayout
+
+    if database_dir is None:
+        return BIDSLayout(root,validate=False)
+    # The database option was renamed in pybids 0.11
+    if 'database_file' in inspect.signature(BIDSLayout.__init__).parameters:
+        return BIDSLayout(root,validate=False,database_file=os.path.join(database_dir,'layout.sqlite'))
+    return BIDSLayout(root,validate=False,database_path=database_dir)
+
+def get_indexed_layout(bids_dir, subject_id, session_id, index_dir, scope):
+    """
+    Get a pybids layout from a persistent index in index_dir.
+
+    The index is built once by the first job, under a file lock, and then
+    loaded read-only by all jobs. It is rebuilt when the indexed files
+    change (names, sizes or modification times).
+
+    scope 'session' indexes only the session folder and the top level
+    sidecars, through a folder with symlinks in index_dir, so the time
+    does not depend on the size of the dataset. scope 'dataset' indexes
+    the whole dataset once for all sessions. Its key does not walk the
+    dataset (see get_dataset_key): a job only checks the files of its own
+    session against the keys of the sessions saved with the index.
+    """
+    session_name = 'sub-' + subject_id + '_ses-' + session_id
+    paths = get_session_files(bids_dir, subject_id, session_id)
+    session_key = get_tree_key(paths, bids_dir)
+    if scope == 'session':
+        index = os.path.join(index_dir, session_name)
+        root = os.path.join(index, 'bids')
+        key = session_key
+    else:
+        index = os.path.join(index_dir, 'dataset')
+        root = bids_dir
+        key = get_dataset_key(bids_dir)
+    key_file = os.path.join(index, 'key.json')
+
+    def is_valid():
+        if not os.path.exists(key_file):
+            return False
+        with open(key_file) as f:
+            saved = json.load(f)
+        if scope == 'dataset':
+            return saved['key'] == key and saved['sessions'].get(session_name) == session_key
+        return saved['key'] == key
+
+    if not is_valid():
+        os.makedirs(index_dir, exist_ok=True)
+        with file_lock(index + '.lock'):
+            if not is_valid():
+                print(f"Indexing BIDS dataset ({scope}) in {index}")
+                if os.path.exists(index):
+                    shutil.rmtree(index)
+                os.makedirs(os.path.join(index, 'database'))
+                saved = {'key': key, 'bids_dir': os.path.abspath(bids_dir)}
+                if scope == 'session':
+                    create_session_view(bids_dir, paths, root)
+                else:
+                    saved['sessions'] = get_session_keys(bids_dir)
+                load_bids_layout(root, os.path.join(index, 'database'))
+                # The key is written last, it marks the index as complete
+                with open(key_file,'w') as f:
+                    json.dump(saved, f)
+    return load_bids_layout(root, os.path.join(index, 'database'))
+
+def get_bids_layout(bids_dir, subject_id, session_id, index_dir=None, scope='session'):
     """
     Use pybids to extract information about dataset that is being processed
+
+    Without index_dir the whole dataset is indexed in memory. With
+    index_dir, the index is saved there and reused (see
+    get_indexed_layout). With scope 'session', the filenames are in the
+    indexed folder of the session (symlinks to bids_dir), which is
+    layout.root.
     """
-    layout = BIDSLayout(bids_dir,validate=False)
+    if index_dir is None:
+        layout = load_bids_layout(bids_dir)
+    else:
+        layout = get_indexed_layout(bids_dir, subject_id, session_id, index_dir, scope)
 
     participant_data = {}
     participant_data['subject'] = subject_id
@@ -20,45 +183,273 @@ def get_bids_layout(bids_dir, subject_id, session_id):
 
     return layout, participant_data
 
+@contextmanager
+def file_lock(lock_file):
+    """
+    Hold an exclusive lock on lock_file. The lock is shared between
+    processes, e.g. nodes running in parallel in a nipype workflow.
+    """
+    with open(lock_file,'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# NIfTI extensions, and the matching fsl/nipype output_type
+NIFTI_OUTPUT_TYPES = {'.nii.gz': 'NIFTI_GZ', '.nii': 'NIFTI'}
+
+def split_nifti_ext(filename):
+    """
+    Split a NIfTI filename into base and extension (.nii.gz or .nii),
+    e.g. sub-01_dwi.nii.gz -> ('sub-01_dwi', '.nii.gz').
+    """
+    for extension in NIFTI_OUTPUT_TYPES:
+        if filename.endswith(extension):
+            return filename[:-len(extension)], extension
+    raise ValueError("Not a NIfTI file: %s" % filename)
+
+def glob_nifti(pattern):
+    """
+    Find the NIfTI files pattern + '.nii' or pattern + '.nii.gz', sorted,
+    e.g. glob_nifti('03_dtifit/dtifit_*'). Other files starting like them
+    (e.g. a temporary file left by an interrupted write) are not matched.
+    """
+    return sorted(glob.glob(pattern + '.nii') + glob.glob(pattern + '.nii.gz'))
+
+def replace_nifti_ext(filename, ending):
+    """
+    Replace the NIfTI extension of filename, e.g. by '.bval'.
+    """
+    return split_nifti_ext(filename)[0] + ending
+
+def add_nifti_suffix(filename, suffix):
+    """
+    Add a suffix before the NIfTI extension, keeping the extension, e.g.
+    dwi.nii -> dwi_denoised.nii.
+    """
+    base, extension = split_nifti_ext(filename)
+    return base + suffix + extension
+
+def get_output_type(filename):
+    """
+    fsl/nipype output_type writing files with the extension of filename.
+    """
+    return NIFTI_OUTPUT_TYPES[split_nifti_ext(filename)[1]]
+
+def copy_nifti(src, dst, compresslevel=6, n_threads=1):
+    """
+    Copy a file. A NIfTI file is compressed or decompressed on the way if
+    src and dst do not both end with .gz, e.g. from a .nii in the work
+    directory to a .nii.gz in the derivatives. Compression uses n_threads
+    threads (see compression.compress_file).
+    """
+    import gzip
+    from dmri_preprocessing import compression
+
+    if src.endswith('.gz') == dst.endswith('.gz'):
+        shutil.copy(src, dst)
+    elif dst.endswith('.gz'):
+        compression.compress_file(src, dst, compresslevel, n_threads)
+    else:
+        with gzip.open(src,'rb') as f_in, open(dst,'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 1 << 20)
+    return dst
+
+# ioctl cloning a file on copy-on-write filesystems (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+def reflink_file(src, dst):
+    """
+    Copy src to dst as a reflink: dst shares the data blocks of src until
+    one of them is written to. Raises OSError if the filesystem does not
+    support it.
+    """
+    with open(src,'rb') as f_src, open(dst,'wb') as f_dst:
+        fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+
+def link_file(src, dst, symlink=True, hardlink=True):
+    """
+    Place src at dst without copying the data when possible: a hardlink
+    (if hardlink is True), else a reflink, else a symlink to src (if
+    symlink is True), and a copy only when none of them work (e.g. on some
+    network filesystems).
+
+    dst can share its data with src, so it must never be written to in
+    place. The stages always write new output files, and an existing dst
+    is removed first, so the input data is never modified. A reflink or a
+    copy is a file of its own, which does not change with src.
+
+    Output
+    ======
+    method: 'hardlink', 'reflink', 'symlink' or 'copy'.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            pass
+    try:
+        reflink_file(src, dst)
+        return 'reflink'
+    except OSError:
+        if os.path.lexists(dst):
+            os.remove(dst)
+    if symlink:
+        try:
+            os.symlink(os.path.realpath(src), dst)
+            return 'symlink'
+        except OSError:
+            pass
+    shutil.copy(src, dst)
+    return 'copy'
+
 def edit_phase_encoding_dir_metadata(metadata):
     # In the metadata we have encoding directions as i,j and k. FSL TOPUP needs x,y or z.
+    # A missing direction is reported by preflight.check_session
+    if 'PhaseEncodingDirection' not in metadata:
+        return metadata
     metadata['PhaseEncodingDirection'] = metadata['PhaseEncodingDirection'].replace('i','x')
     metadata['PhaseEncodingDirection'] = metadata['PhaseEncodingDirection'].replace('j','y')
     metadata['PhaseEncodingDirection'] = metadata['PhaseEncodingDirection'].replace('k','z')
     return metadata
 
-def get_overview_of_data(subject_data, layout, b0_threshold):
+def parse_bids_filename(filename):
+    """
+    Split a BIDS filename into its entities and suffix, e.g.
+    sub-01_ses-01_dir-AP_epi.nii.gz -> ({'sub': '01', 'ses': '01', 'dir': 'AP'}, 'epi')
+    """
+    name = os.path.basename(filename).split('.')[0]
+    parts = name.split('_')
+    entities = {}
+    for part in parts[:-1]:
+        if '-' in part:
+            key, value = part.split('-', 1)
+            entities[key] = value
+    return entities, parts[-1]
+
+def read_json_cached(filename, cache):
+    """
+    Read a json file, or get it from cache if it is unchanged. The cache is
+    keyed on the real path, so a sidecar seen through symlinks (see
+    create_session_view) is only read once.
+    """
+    path = os.path.realpath(filename)
+    mtime = os.stat(path).st_mtime_ns
+    if path not in cache or cache[path][0] != mtime:
+        with open(path) as f:
+            cache[path] = (mtime, json.load(f))
+    return cache[path][1]
+
+def load_metadata(filenames, root, cache=None):
+    """
+    Load the metadata of many files in one pass, following the BIDS
+    inheritance principle: the sidecars in the folders from root down to
+    the file, with the same suffix and a subset of the entities of the
+    file, are merged. Deeper and more specific sidecars take precedence.
+
+    Parsed sidecars and folder listings are cached, so the sidecars
+    shared by many files (e.g. at the top level of the dataset) are only
+    read once. Pass the same cache to reuse it for several sessions.
+
+    Input
+    =====
+    filenames:
+        list of data files (e.g. .nii.gz) under root.
+    root:
+        root folder of the BIDS dataset.
+    cache:
+        dict, filled with parsed sidecars and folder listings.
+
+    Output
+    ======
+    metadata:
+        dict with the merged metadata of each file, with the phase
+        encoding directions as x, y and z (see
+        edit_phase_encoding_dir_metadata).
+    """
+    if cache is None:
+        cache = {}
+    listings = cache.setdefault('listings', {})
+    sidecars = cache.setdefault('sidecars', {})
+    root = os.path.abspath(root)
+
+    metadata = {}
+    for filename in filenames:
+        entities, suffix = parse_bids_filename(filename)
+        folder = os.path.dirname(os.path.abspath(filename))
+        folders = [folder]
+        while folder != root and folder.startswith(root + os.sep):
+            folder = os.path.dirname(folder)
+            folders.append(folder)
+
+        candidates = []
+        for depth, folder in enumerate(reversed(folders)):
+            if folder not in listings:
+                listings[folder] = sorted([name for name in os.listdir(folder) if name.endswith('.json')])
+            for name in listings[folder]:
+                sidecar_entities, sidecar_suffix = parse_bids_filename(name)
+                if sidecar_suffix != suffix:
+                    continue
+                if all([entities.get(key) == value for key, value in sidecar_entities.items()]):
+                    candidates.append((depth, len(sidecar_entities), os.path.join(folder, name)))
+
+        merged = {}
+        for depth, n_entities, sidecar in sorted(candidates):
+            merged.update(read_json_cached(sidecar, sidecars))
+        # In the metadata we have encoding directions as i,j and k. FSL TOPUP needs x,y or z.
+        metadata[filename] = edit_phase_encoding_dir_metadata(merged)
+    return metadata
+
+def get_overview_of_data(subject_data, layout, b0_threshold, metadata_cache=None):
     """
     Gather data from dwi and fmaps into a dictionary
+
+    The metadata of all files is read in one pass with load_metadata.
+    metadata_cache can be shared between sessions. The gradient table of
+    each dwi run is read once, in data['dwi'][i]['gradients']. layout is
+    a pybids layout, or the root folder of the dataset.
     """
+    from dmri_preprocessing.gradients import GradientTable
+
     data = {}
 
     data['dwi'] = []
     data['fmap'] = []
     data['sbref'] = []
 
-    # dwi data
     data_types = ['dwi','fmap','sbref']
+    filenames = []
+    for data_type in data_types:
+        filenames.extend(subject_data[data_type])
+    root = layout if isinstance(layout, str) else layout.root
+    all_metadata = load_metadata(filenames, root, metadata_cache)
+
+    # dwi data
     for data_type in data_types:
         for filename in subject_data[data_type]:
             # get metadata
-            metadata = layout.get_metadata(filename)
-            # In the metadata we have encoding directions as i,j and k. FSL TOPUP needs x,y or z.
-            metadata = edit_phase_encoding_dir_metadata(metadata)
+            metadata = all_metadata[filename]
             if data_type == 'dwi':
-                # extract bvals and b0 indeces
-                with open(filename.replace('nii.gz','bval')) as f_bval:
-                    bval = np.array(f_bval.readline().split(" "),dtype=int)
-                    b0_idx = np.where(bval<b0_threshold)
-                    bhigh_idx = np.where(bval>b0_threshold)
-                
+                # read the gradient table of the run
+                gradients = GradientTable.from_files(
+                    replace_nifti_ext(filename,'.bval'),
+                    replace_nifti_ext(filename,'.bvec'),
+                    b0_threshold,
+                    source_id=len(data['dwi'])
+                )
+
                 data[data_type].append(
                     {
                         'filename': filename,
                         'metadata': metadata,
-                        'bval': bval,
-                        'b0_idx':b0_idx[0],
-                        'bhigh_idx': bhigh_idx[0]
+                        'gradients': gradients,
+                        'bval': gradients.bvals,
+                        'b0_idx': gradients.b0_idx,
+                        'bhigh_idx': gradients.bhigh_idx
                     }
                 )
             else:
@@ -67,7 +458,8 @@ def get_overview_of_data(subject_data, layout, b0_threshold):
                     if any(['dwi' in test for test in metadata['IntendedFor']]):
                         include = True
                 except:
-                    if os.path.exists(filename.replace("_sbref.nii.gz","_dwi.nii.gz")):
+                    base, extension = split_nifti_ext(filename)
+                    if base.endswith("_sbref") and os.path.exists(base[:-len("_sbref")] + "_dwi" + extension):
                         include = True
                 if include is True:
                     data[data_type].append(
@@ -159,26 +551,23 @@ def merge_bval_bvecs(in_files,output_file_base):
         List of nifty files that are being merged.
     output_file_base:
         outputname with path and without extension
+
+    Output
+    ======
+    gradients:
+        GradientTable of the merged files.
     """
-    output_bval = output_file_base + ".bval"
-    output_bvec = output_file_base + ".bvec"
-
-    # bval
-    with open(output_bval,'w') as bval_file:
-        bvals = []
-        for in_file in in_files:
-            with open(in_file.replace('.nii.gz','.bval'),'r') as bval_in:
-                bvals.append(bval_in.read().strip())
-        bval_file.write(" ".join(bvals)+"\n")
-
-    # bvec
-    bvec_arrays = np.array([])
-    i = 0
-    for in_file in in_files:
-        bvec_array = np.loadtxt(fname=in_file.replace('.nii.gz','.bvec'))
-        if i == 0:
-            bvec_arrays = bvec_array
-        else:
-            bvec_arrays = np.hstack((bvec_arrays,bvec_array))
-        i = i + 1
-    np.savetxt(output_bvec,bvec_arrays)
\ No newline at end of file
+    from dmri_preprocessing.gradients import GradientTable
+
+    # The b0 threshold does not change the merged files
+    gradients = GradientTable.merge([
+        GradientTable.from_files(
+            replace_nifti_ext(in_file,'.bval'),
+            replace_nifti_ext(in_file,'.bvec'),
+            0,
+            source_id=i
+        )
+        for i, in_file in enumerate(in_files)
+    ])
+    gradients.to_files(output_file_base)
+    return gradients
\ No newline at end of file
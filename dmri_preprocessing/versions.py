@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Purpose: Probe the versions of the external tools, with a persistent cache
+
+import os
+import json
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+
+from dmri_preprocessing import utils
+
+def get_fsl_version_file():
+    """
+    File which fsl (and nipype) reads the fsl version from.
+    """
+    if os.getenv('FSLDIR'):
+        return os.path.join(os.getenv('FSLDIR'), 'etc', 'fslversion')
+    return None
+
+# The file each version depends on, i.e. the binary run by the probe in
+# workflows.get_<tool>_version
+TOOLS = {
+    'fsl': get_fsl_version_file,
+    'mrtrix3': lambda: shutil.which('dwidenoise'),
+    'ants': lambda: shutil.which('antsRegistration'),
+}
+
+def get_tool_key(tool):
+    """
+    Key of the cached version of a tool: resolved path and modification
+    time of its binary. A new installation of the tool changes the key.
+    """
+    path = TOOLS[tool]()
+    if path is None or not os.path.exists(path):
+        return {'path': None, 'mtime_ns': None}
+    path = os.path.realpath(path)
+    return {'path': path, 'mtime_ns': os.stat(path).st_mtime_ns}
+
+def probe_version(tool):
+    """
+    Run the version probe of a tool (see workflows.get_<tool>_version).
+    """
+    from dmri_preprocessing import workflows
+    return getattr(workflows, 'get_%s_version' % tool)()
+
+def get_tool_versions(cache_file=None):
+    """
+    Get the versions of fsl, mrtrix3 and ants.
+
+    Versions are read from cache_file if the binaries are unchanged. The
+    tools which are not in the cache are probed in parallel, and the cache
+    is updated. The cache is locked while probing, so sessions started at
+    the same time in batch mode probe only once.
+
+    Input
+    =====
+    cache_file:
+        path to .json file with cached versions. None probes all tools.
+
+    Output
+    ======
+    versions:
+        dict with version of each tool, e.g. {'fsl': '6.0.4', ...}.
+    """
+    if cache_file is None:
+        with ThreadPoolExecutor(max_workers=len(TOOLS)) as executor:
+            return dict(zip(TOOLS, executor.map(probe_version, TOOLS)))
+
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    with utils.file_lock(cache_file + '.lock'):
+        cache = {}
+        if os.path.exists(cache_file):
+            with open(cache_file) as f:
+                cache = json.load(f)
+
+        versions = {}
+        to_probe = []
+        keys = {tool: get_tool_key(tool) for tool in TOOLS}
+        for tool in TOOLS:
+            if tool in cache and cache[tool]['key'] == keys[tool]:
+                versions[tool] = cache[tool]['version']
+            else:
+                to_probe.append(tool)
+
+        if len(to_probe) > 0:
+            print("Probing versions of: " + ", ".join(to_probe))
+            with ThreadPoolExecutor(max_workers=len(to_probe)) as executor:
+                probed = list(executor.map(probe_version, to_probe))
+            for tool, version in zip(to_probe, probed):
+                versions[tool] = version
+                cache[tool] = {'key': keys[tool], 'version': version}
+
+            tmp_file = cache_file + '.tmp'
+            with open(tmp_file,'w') as f:
+                f.write(json.dumps(cache, sort_keys=True, indent=4, separators=(',', ': ')))
+            os.replace(tmp_file, cache_file)
+
+    return versions
@@ -2,8 +2,6 @@
 # Purpose: Gather all workflow routines here
 
 import os
-import shutil
-import glob
 import numpy as np
 
 import nipype.pipeline.engine as pe 
@@ -11,11 +9,16 @@ import nipype.pipeline.engine as pe
 from nipype.interfaces import fsl
 from nipype.interfaces import mrtrix3
 from nipype.interfaces import ants
-from dmri_preprocessing.report.plots import plot_before_after_svg
+from nipype.interfaces import utility as niu
 import subprocess
 import nibabel as nib
 
-import dmri_preprocessing.utils
+from dmri_preprocessing import utils
+from dmri_preprocessing import frames
+from dmri_preprocessing import concat
+from dmri_preprocessing import cleanup
+from dmri_preprocessing import dtiscalars
+from dmri_preprocessing import biasfield
 
 def get_fsl_version():
     """
@@ -57,6 +60,10 @@ def gather_inputs(data, subject,session,output_dir):
     If it exists more than one dwi sequence, they will be 
     merged if they have same phase encoding direction.
 
+    The dwi file in the work directory has the extension
+    data['nifti_ext'] (.nii.gz, or .nii for uncompressed intermediates),
+    and the following steps keep it.
+
     Inputs
     ======
     data: dict with information about the data we are going to process.
@@ -64,12 +71,14 @@ def gather_inputs(data, subject,session,output_dir):
     Outputs
     =======
     data: updated dict with information about the data we are going to
-          process.
+          process. data['gradients'] is the GradientTable of the merged
+          dwi file.
     """
     # Merge dwi data if more than one dwi file,
     # if not, copy the original data
     if len(data['dwi']) > 1:
         in_files_dwi = []
+        gradients_dwi = []
         encoding_directions = []
         i = 0
         for dwi in data['dwi']:
@@ -79,6 +88,7 @@ def gather_inputs(data, subject,session,output_dir):
                 continue
             encoding_directions.append(encoding_direction)
             in_files_dwi.append(dwi['filename'])
+            gradients_dwi.append(dwi['gradients'])
             # merge metadata
             # metadata fields that needs to be merged:
             # - 'ProtocolName','SAR','SeriesNumber','WipMemBlock'
@@ -92,29 +102,28 @@ def gather_inputs(data, subject,session,output_dir):
                 del[data['dwi'][i]]
             i += 1
 
-        output_file = os.path.join(output_dir,"sub-"+str(subject)+"_ses-"+str(session)+"_dwi.nii.gz")
-        merge = pe.Node(
-            fsl.Merge(
-                dimension='t',
-                in_files=in_files_dwi,
-                merged_file=output_file,
-                output_type="NIFTI_GZ"
-            ),
-            name='merge'
-        )
-        merge.base_dir = output_dir
-        merge.run()
-        utils.merge_bval_bvecs(in_files_dwi,output_file.replace('.nii.gz',''))
+        output_file = os.path.join(output_dir,"sub-"+str(subject)+"_ses-"+str(session)+"_dwi"+data['nifti_ext'])
+        # Merge the images and gradient tables in one pass
+        _, data['gradients'] = concat.concat_images(in_files_dwi,output_file,gradients_dwi)
+        data['gradients'].to_files(utils.split_nifti_ext(output_file)[0])
         data['dwi'][0]['filename'] = os.path.join(output_dir,output_file)
     else:
-        shutil.copy(data['dwi'][0]['filename'],output_dir)
-        shutil.copy(data['dwi'][0]['filename'].replace('.nii.gz','.bvec'),output_dir)
-        shutil.copy(data['dwi'][0]['filename'].replace('.nii.gz','.bval'),output_dir)
-        data['dwi'][0]['filename'] = os.path.join(output_dir,os.path.basename(data['dwi'][0]['filename']))
+        in_file = data['dwi'][0]['filename']
+        output_file = os.path.join(output_dir,utils.replace_nifti_ext(os.path.basename(in_file),data['nifti_ext']))
+        # The raw data is linked, not copied, unless it is decompressed
+        # for uncompressed intermediates
+        if utils.split_nifti_ext(in_file)[1] == data['nifti_ext']:
+            utils.link_file(in_file,output_file)
+        else:
+            utils.copy_nifti(in_file,output_file)
+        for extension in ['.bvec','.bval']:
+            utils.link_file(utils.replace_nifti_ext(in_file,extension),utils.replace_nifti_ext(output_file,extension))
+        data['gradients'] = data['dwi'][0]['gradients']
+        data['dwi'][0]['filename'] = output_file
     
     # bval and bvecs
-    data['in_bval'] = data['dwi'][0]['filename'].replace('.nii.gz','.bval')
-    data['in_bvec'] = data['dwi'][0]['filename'].replace('.nii.gz','.bvec')
+    data['in_bval'] = utils.replace_nifti_ext(data['dwi'][0]['filename'],'.bval')
+    data['in_bvec'] = utils.replace_nifti_ext(data['dwi'][0]['filename'],'.bvec')
 
     # Make mask for qc plots
     mask_name = extract_mask_from_dwi(data,data['dwi'][0]['filename'])
@@ -135,10 +144,10 @@ def run_dwidenoise(data, denoise_filter_length, n_cpus, output_dir):
 
     Outputs
     =======
-    None
+    data: updated dict with the denoised dwi file.
     """
     in_file = data['dwi'][0]['filename']
-    out_dwidenoise = in_file.replace('.nii.gz','_denoised.nii.gz')
+    out_dwidenoise = utils.add_nifti_suffix(in_file,'_denoised')
     dwidenoise = pe.Node(mrtrix3.preprocess.DWIDenoise(
             in_file=in_file,
             extent=denoise_filter_length,
@@ -151,23 +160,42 @@ def run_dwidenoise(data, denoise_filter_length, n_cpus, output_dir):
     dwidenoise.run()
     data['dwi'][0]['filename'] = out_dwidenoise
 
-    # Produce qc figure
-    output_svg_basename = out_dwidenoise.replace('.nii.gz','')
+    return data
+
+def plot_before_after_frames(in_file, out_file, data, output_svg_basename):
+    """
+    Plot a low and a high b-value frame before and after a processing step.
+
+    Inputs
+    ======
+    in_file: dwi file before the processing step.
+    out_file: dwi file after the processing step.
+    data: dict containing information about data
+    output_svg_basename: output path of figures, without extension.
+
+    Outputs
+    =======
+    output_svg: list with paths to the low and high b-value figures.
+    """
     # Extract high and low b0 value for qc report
-    dwi_b_low = extract_frame_dwi(in_file,data['dwi'][0]['b0_idx'][0])
-    dwi_b_high = extract_frame_dwi(in_file,data['dwi'][0]['bhigh_idx'][0])
-    dwi_denoise_b_low = extract_frame_dwi(out_dwidenoise,data['dwi'][0]['b0_idx'][0])
-    dwi_denoise_b_high = extract_frame_dwi(out_dwidenoise,data['dwi'][0]['bhigh_idx'][0])
+    # Both frames of a file are read in one pass
+    frame_nrs = [data['gradients'].b0_idx[0],data['gradients'].bhigh_idx[0]]
+    dwi_b_low, dwi_b_high = frames.extract_frames(in_file,frame_nrs)
+    dwi_out_b_low, dwi_out_b_high = frames.extract_frames(out_file,frame_nrs)
+
+    # The plotting stack (matplotlib, niworkflows, ...) is slow to import,
+    # so it is only imported by the stages making figures
+    from dmri_preprocessing.report.plots import plot_before_after_svg
 
     output_svg = [output_svg_basename + '_lowb.svg',output_svg_basename + '_highb.svg']
-    plot_before_after_svg(dwi_b_low,dwi_denoise_b_low,data['b0_mask'],output_svg[0])
-    plot_before_after_svg(dwi_b_high,dwi_denoise_b_high,data['b0_mask'],output_svg[1])
+    plot_before_after_svg(dwi_b_low,dwi_out_b_low,data['b0_mask'],output_svg[0])
+    plot_before_after_svg(dwi_b_high,dwi_out_b_high,data['b0_mask'],output_svg[1])
 
     return output_svg
 
 def run_mrdegibbs(data, n_cpus, output_dir):
     """
-    Run mrtrix3 dwidenoise routine on in_file
+    Run mrtrix3 mrdegibbs routine on in_file
 
     Inputs
     ======
@@ -177,10 +205,10 @@ def run_mrdegibbs(data, n_cpus, output_dir):
 
     Outputs
     =======
-    None
+    data: updated dict with the degibbsed dwi file.
     """
     in_file = data['dwi'][0]['filename']
-    out_mrdegibbs = in_file.replace('.nii.gz','_mrdegibbs.nii.gz')
+    out_mrdegibbs = utils.add_nifti_suffix(in_file,'_mrdegibbs')
     mrdegibbs = pe.Node(mrtrix3.MRDeGibbs(
             in_file=in_file,
             out_file=out_mrdegibbs,
@@ -193,21 +221,7 @@ def run_mrdegibbs(data, n_cpus, output_dir):
 
     data['dwi'][0]['filename'] = out_mrdegibbs
 
-    # Produce qc figure
-    output_svg_basename = out_mrdegibbs.replace('_denoised','').replace('.nii.gz','')
-    print(output_svg_basename)
-
-    # Extract high and low b0 value for qc report
-    dwi_b_low = extract_frame_dwi(in_file,data['dwi'][0]['b0_idx'][0])
-    dwi_b_high = extract_frame_dwi(in_file,data['dwi'][0]['bhigh_idx'][0])
-    dwi_degibbs_b_low = extract_frame_dwi(out_mrdegibbs,data['dwi'][0]['b0_idx'][0])
-    dwi_degibbs_b_high = extract_frame_dwi(out_mrdegibbs,data['dwi'][0]['bhigh_idx'][0])
-
-    output_svg = [output_svg_basename + '_lowb.svg',output_svg_basename + '_highb.svg']
-    plot_before_after_svg(dwi_b_low,dwi_degibbs_b_low,data['b0_mask'],output_svg[0])
-    plot_before_after_svg(dwi_b_high,dwi_degibbs_b_high,data['b0_mask'],output_svg[1])
-
-    return output_svg
+    return data
 
 def run_topup(data, topup_options, output_dir):
     """
@@ -221,10 +235,12 @@ def run_topup(data, topup_options, output_dir):
 
     Outputs
     =======
-    output_svg_name: file path to svg containing before and after of sdc
+    topup_basename: path prefix of the topup outputs.
+    multiple_encoding_directions_file: merged input to topup.
     """
 
     # topup: preparation
+    # One entry per input file, see the encoding direction file below
     in_files_fmap = []
     encoding_directions = []
     readout_times = []
@@ -239,19 +255,12 @@ def run_topup(data, topup_options, output_dir):
         # merge fmaps:
         for fmap in data['fmap']:
             in_files_fmap.append(fmap['filename'])
-            # Add as many entries to the encoding direction file as it is frames
-            # in the nifty files
-            try:
-                fmap_nii_frames = nib.load(fmap['filename']).shape[3]
-            except:
-                fmap_nii_frames = 1
-            for i in range(0,fmap_nii_frames):
-                encoding_directions.append(fmap['metadata']['PhaseEncodingDirection'])
-                readout_times.append(fmap['metadata']['TotalReadoutTime'])
+            encoding_directions.append(fmap['metadata']['PhaseEncodingDirection'])
+            readout_times.append(fmap['metadata']['TotalReadoutTime'])
                 
     elif topup_options['dwi_fmap_combined']:
         # Extract b0 from dwi
-        b0_file = extract_frame_dwi(data['dwi'][0]['filename'],data['dwi'][0]['b0_idx'][0])
+        b0_file = extract_frame_dwi(data['dwi'][0]['filename'],data['gradients'].b0_idx[0])
 
         in_files_fmap.append(b0_file)
         encoding_directions.append(data['dwi'][0]['metadata']['PhaseEncodingDirection'])
@@ -263,18 +272,14 @@ def run_topup(data, topup_options, output_dir):
             encoding_directions.append(fmap['metadata']['PhaseEncodingDirection'])
             readout_times.append(fmap['metadata']['TotalReadoutTime'])
 
-    multiple_encoding_directions_file = os.path.join(output_dir,"AP_PA.nii.gz")
-    merge = pe.Node(
-        fsl.Merge(
-            dimension='t',
-            in_files=in_files_fmap,
-            merged_file=multiple_encoding_directions_file,
-            output_type="NIFTI_GZ"
-        ), 
-        name='merge'
-    )
-    merge.base_dir = output_dir
-    merge.run()
+    multiple_encoding_directions_file = os.path.join(output_dir,"AP_PA"+data['nifti_ext'])
+    output_type = utils.get_output_type(multiple_encoding_directions_file)
+    source_ids, _ = concat.concat_images(in_files_fmap,multiple_encoding_directions_file)
+
+    # Add as many entries to the encoding direction file as it is frames
+    # in the merged file
+    encoding_directions = [encoding_directions[i] for i in source_ids]
+    readout_times = [readout_times[i] for i in source_ids]
 
     topup_nipype_name = 'topup'
     topup = pe.Node(
@@ -282,19 +287,40 @@ def run_topup(data, topup_options, output_dir):
             in_file=multiple_encoding_directions_file, 
             encoding_direction=encoding_directions, 
             readout_times=readout_times,
-            output_type = "NIFTI_GZ"
+            output_type = output_type
         ),
         name=topup_nipype_name
     )
     topup.base_dir = output_dir
     topup.run()
 
-    # Produce qc figure
+    topup_basename = os.path.join(
+        output_dir,
+        topup_nipype_name,
+        utils.split_nifti_ext(os.path.basename(multiple_encoding_directions_file))[0]
+    )
+
+    return topup_basename, multiple_encoding_directions_file
+
+def plot_topup(data, topup_basename, multiple_encoding_directions_file):
+    """
+    Plot the first frame of the topup input before and after correction.
+
+    Inputs
+    ======
+    data: dict containing datasets and metainformation.
+    topup_basename: path prefix of the topup outputs.
+    multiple_encoding_directions_file: merged input to topup.
+
+    Outputs
+    =======
+    output_svg_name: file path to svg containing before and after of sdc
+    """
     before_nii = extract_frame_dwi(multiple_encoding_directions_file,0)
-    after_nii_basename = os.path.basename(multiple_encoding_directions_file.replace('.nii.gz','_corrected.nii.gz'))
-    after_nii = extract_frame_dwi(os.path.join(output_dir,topup_nipype_name,after_nii_basename),0)
-    output_svg_name = after_nii.replace('.nii.gz','.svg')
+    after_nii = extract_frame_dwi(topup_basename + '_corrected' + data['nifti_ext'],0)
+    output_svg_name = utils.replace_nifti_ext(after_nii,'.svg')
 
+    from dmri_preprocessing.report.plots import plot_before_after_svg
     plot_before_after_svg(before_nii,after_nii,data['b0_mask'],output_svg_name)
 
     return output_svg_name
@@ -312,22 +338,8 @@ def extract_frame_dwi(fname,frame_nr):
     ======
     output: full path of file with extracted frame
     """
-    # Extracts frame from fname
-    output = fname.replace('.nii.gz','_%02i.nii.gz' % frame_nr)
-    if not os.path.exists(output):
-        extract = pe.Node(
-            fsl.ExtractROI(
-                in_file=fname,
-                t_min=frame_nr,
-                t_size=1,roi_file=output,
-                output_type="NIFTI_GZ"
-            ), 
-            name='extract_%02i' % frame_nr
-        )
-        extract.base_dir = os.path.dirname(fname)
-        extract.run()
-
-    return output
+    # In-process and cached, see frames.extract_frames
+    return frames.extract_frames(fname,[frame_nr])[0]
 
 def extract_mask_from_dwi(data,dwi_file):
     """
@@ -346,17 +358,17 @@ def extract_mask_from_dwi(data,dwi_file):
         path to mask that were created.
     """
     # Create mask from b0
-    b0_file = extract_frame_dwi(dwi_file,data['dwi'][0]['b0_idx'][0])
+    b0_file = extract_frame_dwi(dwi_file,data['gradients'].b0_idx[0])
 
-    out_brain = b0_file.replace('.nii.gz','_brain.nii.gz')
-    in_mask = out_brain.replace('.nii.gz','_mask.nii.gz')
+    out_brain = utils.add_nifti_suffix(b0_file,'_brain')
+    in_mask = utils.add_nifti_suffix(out_brain,'_mask')
     bet = pe.Node(
         fsl.BET(
             in_file=b0_file,
             mask=True,
             frac=0.3,
             out_file=out_brain,
-            output_type="NIFTI_GZ"
+            output_type=utils.get_output_type(out_brain)
         ),
         name='bet'
     )
@@ -365,7 +377,7 @@ def extract_mask_from_dwi(data,dwi_file):
 
     return in_mask
 
-def prepare_eddy(data,topup_options,phase_encoding_directions,output_dir):
+def prepare_eddy(data,topup_options,phase_encoding_directions,output_dir,topup_basename=None):
     """
     Prepare inputs for fsl eddy routine.
 
@@ -375,6 +387,8 @@ def prepare_eddy(data,topup_options,phase_encoding_directions,output_dir):
     topup_options: dict containing info on how to apply topup
     phase_encoding_directions: dict with phase encoding directions for data.
     output_dir: output destination of work files.
+    topup_basename: path prefix of the topup outputs. Defaults to
+        output_dir/topup/AP_PA.
 
     Outputs
     =======
@@ -396,39 +410,42 @@ def prepare_eddy(data,topup_options,phase_encoding_directions,output_dir):
     eddy_inputs = {}
 
     in_file = data['dwi'][0]['filename']
+    nifti_ext = data['nifti_ext']
+    output_type = utils.NIFTI_OUTPUT_TYPES[nifti_ext]
 
     if topup_options['do_topup']:
         # If we have done topup, we have the in_acqp file, as well as other inputs required by eddy
-        topup_basename = os.path.join(output_dir,"topup","AP_PA")
+        if topup_basename is None:
+            topup_basename = os.path.join(output_dir,"topup","AP_PA")
         eddy_inputs['in_acqp'] = topup_basename + '_encfile.txt'
-        eddy_inputs['in_topup_fieldcoef'] = topup_basename + "_base_fieldcoef.nii.gz"
-        eddy_inputs['in_topup_field'] = topup_basename + "_field.nii.gz"
+        eddy_inputs['in_topup_fieldcoef'] = topup_basename + "_base_fieldcoef" + nifti_ext
+        eddy_inputs['in_topup_field'] = topup_basename + "_field" + nifti_ext
         eddy_inputs['in_topup_movpar'] = topup_basename + "_base_movpar.txt"
-        eddy_inputs['in_topup_corrected'] = topup_basename + "_corrected.nii.gz"
+        eddy_inputs['in_topup_corrected'] = topup_basename + "_corrected" + nifti_ext
 
         # Make mask out of the corrected fmaps
-        in_mean_topup_corrected = eddy_inputs['in_topup_corrected'].replace("_corrected.nii.gz","_corrected_mean.nii.gz")
+        in_mean_topup_corrected = utils.add_nifti_suffix(eddy_inputs['in_topup_corrected'],"_mean")
         mean = pe.Node(
             fsl.maths.MathsCommand(
                 in_file=eddy_inputs['in_topup_corrected'],
                 args="-Tmean",
                 out_file=in_mean_topup_corrected,
-                output_type="NIFTI_GZ"
+                output_type=output_type
             ), 
             name='mean'
         )
         mean.base_dir = output_dir
         mean.run()
 
-        out_brain = in_mean_topup_corrected.replace("_mean.nii.gz","_mean_brain.nii.gz")
-        eddy_inputs['in_mask'] = out_brain.replace('_brain.nii.gz','_brain_mask.nii.gz')
+        out_brain = utils.add_nifti_suffix(in_mean_topup_corrected,"_brain")
+        eddy_inputs['in_mask'] = utils.add_nifti_suffix(out_brain,"_mask")
         bet = pe.Node(
             fsl.BET(
                 in_file=in_mean_topup_corrected,
                 mask=True,
                 frac=0.3, # Higher values can remove parts of brain.
                 out_file=out_brain,
-                output_type="NIFTI_GZ"
+                output_type=output_type
             ),
             name='bet'
         )
@@ -453,7 +470,7 @@ def prepare_eddy(data,topup_options,phase_encoding_directions,output_dir):
                 fsl.utils.CopyGeom(
                     in_file=data['b0_mask'],
                     dest_file=input_mean_topup_mask,
-                    output_type="NIFTI_GZ"
+                    output_type=output_type
                 ), 
                 name='copygeom'
             )
@@ -481,7 +498,7 @@ def prepare_eddy(data,topup_options,phase_encoding_directions,output_dir):
         # - mask from b0, instead of corrected fieldmaps
         eddy_inputs['in_mask'] = data['b0_mask']
         # Create acqp_file
-        eddy_inputs['in_acqp'] = in_file.replace('.nii.gz','_acq_param.txt')
+        eddy_inputs['in_acqp'] = utils.replace_nifti_ext(in_file,'_acq_param.txt')
 
         phase_encoding_direction = data['dwi'][0]['metadata']['PhaseEncodingDirection']
         total_readout_time = data['dwi'][0]['metadata']['TotalReadoutTime']
@@ -500,14 +517,8 @@ def prepare_eddy(data,topup_options,phase_encoding_directions,output_dir):
                 acqp_file.write("0 0 -1 "+str(total_readout_time)+"\n")
 
     # Make in_index file
-    eddy_inputs['in_index'] = in_file.replace('.nii.gz','_index.txt')
-    in_bval = data['in_bval']
-    with open(in_bval, 'r') as bval_file:
-        bvals = bval_file.read().strip().split(" ")
-
-    in_acqp_indeces = []
-    for bval in bvals:
-        in_acqp_indeces.append(str(in_acqp_idx))
+    eddy_inputs['in_index'] = utils.replace_nifti_ext(in_file,'_index.txt')
+    in_acqp_indeces = [str(in_acqp_idx)] * len(data['gradients'])
 
     with open(eddy_inputs['in_index'],'w') as index_file:
         index_file.write(" ".join(in_acqp_indeces)+"\n")
@@ -529,6 +540,8 @@ def run_eddy(eddy_inputs,topup_options,output_dir,n_cpus):
     eddy_work_dir: eddy work directory
     """
     name = '01_hmc'
+    # The outputs have the extension of the input
+    output_type = utils.get_output_type(eddy_inputs['in_file'])
 
     if topup_options['do_topup']:
         eddy = pe.Node(
@@ -544,7 +557,7 @@ def run_eddy(eddy_inputs,topup_options,output_dir,n_cpus):
                 cnr_maps = True,
                 repol = True,
                 num_threads = n_cpus,
-                output_type = "NIFTI_GZ"
+                output_type = output_type
             ),
             name=name
         )
@@ -562,18 +575,33 @@ def run_eddy(eddy_inputs,topup_options,output_dir,n_cpus):
                 cnr_maps = True,
                 repol = True,
                 num_threads = n_cpus,
-                output_type = "NIFTI_GZ"
+                output_type = output_type
             ),
             name=name
         )
         eddy.base_dir = output_dir
         eddy.run()
 
-    # Run EddyQuad
-    output_quad = os.path.join(output_dir,name,'qc')
+    return os.path.join(output_dir,name)
+
+def run_eddy_quad(eddy_inputs,topup_options,eddy_output_dir):
+    """
+    Run eddy_quad on the eddy outputs.
+
+    Inputs
+    ======
+    eddy_inputs: dict with inputs to eddy.
+    topup_options: dict containing info on how to apply topup
+    eddy_output_dir: eddy work directory.
+
+    Outputs
+    =======
+    output_quad: eddy_quad output directory
+    """
+    output_quad = os.path.join(eddy_output_dir,'qc')
     if not os.path.exists(output_quad):
         quad = fsl.EddyQuad()
-        quad.inputs.base_name  = os.path.join(output_dir,name,'eddy_corrected')
+        quad.inputs.base_name  = os.path.join(eddy_output_dir,'eddy_corrected')
         quad.inputs.idx_file   = eddy_inputs['in_index']
         quad.inputs.param_file = eddy_inputs['in_acqp']
         quad.inputs.mask_file  = eddy_inputs['in_mask']
@@ -584,28 +612,33 @@ def run_eddy(eddy_inputs,topup_options,output_dir,n_cpus):
             quad.inputs.field  = eddy_inputs['in_topup_field']
         quad.inputs.verbose    = True
         res = quad.run()
-    return os.path.join(output_dir,name)
+    return output_quad
 
-def run_n4biasfieldcorrection(data,output_dir):
+def run_n4biasfieldcorrection(data,output_dir,compresslevel=6,n_cpus=1):
     """
     Run ants biasfieldcorrection.
 
     This method estimates the bias field correction on one b0 image,
-    then applies it on the full sequence by division using fslmaths.
+    then applies it on the full sequence by division, in-process (see
+    biasfield.apply_bias_field).
 
     Inputs
     ======
-    in_file: input dwi sequence to correct. Must contain a b0 volume
+    data: dict with information about the data. The dwi sequence to correct
+        must contain a b0 volume.
     output_dir: work directory for nipype
+    compresslevel: gzip compression level of the corrected dwi file
+        (--compression_level), which is exported as the preprocessed dwi.
+    n_cpus: number of cpus
 
     Outputs
     =======
-    dtifit_work_dir: eddy work directory
+    data: updated dict with the bias field corrected dwi file.
     """
 
     # Generate bias field
-    dwi_b0 = extract_frame_dwi(data['dwi'][0]['filename'],data['dwi'][0]['b0_idx'][0])
-    bias_field_output = "bias_field_b0.nii.gz"
+    dwi_b0 = extract_frame_dwi(data['dwi'][0]['filename'],data['gradients'].b0_idx[0])
+    bias_field_output = "bias_field_b0" + utils.split_nifti_ext(dwi_b0)[1]
 
     name_n4bias = '02_n4biasfieldcorrection'
     # Run dtifit on output
@@ -614,46 +647,25 @@ def run_n4biasfieldcorrection(data,output_dir):
             input_image = dwi_b0,
             save_bias = True,
             copy_header = False,
-            bias_image = bias_field_output
+            bias_image = bias_field_output,
+            num_threads = n_cpus
         ),
         name=name_n4bias
     )
     n4bias.base_dir = output_dir
     n4bias.run()
 
-    # Apply bias field on dwi sequence by division using fslmaths
-    name_apply_field = 'apply_bias_field'
-    out_bias = data['dwi'][0]['filename'].replace('.nii.gz','_bias_corrected.nii.gz')
+    # Apply bias field on dwi sequence by division, one volume at a time.
+    # The frames of the qc plot are written in the same pass.
+    out_bias = utils.add_nifti_suffix(data['dwi'][0]['filename'],'_bias_corrected')
     base_dir = os.path.join(output_dir,name_n4bias)
-
-    apply_field = pe.Node(
-        fsl.maths.BinaryMaths(
-            in_file = data['dwi'][0]['filename'],
-            operation = 'div',
-            operand_file = os.path.join(base_dir,bias_field_output),
-            out_file = out_bias,
-            output_type = "NIFTI_GZ"
-        ),
-        name=name_apply_field
-    )
-    apply_field.base_dir = base_dir
-    apply_field.run()
-
-    # Produce qc figures
-    output_svg_basename = out_bias.replace('.nii.gz','')
-    # Extract high and low b0 value for qc report
-    dwi_b_low = extract_frame_dwi(data['dwi'][0]['filename'],data['dwi'][0]['b0_idx'][0])
-    dwi_b_high = extract_frame_dwi(data['dwi'][0]['filename'],data['dwi'][0]['bhigh_idx'][0])
-    dwi_denoise_b_low = extract_frame_dwi(out_bias,data['dwi'][0]['b0_idx'][0])
-    dwi_denoise_b_high = extract_frame_dwi(out_bias,data['dwi'][0]['bhigh_idx'][0])
-
-    output_svg = [output_svg_basename + '_lowb.svg',output_svg_basename + '_highb.svg']
-    plot_before_after_svg(dwi_b_low,dwi_denoise_b_low,data['b0_mask'],output_svg[0])
-    plot_before_after_svg(dwi_b_high,dwi_denoise_b_high,data['b0_mask'],output_svg[1])
+    qc_frames = [data['gradients'].b0_idx[0],data['gradients'].bhigh_idx[0]]
+    biasfield.apply_bias_field(data['dwi'][0]['filename'], os.path.join(base_dir,bias_field_output),
+                               out_bias, frame_nrs=qc_frames, compresslevel=compresslevel, n_threads=n_cpus)
 
     data['dwi'][0]['filename'] = out_bias
 
-    return output_svg
+    return data
 
 def run_dtifit(in_file,in_bval,in_bvec,in_mask,output_dir):
     """
@@ -679,7 +691,7 @@ def run_dtifit(in_file,in_bval,in_bvec,in_mask,output_dir):
             bvals = in_bval,
             bvecs = in_bvec,
             mask = in_mask,
-            output_type = "NIFTI_GZ"
+            output_type = utils.get_output_type(in_file)
         ),
         name=name
     )
@@ -688,30 +700,549 @@ def run_dtifit(in_file,in_bval,in_bvec,in_mask,output_dir):
 
     return os.path.join(output_dir,name)
 
-def run_rd(dtifit_output_dir):
+def run_rd(dtifit_output_dir, compresslevel=6, n_cpus=1):
     """
-    Calculate radial diffusitivity (RD). 
-    RD = (L2 + L3) / 2.
+    Calculate radial diffusitivity (RD), RD = (L2 + L3) / 2, and axial
+    diffusivity (AD), AD = L1, in-process (see dtiscalars.compute_scalars).
 
     Outputs to the same directory as dtifit.
 
     Inputs
     ======
     dtifit_output_dir: output directory of FSLs dtifit
+    compresslevel: gzip compression level of the maps (--compression_level),
+        which are exported as they are.
+    n_cpus: number of cpus, shared by the maps
+
+    Outputs
+    =======
+    output_files: dict with the path of each map, recorded in the
+        checkpoint of the stage.
     """
-    l2_file = glob.glob(os.path.join(dtifit_output_dir,"*L2*.nii.gz"))[0]
-    l3_file = glob.glob(os.path.join(dtifit_output_dir,"*L3*.nii.gz"))[0]
-    output_file = l2_file.replace("L2","RD")
-
-    fsl_rd = pe.Node(
-        fsl.MultiImageMaths(
-            in_file=l2_file,
-            op_string="-add %s -div 2",
-            operand_files=l3_file,
-            out_file=output_file,
-            output_type="NIFTI_GZ"
-        ), 
-        name='fslmaths'
+    l1_file = utils.glob_nifti(os.path.join(dtifit_output_dir,"*L1*"))[0]
+    n_threads = max(1, n_cpus // len(dtiscalars.PIPELINE_SCALARS))
+    return dtiscalars.compute_scalars(l1_file, dtiscalars.PIPELINE_SCALARS, compresslevel, n_threads)
+
+def init_dmri_preprocessing_wf(data, data_raw, topup_options, phase_encoding_directions,
+                               denoise_filter_length, cpu_budget, subject_work_dir,
+                               derivatives_dir, application_name):
+    """
+    Connect all processing steps of one session into a nipype workflow.
+
+    Steps which do not depend on each other, e.g. topup on fieldmaps and
+    denoising of the dwi, or qc plots and the next processing step, can
+    then run in parallel.
+
+    Inputs
+    ======
+    data: dict with information about the data we are going to process.
+    data_raw: dict with information about all data and the processing.
+    topup_options: dict containing info on how to apply topup
+    phase_encoding_directions: dict with phase encoding directions for data.
+    denoise_filter_length: tuple with 3 ints, e.g: (7,7,7)
+    cpu_budget: path to cpu budget file, which all stages take their
+        threads from (see scheduler.py).
+    subject_work_dir: work directory for this subject and session.
+    derivatives_dir: path to data_out dir that user specified.
+    application_name: name of the app
+
+    Outputs
+    =======
+    wf: nipype workflow
+    """
+    pre_hmc_dir = os.path.join(subject_work_dir,'00_pre_hmc')
+    os.makedirs(pre_hmc_dir,exist_ok=True)
+    telemetry_dir = os.path.join(subject_work_dir,'telemetry')
+
+    wf = pe.Workflow(name='dmri_preprocessing_wf', base_dir=subject_work_dir)
+    wf.config['execution']['crashdump_dir'] = os.path.join(subject_work_dir,'crash')
+
+    # 00_pre_hmc, here we will make the following:
+    # - input dwi: sub-id_ses-id_dwi.nii.gz (or .nii)
+    # - input bvals and bvecs: sub-id_ses-id_dwi.[bvec,bval]
+    # - All input needed for head motion correcton (hmc)
+    gather = pe.Node(
+        niu.Function(
+            function=_gather_inputs,
+            input_names=['data','subject','session','output_dir','stage'],
+            output_names=['data']
+        ),
+        name='gather_inputs'
+    )
+    gather.inputs.data = data
+    gather.inputs.subject = data_raw['subject']
+    gather.inputs.session = data_raw['session']
+    gather.inputs.output_dir = pre_hmc_dir
+
+    # mrtrix3 dwidenoise
+    dwidenoise = pe.Node(
+        niu.Function(
+            function=_dwidenoise,
+            input_names=['data','denoise_filter_length','output_dir','stage'],
+            output_names=['data']
+        ),
+        name='dwidenoise'
+    )
+    dwidenoise.inputs.denoise_filter_length = denoise_filter_length
+    dwidenoise.inputs.output_dir = pre_hmc_dir
+
+    plot_dwidenoise = pe.Node(
+        niu.Function(
+            function=_plot_dwidenoise,
+            input_names=['in_data','data','stage'],
+            output_names=['figures']
+        ),
+        name='plot_dwidenoise'
+    )
+
+    wf.connect([
+        (gather, dwidenoise, [('data','data')]),
+        (gather, plot_dwidenoise, [('data','in_data')]),
+        (dwidenoise, plot_dwidenoise, [('data','data')]),
+    ])
+    figure_nodes = [plot_dwidenoise]
+    last_dwi_node = dwidenoise
+
+    # mrtrix3 mrdegibbs
+    # Only run mrdegibbs if we have acquired full k-space data:
+    try:
+        partial_fourier = data['dwi'][0]['metadata']['PartialFourier']
+    except:
+        partial_fourier = None
+        print(f"metadata 'PartialFourier' does not exist in .json. Because of \
+        incomplete information we are not running mrdegibbs.")
+
+    if partial_fourier == 1:
+        mrdegibbs = pe.Node(
+            niu.Function(
+                function=_mrdegibbs,
+                input_names=['data','output_dir','stage'],
+                output_names=['data']
+            ),
+            name='mrdegibbs'
+        )
+        mrdegibbs.inputs.output_dir = pre_hmc_dir
+
+        plot_mrdegibbs = pe.Node(
+            niu.Function(
+                function=_plot_mrdegibbs,
+                input_names=['in_data','data','stage'],
+                output_names=['figures']
+            ),
+            name='plot_mrdegibbs'
+        )
+
+        wf.connect([
+            (dwidenoise, mrdegibbs, [('data','data')]),
+            (dwidenoise, plot_mrdegibbs, [('data','in_data')]),
+            (mrdegibbs, plot_mrdegibbs, [('data','data')]),
+        ])
+        figure_nodes.append(plot_mrdegibbs)
+        last_dwi_node = mrdegibbs
+
+    # eddy
+    prepare_eddy = pe.Node(
+        niu.Function(
+            function=_prepare_eddy,
+            input_names=['data','topup_options','phase_encoding_directions','output_dir','stage','topup_basename'],
+            output_names=['eddy_inputs']
+        ),
+        name='prepare_eddy'
+    )
+    prepare_eddy.inputs.topup_options = topup_options
+    prepare_eddy.inputs.phase_encoding_directions = phase_encoding_directions
+    prepare_eddy.inputs.output_dir = pre_hmc_dir
+    wf.connect(last_dwi_node, 'data', prepare_eddy, 'data')
+
+    # topup
+    if topup_options['do_topup']:
+        topup = pe.Node(
+            niu.Function(
+                function=_topup,
+                input_names=['data','topup_options','output_dir','stage'],
+                output_names=['topup_basename','in_file']
+            ),
+            name='topup'
+        )
+        topup.inputs.topup_options = topup_options
+        topup.inputs.output_dir = pre_hmc_dir
+
+        plot_topup = pe.Node(
+            niu.Function(
+                function=_plot_topup,
+                input_names=['data','stage','topup_basename','in_file'],
+                output_names=['figure']
+            ),
+            name='plot_topup'
+        )
+
+        # Only the combined dwi and fmap branch needs the preprocessed dwi,
+        # the other branches can run in parallel with denoising.
+        if (not topup_options['only_sbref'] and not topup_options['only_fmap']
+            and topup_options['dwi_fmap_combined']):
+            wf.connect(last_dwi_node, 'data', topup, 'data')
+        else:
+            wf.connect(gather, 'data', topup, 'data')
+
+        wf.connect([
+            (gather, plot_topup, [('data','data')]),
+            (topup, plot_topup, [('topup_basename','topup_basename'),
+                                 ('in_file','in_file')]),
+            (topup, prepare_eddy, [('topup_basename','topup_basename')]),
+        ])
+        figure_nodes.append(plot_topup)
+
+    eddy = pe.Node(
+        niu.Function(
+            function=_eddy,
+            input_names=['data','eddy_inputs','topup_options','output_dir','stage'],
+            output_names=['data','eddy_output_dir']
+        ),
+        name='eddy'
+    )
+    eddy.inputs.topup_options = topup_options
+    eddy.inputs.output_dir = subject_work_dir
+
+    eddy_quad = pe.Node(
+        niu.Function(
+            function=_eddy_quad,
+            input_names=['eddy_inputs','topup_options','eddy_output_dir','stage'],
+            output_names=['eddy_quad_dir']
+        ),
+        name='eddy_quad'
+    )
+    eddy_quad.inputs.topup_options = topup_options
+
+    wf.connect([
+        (last_dwi_node, eddy, [('data','data')]),
+        (prepare_eddy, eddy, [('eddy_inputs','eddy_inputs')]),
+        (prepare_eddy, eddy_quad, [('eddy_inputs','eddy_inputs')]),
+        (eddy, eddy_quad, [('eddy_output_dir','eddy_output_dir')]),
+    ])
+
+    # N4biasfield correction!
+    n4biasfieldcorrection = pe.Node(
+        niu.Function(
+            function=_n4biasfieldcorrection,
+            input_names=['data','output_dir','stage'],
+            output_names=['data']
+        ),
+        name='n4biasfieldcorrection'
+    )
+    n4biasfieldcorrection.inputs.output_dir = subject_work_dir
+
+    plot_n4biasfieldcorrection = pe.Node(
+        niu.Function(
+            function=_plot_n4biasfieldcorrection,
+            input_names=['in_data','data','stage'],
+            output_names=['figures']
+        ),
+        name='plot_n4biasfieldcorrection'
+    )
+    figure_nodes.append(plot_n4biasfieldcorrection)
+
+    # dtifit and radial diffusitivity
+    dtifit = pe.Node(
+        niu.Function(
+            function=_dtifit,
+            input_names=['data','eddy_output_dir','eddy_inputs','output_dir','stage'],
+            output_names=['dtifit_output_dir']
+        ),
+        name='dtifit'
+    )
+    dtifit.inputs.output_dir = subject_work_dir
+
+    rd = pe.Node(
+        niu.Function(
+            function=_rd,
+            input_names=['dtifit_output_dir','stage'],
+            output_names=['dtifit_output_dir']
+        ),
+        name='rd'
+    )
+
+    wf.connect([
+        (eddy, n4biasfieldcorrection, [('data','data')]),
+        (eddy, plot_n4biasfieldcorrection, [('data','in_data')]),
+        (n4biasfieldcorrection, plot_n4biasfieldcorrection, [('data','data')]),
+        (n4biasfieldcorrection, dtifit, [('data','data')]),
+        (eddy, dtifit, [('eddy_output_dir','eddy_output_dir')]),
+        (prepare_eddy, dtifit, [('eddy_inputs','eddy_inputs')]),
+        (dtifit, rd, [('dtifit_output_dir','dtifit_output_dir')]),
+    ])
+
+    # Outputs to derivatives directory and report
+    merge_figures = pe.Node(niu.Merge(len(figure_nodes)), name='merge_figures')
+    for i, figure_node in enumerate(figure_nodes):
+        figure_output = 'figure' if figure_node.name == 'plot_topup' else 'figures'
+        wf.connect(figure_node, figure_output, merge_figures, 'in%d' % (i+1))
+
+    derivatives = pe.Node(
+        niu.Function(
+            function=_to_derivatives,
+            input_names=['data','data_raw','derivatives_dir','application_name',
+                         'eddy_output_dir','dtifit_dir','eddy_input','figures','eddy_quad_dir','stage'],
+            output_names=['output_dir_session']
+        ),
+        name='to_derivatives'
+    )
+    derivatives.inputs.data_raw = data_raw
+    derivatives.inputs.derivatives_dir = derivatives_dir
+    derivatives.inputs.application_name = application_name
+
+    report = pe.Node(
+        niu.Function(
+            function=_create_report,
+            input_names=['data','data_raw','derivatives_dir','application_name','output_dir_session'],
+            output_names=['report']
+        ),
+        name='create_report'
     )
-    fsl_rd.base_dir = dtifit_output_dir
-    fsl_rd.run()
\ No newline at end of file
+    report.inputs.data_raw = data_raw
+    report.inputs.derivatives_dir = derivatives_dir
+    report.inputs.application_name = application_name
+
+    wf.connect([
+        (n4biasfieldcorrection, derivatives, [('data','data')]),
+        (eddy, derivatives, [('eddy_output_dir','eddy_output_dir')]),
+        (rd, derivatives, [('dtifit_output_dir','dtifit_dir')]),
+        (prepare_eddy, derivatives, [('eddy_inputs','eddy_input')]),
+        (merge_figures, derivatives, [('out','figures')]),
+        (eddy_quad, derivatives, [('eddy_quad_dir','eddy_quad_dir')]),
+        (n4biasfieldcorrection, report, [('data','data')]),
+        (derivatives, report, [('output_dir_session','output_dir_session')]),
+    ])
+
+    # Options and tool versions that each stage depends on. Together with
+    # the input files, they make up the checkpoint key of the stage.
+    fsl_version = data_raw['fsl_version']
+    mrtrix3_version = data_raw['mrtrix3_version']
+    stage_params = {
+        'gather_inputs': {'b0_threshold': data_raw['b0_threshold'], 'fsl_version': fsl_version},
+        'dwidenoise': {'denoise_filter_length': denoise_filter_length, 'mrtrix3_version': mrtrix3_version},
+        'plot_dwidenoise': {'b0_threshold': data_raw['b0_threshold']},
+        'mrdegibbs': {'mrtrix3_version': mrtrix3_version},
+        'plot_mrdegibbs': {'b0_threshold': data_raw['b0_threshold']},
+        'topup': {'topup_options': topup_options, 'fsl_version': fsl_version},
+        'plot_topup': {},
+        'prepare_eddy': {
+            'topup_options': topup_options,
+            'phase_encoding_directions': phase_encoding_directions,
+            'fsl_version': fsl_version
+        },
+        'eddy': {'topup_options': topup_options, 'fsl_version': fsl_version},
+        'eddy_quad': {'fsl_version': fsl_version},
+        'n4biasfieldcorrection': {
+            'ants_version': data_raw['ants_version'],
+            'fsl_version': fsl_version,
+            'compression_level': data_raw['compression_level']
+        },
+        'plot_n4biasfieldcorrection': {'b0_threshold': data_raw['b0_threshold']},
+        'dtifit': {'fsl_version': fsl_version},
+        'rd': {'scalars': dtiscalars.PIPELINE_SCALARS, 'compression_level': data_raw['compression_level']},
+        'to_derivatives': {
+            'derivatives_dir': os.path.abspath(derivatives_dir),
+            'application_name': application_name,
+            'compression_level': data_raw['compression_level'],
+            'zarr_derivatives': data_raw['zarr_derivatives']
+        },
+    }
+    checkpoint_dir = os.path.join(subject_work_dir,'checkpoints')
+    # Paths in the checkpoints are saved relative to these directories
+    roots = {
+        'WORK_DIR': subject_work_dir,
+        'BIDS_DIR': data_raw['bids_dir'],
+        'OUTPUT_DIR': derivatives_dir
+    }
+    # Intermediates are deleted when the stages getting them are done
+    # (see cleanup.release). The reference counts start over every run.
+    gc_mode = data_raw['gc_work_dir']
+    if gc_mode != 'off':
+        consumers = cleanup.get_consumers(wf._create_flat_graph(), stage_params)
+        refcount_file = os.path.join(subject_work_dir,'gc_refcounts.json')
+        if os.path.exists(refcount_file):
+            os.remove(refcount_file)
+    for name in stage_params:
+        node = wf.get_node(name)
+        if node is None:
+            continue
+        stage_params[name]['application_version'] = data_raw['application_version']
+        stage_params[name]['nifti_ext'] = data_raw['nifti_ext']
+        node.inputs.stage = {
+            'name': name,
+            'checkpoint_dir': checkpoint_dir,
+            'params': stage_params[name],
+            'cpu_budget': cpu_budget,
+            'telemetry_dir': telemetry_dir,
+            'roots': roots,
+            'gc': None
+        }
+        if gc_mode != 'off':
+            node.inputs.stage['gc'] = {
+                'mode': gc_mode,
+                'refcount_file': refcount_file,
+                'consumers': consumers[name]
+            }
+        # The checkpoint decides if the stage is run, not the nipype cache
+        node.overwrite = True
+
+    return wf
+
+# The functions below are run by nipype Function nodes, which only get the
+# source code of the function. Imports must therefore be done inside them.
+# Each processing stage is run through stages.run_stage, which skips the
+# stage if it has been run before with the same inputs and parameters, and
+# returns everything it passes on through stages.release_outputs.
+
+def _gather_inputs(data, subject, session, output_dir, stage):
+    from dmri_preprocessing import stages, utils, workflows
+    input_files = []
+    for dwi in data['dwi']:
+        input_files.extend([
+            dwi['filename'],
+            utils.replace_nifti_ext(dwi['filename'],'.bval'),
+            utils.replace_nifti_ext(dwi['filename'],'.bvec')
+        ])
+    data = stages.run_stage(stage, input_files,
+        workflows.gather_inputs, data, subject, session, output_dir)
+    return stages.release_outputs(stage, data)
+
+def _dwidenoise(data, denoise_filter_length, output_dir, stage):
+    from dmri_preprocessing import stages, workflows
+    data = stages.run_stage(stage, [data['dwi'][0]['filename']],
+        workflows.run_dwidenoise, data, denoise_filter_length, output_dir=output_dir)
+    return stages.release_outputs(stage, data)
+
+def _plot_dwidenoise(in_data, data, stage):
+    from dmri_preprocessing import stages, utils, workflows
+    in_file = in_data['dwi'][0]['filename']
+    out_file = data['dwi'][0]['filename']
+    output_svg_basename = utils.split_nifti_ext(out_file)[0]
+    figures = stages.run_stage(stage, [in_file, out_file, data['b0_mask']],
+        workflows.plot_before_after_frames, in_file, out_file, data, output_svg_basename)
+    return stages.release_outputs(stage, figures)
+
+def _mrdegibbs(data, output_dir, stage):
+    from dmri_preprocessing import stages, workflows
+    data = stages.run_stage(stage, [data['dwi'][0]['filename']],
+        workflows.run_mrdegibbs, data, output_dir=output_dir)
+    return stages.release_outputs(stage, data)
+
+def _plot_mrdegibbs(in_data, data, stage):
+    from dmri_preprocessing import stages, utils, workflows
+    in_file = in_data['dwi'][0]['filename']
+    out_file = data['dwi'][0]['filename']
+    output_svg_basename = utils.split_nifti_ext(out_file)[0].replace('_denoised','')
+    figures = stages.run_stage(stage, [in_file, out_file, data['b0_mask']],
+        workflows.plot_before_after_frames, in_file, out_file, data, output_svg_basename)
+    return stages.release_outputs(stage, figures)
+
+def _topup(data, topup_options, output_dir, stage):
+    import os
+    from dmri_preprocessing import stages, workflows
+    input_files = [data['dwi'][0]['filename']]
+    input_files.extend([fmap['filename'] for fmap in data['fmap']])
+    input_files.extend([sbref['filename'] for sbref in data['sbref']])
+    topup_basename, in_file = stages.run_stage(stage, input_files,
+        workflows.run_topup, data, topup_options, output_dir)
+    # topup_basename is the prefix of the files in the topup folder
+    stages.release_outputs(stage, (os.path.dirname(topup_basename), in_file))
+    return topup_basename, in_file
+
+def _plot_topup(data, topup_basename, in_file, stage):
+    from dmri_preprocessing import stages, workflows
+    figure = stages.run_stage(stage, [in_file, topup_basename + '_corrected' + data['nifti_ext'], data['b0_mask']],
+        workflows.plot_topup, data, topup_basename, in_file)
+    return stages.release_outputs(stage, figure)
+
+def _prepare_eddy(data, topup_options, phase_encoding_directions, output_dir, stage, topup_basename=None):
+    from dmri_preprocessing import stages, workflows
+    input_files = [data['dwi'][0]['filename'], data['in_bval'], data['b0_mask']]
+    if topup_basename is not None:
+        input_files.append(topup_basename + '_corrected' + data['nifti_ext'])
+    eddy_inputs = stages.run_stage(stage, input_files,
+        workflows.prepare_eddy, data, topup_options, phase_encoding_directions, output_dir, topup_basename)
+    eddy_inputs['in_file'] = data['dwi'][0]['filename']
+    eddy_inputs['in_bval'] = data['in_bval']
+    eddy_inputs['in_bvec'] = data['in_bvec']
+    return stages.release_outputs(stage, eddy_inputs)
+
+def _eddy(data, eddy_inputs, topup_options, output_dir, stage):
+    import os
+    from dmri_preprocessing import stages, workflows
+    input_files = [eddy_inputs[name] for name in sorted(eddy_inputs) if name != 'in_topup_field']
+    eddy_output_dir = stages.run_stage(stage, input_files,
+        workflows.run_eddy, eddy_inputs, topup_options, output_dir)
+    data['dwi'][0]['filename'] = os.path.join(eddy_output_dir,'eddy_corrected' + data['nifti_ext'])
+    return stages.release_outputs(stage, (data, eddy_output_dir))
+
+def _eddy_quad(eddy_inputs, topup_options, eddy_output_dir, stage):
+    import os
+    from dmri_preprocessing import stages, utils, workflows
+    nifti_ext = utils.split_nifti_ext(eddy_inputs['in_file'])[1]
+    input_files = [os.path.join(eddy_output_dir,'eddy_corrected' + nifti_ext)]
+    input_files.extend([eddy_inputs[name] for name in sorted(eddy_inputs)])
+    eddy_quad_dir = stages.run_stage(stage, input_files,
+        workflows.run_eddy_quad, eddy_inputs, topup_options, eddy_output_dir)
+    return stages.release_outputs(stage, eddy_quad_dir)
+
+def _n4biasfieldcorrection(data, output_dir, stage):
+    from dmri_preprocessing import stages, workflows
+    data = stages.run_stage(stage, [data['dwi'][0]['filename']],
+        workflows.run_n4biasfieldcorrection, data, output_dir=output_dir,
+        compresslevel=stage['params']['compression_level'])
+    return stages.release_outputs(stage, data)
+
+def _plot_n4biasfieldcorrection(in_data, data, stage):
+    from dmri_preprocessing import stages, utils, workflows
+    in_file = in_data['dwi'][0]['filename']
+    out_file = data['dwi'][0]['filename']
+    output_svg_basename = utils.split_nifti_ext(out_file)[0]
+    figures = stages.run_stage(stage, [in_file, out_file, data['b0_mask']],
+        workflows.plot_before_after_frames, in_file, out_file, data, output_svg_basename)
+    return stages.release_outputs(stage, figures)
+
+def _dtifit(data, eddy_output_dir, eddy_inputs, output_dir, stage):
+    import os
+    from dmri_preprocessing import stages, workflows
+    rotated_bvec = os.path.join(eddy_output_dir,"eddy_corrected.eddy_rotated_bvecs")
+    input_files = [data['dwi'][0]['filename'], data['in_bval'], rotated_bvec, eddy_inputs['in_mask']]
+    dtifit_output_dir = stages.run_stage(stage, input_files,
+        workflows.run_dtifit, data['dwi'][0]['filename'], data['in_bval'], rotated_bvec, eddy_inputs['in_mask'], output_dir)
+    return stages.release_outputs(stage, dtifit_output_dir)
+
+def _rd(dtifit_output_dir, stage):
+    import os
+    from dmri_preprocessing import stages, utils, workflows
+    input_files = utils.glob_nifti(os.path.join(dtifit_output_dir,"dtifit_*L[123]"))
+    stages.run_stage(stage, input_files, workflows.run_rd, dtifit_output_dir,
+        compresslevel=stage['params']['compression_level'])
+    return stages.release_outputs(stage, dtifit_output_dir)
+
+def _to_derivatives(data, data_raw, derivatives_dir, application_name, eddy_output_dir, dtifit_dir, eddy_input, figures, eddy_quad_dir, stage):
+    import os
+    import glob
+    from dmri_preprocessing import stages, utils, outputs
+    input_files = [data['dwi'][0]['filename'], eddy_input['in_bval'], eddy_input['in_mask'], eddy_quad_dir]
+    input_files.extend(sorted(glob.glob(os.path.join(eddy_output_dir,'eddy_corrected.*'))))
+    input_files.extend(utils.glob_nifti(os.path.join(dtifit_dir,"dtifit_*")))
+    input_files.extend(figures)
+    print("Output results to derivatives directory")
+    output_dir_session = stages.run_stage(stage, input_files,
+        outputs.to_derivatives, data, data_raw, derivatives_dir, application_name, eddy_output_dir, dtifit_dir, eddy_input, figures,
+        eddy_quad_dir)
+    # After the stage, so the export is measured in the runtime files too
+    if stage.get('telemetry_dir') is not None:
+        outputs.write_runtime(stage['telemetry_dir'], output_dir_session, data_raw)
+    return stages.release_outputs(stage, output_dir_session)
+
+def _create_report(data, data_raw, derivatives_dir, application_name, output_dir_session):
+    # Created after the derivatives are in place, with the runtime files
+    # written with them
+    import os
+    from dmri_preprocessing import outputs
+    from dmri_preprocessing.report import reports
+    runtime_file = outputs.get_runtime_basename(output_dir_session, data_raw) + 'runtime.tsv'
+    if not os.path.exists(runtime_file):
+        runtime_file = None
+    return reports.create_report(data, data_raw, derivatives_dir, application_name, runtime_file)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# Purpose: Write derivatives as chunked Zarr (v2) arrays, for reading single volumes or regions
+
+import os
+import json
+import zlib
+import shutil
+import itertools
+
+import numpy as np
+
+# Voxels along each spatial dimension of a chunk. With one volume per
+# chunk, a float32 chunk is 1 MB.
+CHUNK_SIZE = 64
+
+def get_chunks(shape, chunk_size=CHUNK_SIZE):
+    """
+    Chunk shape of an image: blocks of chunk_size voxels in space, and one
+    volume along time, so reading a volume or a slab only decompresses
+    the chunks it overlaps.
+    """
+    chunks = [min(chunk_size, dim) for dim in shape[:3]]
+    return tuple(chunks + [1] * (len(shape) - 3))
+
+def get_chunk_key(chunk_index):
+    return '.'.join([str(index) for index in chunk_index])
+
+def write_metadata(store_dir, shape, chunks, dtype, compresslevel, attributes):
+    """
+    Write the array metadata (.zarray) and the attributes (.zattrs) of a
+    Zarr v2 store, readable with zarr.open(store_dir).
+    """
+    zarray = {
+        'zarr_format': 2,
+        'shape': list(shape),
+        'chunks': list(chunks),
+        'dtype': dtype.str,
+        'compressor': {'id': 'zlib', 'level': compresslevel},
+        'fill_value': 0,
+        'order': 'C',
+        'filters': None
+    }
+    with open(os.path.join(store_dir,'.zarray'),'w') as f:
+        f.write(json.dumps(zarray, sort_keys=True, indent=4, separators=(',', ': ')))
+    with open(os.path.join(store_dir,'.zattrs'),'w') as f:
+        f.write(json.dumps(attributes, sort_keys=True, indent=4, separators=(',', ': '), default=str))
+
+def compress_chunk(block, chunks, compresslevel):
+    """
+    Compress one chunk. Chunks at the edge of the array are padded to
+    the full chunk shape, as Zarr stores them. Chunks with only zeros are
+    not stored, they are read as the fill value.
+    """
+    if not np.any(block):
+        return None
+    if block.shape != chunks:
+        padded = np.zeros(chunks, dtype=block.dtype)
+        padded[tuple([slice(0, dim) for dim in block.shape])] = block
+        block = padded
+    return zlib.compress(np.ascontiguousarray(block).tobytes(), compresslevel)
+
+def write_zarr(in_file, store_dir, attributes=None, compresslevel=6, n_threads=1, chunk_size=CHUNK_SIZE):
+    """
+    Write a NIfTI image as a Zarr v2 array, one volume at a time, so only
+    one volume is in memory.
+
+    The voxels are stored with the data type of the image when it is not
+    scaled, else as float32. The affine and the given attributes (e.g.
+    gradients and sidecar metadata) are stored in .zattrs. The chunks of
+    a volume are compressed with zlib in n_threads threads.
+
+    The array is written to a new folder next to store_dir, and swapped
+    in when it is complete (see staging.swap_tree), so an existing store
+    is replaced whole, without chunks left over from it.
+
+    Input
+    =====
+    in_file: path to 3D or 4D image (.nii or .nii.gz).
+    store_dir: path to output folder, e.g. *_dwi.zarr.
+    attributes: dict with metadata to store with the array, or None.
+    compresslevel: zlib compression level of the chunks.
+    n_threads: number of threads compressing the chunks.
+    chunk_size: voxels along each spatial dimension of a chunk.
+
+    Output
+    ======
+    store_dir: path to output folder.
+    """
+    import nibabel as nib
+    from concurrent.futures import ThreadPoolExecutor
+    from dmri_preprocessing import staging
+
+    img = nib.load(in_file, keep_file_open=True)
+    shape = img.shape
+    dtype = img.get_data_dtype()
+    scaled = hasattr(img.dataobj, 'slope') and (img.dataobj.slope, img.dataobj.inter) != (1.0, 0.0)
+    if scaled or dtype.kind not in 'iuf':
+        dtype = np.dtype(np.float32)
+    dtype = dtype.newbyteorder('<')
+    chunks = get_chunks(shape, chunk_size)
+
+    if attributes is None:
+        attributes = {}
+    attributes = dict(attributes)
+    attributes['affine'] = img.affine.tolist()
+    # Dimension names, as read by xarray
+    attributes['_ARRAY_DIMENSIONS'] = ['x', 'y', 'z', 'volume'][:len(shape)]
+
+    tmp_store_dir = store_dir + '.tmp%d' % os.getpid()
+    if os.path.exists(tmp_store_dir):
+        shutil.rmtree(tmp_store_dir)
+    os.makedirs(tmp_store_dir)
+    try:
+        write_metadata(tmp_store_dir, shape, chunks, dtype, compresslevel, attributes)
+
+        n_volumes = shape[3] if len(shape) > 3 else 1
+        spatial_chunks = list(itertools.product(*[range(-(-dim // chunk)) for dim, chunk in zip(shape[:3], chunks[:3])]))
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            for volume in range(n_volumes):
+                data = img.dataobj[..., volume] if len(shape) > 3 else img.dataobj[...]
+                data = np.asarray(data, dtype=dtype)
+                blocks = [
+                    data[tuple([slice(index * chunk, (index + 1) * chunk) for index, chunk in zip(chunk_index, chunks)])]
+                    for chunk_index in spatial_chunks
+                ]
+                # zlib releases the GIL, so the chunks are compressed in parallel
+                compressed = executor.map(lambda block: compress_chunk(block, chunks[:3], compresslevel), blocks)
+                for chunk_index, chunk_bytes in zip(spatial_chunks, compressed):
+                    if chunk_bytes is None:
+                        continue
+                    key = get_chunk_key(chunk_index + ((volume,) if len(shape) > 3 else ()))
+                    with open(os.path.join(tmp_store_dir, key),'wb') as f:
+                        f.write(chunk_bytes)
+    except BaseException:
+        shutil.rmtree(tmp_store_dir, ignore_errors=True)
+        raise
+    staging.swap_tree(tmp_store_dir, store_dir)
+    return store_dir
+
+def read_zarr(store_dir, region=()):
+    """
+    Read a region of an array written by write_zarr, without zarr
+    installed. Only the chunks overlapping the region are read.
+
+    Input
+    =====
+    store_dir: path to Zarr folder.
+    region: tuple with an index or a slice (step 1) for the first
+        dimensions, e.g. (slice(None), slice(None), slice(None), 10) for
+        volume 10. The other dimensions are read whole.
+
+    Output
+    ======
+    data: numpy array with the region, without the indexed dimensions.
+    attributes: dict with the attributes of the array.
+    """
+    with open(os.path.join(store_dir,'.zarray')) as f:
+        zarray = json.load(f)
+    with open(os.path.join(store_dir,'.zattrs')) as f:
+        attributes = json.load(f)
+    assert zarray['compressor']['id'] == 'zlib' and zarray['order'] == 'C' and zarray['filters'] is None, \
+        f"{store_dir} was not written by write_zarr"
+    shape = zarray['shape']
+    chunks = zarray['chunks']
+    dtype = np.dtype(zarray['dtype'])
+
+    region = tuple(region) + (slice(None),) * (len(shape) - len(region))
+    starts, stops, indexed = [], [], []
+    for dim, index in enumerate(region):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(shape[dim])
+            assert step == 1, "only slices with step 1 are supported"
+        else:
+            start = int(index) + shape[dim] if index < 0 else int(index)
+            assert 0 <= start < shape[dim], f"index {index} is out of range for dimension {dim}"
+            stop = start + 1
+            indexed.append(dim)
+        starts.append(start)
+        stops.append(max(start, stop))
+
+    data = np.full([stop - start for start, stop in zip(starts, stops)], zarray['fill_value'], dtype=dtype)
+    chunk_ranges = [range(start // chunk, -(-stop // chunk)) for start, stop, chunk in zip(starts, stops, chunks)]
+    for chunk_index in itertools.product(*chunk_ranges):
+        chunk_file = os.path.join(store_dir, get_chunk_key(chunk_index))
+        if not os.path.exists(chunk_file):
+            continue
+        with open(chunk_file,'rb') as f:
+            chunk_data = np.frombuffer(zlib.decompress(f.read()), dtype=dtype).reshape(chunks)
+        src, dst = [], []
+        for index, start, stop, chunk in zip(chunk_index, starts, stops, chunks):
+            low = max(start, index * chunk)
+            high = min(stop, (index + 1) * chunk)
+            src.append(slice(low - index * chunk, high - index * chunk))
+            dst.append(slice(low - start, high - start))
+        data[tuple(dst)] = chunk_data[tuple(src)]
+    return data.squeeze(axis=tuple(indexed)), attributes
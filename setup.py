@@ -20,7 +20,10 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     entry_points = {
-        'console_scripts': ['dmri_preprocessing=dmri_preprocessing.dmri_preprocessing:main'],
+        'console_scripts': [
+            'dmri_preprocessing=dmri_preprocessing.dmri_preprocessing:main',
+            'dmri_dti_scalars=dmri_preprocessing.dtiscalars:main'
+        ],
     },
     python_requires='>=3.6',
 )
\ No newline at end of file
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import logging
+import argparse
+import pytest
+import numpy as np
+import nibabel as nib
+
+from dmri_preprocessing import batch
+
+logger = logging.getLogger(__name__)
+
+def make_bids_dir(bids_dir, sessions):
+    for subject, session in sessions:
+        os.makedirs(os.path.join(bids_dir,"sub-"+subject,"ses-"+session,"dwi"))
+
+def test_get_sessions(tmp_path):
+    bids_dir = str(tmp_path)
+    make_bids_dir(bids_dir,[('01','a'),('01','b'),('02','a'),('11','a')])
+
+    assert batch.get_sessions(bids_dir) == [('01','a'),('01','b'),('02','a'),('11','a')]
+    assert batch.get_sessions(bids_dir,['sub-01']) == [('01','a'),('01','b')]
+    assert batch.get_sessions(bids_dir,['01','02'],['ses-a']) == [('01','a'),('02','a')]
+    assert batch.get_sessions(bids_dir,['1*']) == [('11','a')]
+    assert batch.get_sessions(bids_dir,['03']) == []
+
+def mock_run_session(opts, subject, session, cpu_budget):
+    if subject == '02':
+        raise RuntimeError("failed")
+
+def test_run_batch(tmp_path):
+    summary_file = os.path.join(str(tmp_path),"batch_summary.tsv")
+    results = batch.run_batch(mock_run_session, None, [("01","a"),("02","a")], 1, None, summary_file)
+    status = {result['subject']: result['status'] for result in results}
+    assert status == {'01': 'success', '02': 'failed'}
+
+    with open(summary_file) as f:
+        lines = f.read().strip().split("\n")
+    assert lines[0].split("\t") == ['subject', 'session', 'status', 'duration_s', 'error']
+    assert len(lines) == 3
+
+def test_parse_shard():
+    assert batch.parse_shard('2/10') == (2, 10)
+    for value in ['10/10', '-1/10', '1', 'a/b']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            batch.parse_shard(value)
+
+def test_shard_sessions():
+    sessions = [('%02d' % i, '01') for i in range(10)]
+    costs = [100, 90, 10, 10, 10, 10, 10, 10, 10, 10]
+    shards = [batch.shard_sessions(sessions, costs, i, 3) for i in range(3)]
+
+    # All sessions are in exactly one shard
+    assert sorted(sum(shards, [])) == sessions
+    # The two costly sessions are in separate shards
+    assert ('00', '01') in shards[0] and ('01', '01') in shards[1]
+    loads = [sum([costs[sessions.index(session)] for session in shard]) for shard in shards]
+    assert sorted(loads) == [80, 90, 100]
+    # The split does not depend on the order of the sessions
+    assert batch.shard_sessions(sessions[::-1], costs[::-1], 2, 3) == shards[2]
+
+def test_get_session_cost(tmp_path):
+    bids_dir = str(tmp_path)
+    make_bids_dir(bids_dir, [('01','01')])
+    dwi_file = os.path.join(bids_dir, 'sub-01', 'ses-01', 'dwi', 'sub-01_ses-01_dwi.nii.gz')
+    nib.save(nib.Nifti1Image(np.zeros((4,4,2,3), dtype=np.int16), np.eye(4)), dwi_file)
+    assert batch.get_session_cost(bids_dir, '01', '01') == 4*4*2*3
+
+def test_parse_size():
+    assert batch.parse_size('500G') == 500 << 30
+    assert batch.parse_size('1.5k') == 1536
+    assert batch.parse_size('1000') == 1000
+    for value in ['G', '-1G', '10X', '0']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            batch.parse_size(value)
+
+def test_run_batch_disk_quota(tmp_path):
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    with open(str(work_dir / 'intermediate.nii'),'wb') as f:
+        f.write(b'\x01' * 100000)
+    assert batch.get_disk_usage(str(work_dir)) >= 100000
+    os.link(str(work_dir / 'intermediate.nii'), str(work_dir / 'link.nii'))
+    assert batch.get_disk_usage(str(work_dir)) < 200000
+
+    disk_quota = {'max_bytes': 150000, 'session_dirs': [str(work_dir), str(tmp_path / 'missing')],
+                  'session_bytes': [100000, 100000]}
+    assert batch.has_disk_room(disk_quota, [str(work_dir)], 0, 10000)
+    assert not batch.has_disk_room(disk_quota, [str(work_dir)], 0, 100000)
+    assert not batch.has_disk_room(disk_quota, [], 100000, 60000)
+    # Only the folders of the running sessions are measured
+    assert batch.has_disk_room(disk_quota, [], 0, 100000)
+
+    # The sessions do not fit together, so they run one at a time
+    summary_file = os.path.join(str(tmp_path),"batch_summary.tsv")
+    sessions = [("01","a"),("02","a")]
+    results = batch.run_batch(mock_run_session, None, sessions, 2, None, summary_file, disk_quota)
+    status = {result['subject']: result['status'] for result in results}
+    assert status == {'01': 'success', '02': 'failed'}
+
+def test_get_session_work_dir(tmp_path):
+    opts = argparse.Namespace(work_dir=str(tmp_path / 'work'), scratch_dir=None)
+    assert batch.get_session_work_dir(opts, 'app', '01', 'a') == str(tmp_path / 'work' / 'app_wf' / 'sub-01_ses-a_wf')
+    opts.scratch_dir = str(tmp_path / 'scratch')
+    for name in ['app_sub-01_ses-a_x1y2', 'app_sub-01_ses-ab_x1y2', 'app_sub-011_ses-a_x1y2']:
+        (tmp_path / 'scratch' / name).mkdir(parents=True)
+    pattern = batch.get_session_work_dir(opts, 'app', '01', 'a')
+    assert glob.glob(pattern) == [str(tmp_path / 'scratch' / 'app_sub-01_ses-a_x1y2')]
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import os
+import logging
+import pytest
+import numpy as np
+import nibabel as nib
+
+import dmri_preprocessing.biasfield as biasfield
+import dmri_preprocessing.frames as frames
+
+logger = logging.getLogger(__name__)
+
+def test_apply_bias_field(tmp_path):
+    rng = np.random.RandomState(0)
+    data = rng.randint(0, 1000, size=(6,7,5,9)).astype(np.int16)
+    bias = rng.uniform(0.5, 2.0, size=(6,7,5)).astype(np.float32)
+    # No correction where the field is 0
+    bias[0] = 0
+    in_file = str(tmp_path / 'dwi.nii.gz')
+    bias_file = str(tmp_path / 'bias_field_b0.nii.gz')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), in_file)
+    nib.save(nib.Nifti1Image(bias, np.eye(4)), bias_file)
+    expected = np.where(bias[..., np.newaxis] != 0, data / np.where(bias != 0, bias, 1)[..., np.newaxis], 0)
+
+    out_file = str(tmp_path / 'dwi_bias_corrected.nii.gz')
+    biasfield.apply_bias_field(in_file, bias_file, out_file, frame_nrs=[0, 7], n_threads=2)
+    img = nib.load(out_file)
+    assert img.get_data_dtype() == np.int16
+    assert np.array_equal(np.asanyarray(img.dataobj), np.rint(expected).astype(np.int16))
+
+    # The qc frames are written in the same pass, and reused
+    for fname, volumes in [(in_file, data), (out_file, np.asanyarray(img.dataobj))]:
+        frame_files = frames.extract_frames(fname, [0, 7])
+        assert frame_files == [frames.get_frame_filename(fname, 0), frames.get_frame_filename(fname, 7)]
+        assert np.array_equal(nib.load(frame_files[1]).get_fdata(), volumes[..., 7])
+        assert frames.is_up_to_date(frame_files[1], fname)
+
+    # A scaled input is written as float32, here on one thread
+    scaled_file = str(tmp_path / 'dwi_scaled.nii.gz')
+    scaled_img = nib.Nifti1Image(data, np.eye(4))
+    scaled_img.header.set_slope_inter(0.5, 0)
+    nib.save(scaled_img, scaled_file)
+    out_file = str(tmp_path / 'dwi_float.nii.gz')
+    biasfield.apply_bias_field(scaled_file, bias_file, out_file, compresslevel=1, n_threads=1)
+    img = nib.load(out_file)
+    assert img.get_data_dtype() == np.float32
+    assert np.allclose(img.get_fdata(), expected * 0.5, rtol=1e-6)
+
+def test_apply_bias_field_failure(tmp_path, monkeypatch):
+    in_file = str(tmp_path / 'dwi.nii.gz')
+    bias_file = str(tmp_path / 'bias_field_b0.nii.gz')
+    nib.save(nib.Nifti1Image(np.ones((4,4,4,3), dtype=np.int16), np.eye(4)), in_file)
+    nib.save(nib.Nifti1Image(np.ones((4,4,4), dtype=np.float32), np.eye(4)), bias_file)
+    def broken_divide(volume, bias, out_dtype):
+        raise MemoryError("volume too large")
+    monkeypatch.setattr(biasfield, 'divide_volume', broken_divide)
+    with pytest.raises(MemoryError):
+        biasfield.apply_bias_field(in_file, bias_file, str(tmp_path / 'dwi_bias_corrected.nii.gz'))
+    assert not [name for name in os.listdir(str(tmp_path)) if '.tmp' in name]
+    assert sorted(os.listdir(str(tmp_path))) == ['bias_field_b0.nii.gz', 'dwi.nii.gz']
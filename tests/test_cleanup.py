@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import shutil
+import json
+import logging
+import numpy as np
+
+import dmri_preprocessing.utils as utils
+import dmri_preprocessing.cleanup as cleanup
+import dmri_preprocessing.outputs as outputs
+import dmri_preprocessing.telemetry as telemetry
+import dmri_preprocessing.workflows as workflows
+from dmri_preprocessing.gradients import GradientTable
+from dmri_preprocessing.report import reports
+
+logger = logging.getLogger(__name__)
+
+def touch(path, overwrite=True):
+    os.makedirs(os.path.dirname(str(path)), exist_ok=True)
+    if overwrite or not os.path.exists(str(path)):
+        with open(str(path),'w') as f:
+            f.write('mock')
+    return str(path)
+
+def read(*paths):
+    # A stage reading a file that was deleted fails the workflow
+    for path in paths:
+        assert os.path.exists(path), f"{path} was deleted before it was read"
+
+def test_get_derived_files(tmp_path):
+    image = touch(tmp_path / 'dwi.nii.gz')
+    frame_files = [touch(tmp_path / name) for name in ['dwi_00.nii.gz', 'dwi_99.nii.gz', 'dwi_100.nii.gz']]
+    # Not frames of dwi.nii.gz
+    touch(tmp_path / 'dwi_00_brain.nii.gz')
+    touch(tmp_path / 'dwi_00.nii')
+    assert cleanup.get_derived_files(image) == sorted(frame_files)
+
+# Mock stages, reading and writing the files the real stages read and
+# write (see workflows.py)
+def mock_gather_inputs(data, subject, session, output_dir):
+    in_file = data['dwi'][0]['filename']
+    read(in_file)
+    output_file = os.path.join(output_dir, os.path.basename(in_file))
+    utils.link_file(in_file, output_file)
+    for extension in ['.bvec','.bval']:
+        utils.link_file(utils.replace_nifti_ext(in_file,extension), utils.replace_nifti_ext(output_file,extension))
+    data['gradients'] = data['dwi'][0]['gradients']
+    data['dwi'][0]['filename'] = output_file
+    data['in_bval'] = utils.replace_nifti_ext(output_file,'.bval')
+    data['in_bvec'] = utils.replace_nifti_ext(output_file,'.bvec')
+    data['b0_mask'] = touch(utils.add_nifti_suffix(output_file,'_00_brain_mask'))
+    return data
+
+def mock_processing_step(suffix):
+    def run_step(data, output_dir=None, n_cpus=1, *args):
+        read(data['dwi'][0]['filename'])
+        data['dwi'][0]['filename'] = touch(utils.add_nifti_suffix(data['dwi'][0]['filename'], suffix))
+        return data
+    return run_step
+
+def mock_dwidenoise(data, denoise_filter_length, n_cpus, output_dir):
+    return mock_processing_step('_denoised')(data)
+
+def mock_plot_before_after_frames(in_file, out_file, data, output_svg_basename):
+    read(in_file, out_file, data['b0_mask'])
+    # Frames are extracted next to the images
+    for image in [in_file, out_file]:
+        touch(utils.add_nifti_suffix(image,'_00'))
+    return [touch(output_svg_basename + '_lowb.svg'), touch(output_svg_basename + '_highb.svg')]
+
+def mock_topup(data, topup_options, output_dir):
+    read(*[fmap['filename'] for fmap in data['fmap']])
+    merged = touch(os.path.join(output_dir,'AP_PA.nii.gz'))
+    topup_basename = os.path.join(output_dir,'topup','AP_PA')
+    for suffix in ['_corrected.nii.gz','_base_fieldcoef.nii.gz','_field.nii.gz','_base_movpar.txt','_encfile.txt']:
+        touch(topup_basename + suffix)
+    return topup_basename, merged
+
+def mock_plot_topup(data, topup_basename, multiple_encoding_directions_file):
+    read(multiple_encoding_directions_file, topup_basename + '_corrected.nii.gz', data['b0_mask'])
+    return touch(topup_basename + '_corrected.svg')
+
+def mock_prepare_eddy(data, topup_options, phase_encoding_directions, output_dir, topup_basename=None):
+    in_file = data['dwi'][0]['filename']
+    read(in_file, data['in_bval'], data['b0_mask'], topup_basename + '_corrected.nii.gz')
+    return {
+        'in_acqp': topup_basename + '_encfile.txt',
+        'in_topup_fieldcoef': topup_basename + '_base_fieldcoef.nii.gz',
+        'in_topup_field': topup_basename + '_field.nii.gz',
+        'in_topup_movpar': topup_basename + '_base_movpar.txt',
+        'in_topup_corrected': topup_basename + '_corrected.nii.gz',
+        'in_mask': touch(os.path.join(output_dir,'copygeom','AP_PA_corrected_mean_brain_mask.nii.gz')),
+        'in_index': touch(utils.replace_nifti_ext(in_file,'_index.txt'))
+    }
+
+def mock_eddy(eddy_inputs, topup_options, output_dir, n_cpus):
+    read(*[eddy_inputs[name] for name in ['in_file','in_bval','in_bvec','in_mask','in_acqp','in_index',
+                                          'in_topup_fieldcoef','in_topup_movpar']])
+    eddy_output_dir = os.path.join(output_dir,'01_hmc')
+    for suffix in ['.nii.gz','.eddy_rotated_bvecs','.eddy_cnr_maps.nii.gz','.eddy_parameters']:
+        touch(os.path.join(eddy_output_dir,'eddy_corrected' + suffix))
+    return eddy_output_dir
+
+def mock_eddy_quad(eddy_inputs, topup_options, eddy_output_dir):
+    read(os.path.join(eddy_output_dir,'eddy_corrected.nii.gz'), eddy_inputs['in_topup_field'],
+         *[eddy_inputs[name] for name in ['in_index','in_acqp','in_mask','in_bval','in_bvec']])
+    return os.path.dirname(touch(os.path.join(eddy_output_dir,'qc','qc.json')))
+
+def mock_n4biasfieldcorrection(data, output_dir, compresslevel=6, n_cpus=1):
+    touch(utils.add_nifti_suffix(data['dwi'][0]['filename'],'_00'))
+    return mock_processing_step('_bias_corrected')(data)
+
+def mock_dtifit(in_file, in_bval, in_bvec, in_mask, output_dir):
+    read(in_file, in_bval, in_bvec, in_mask)
+    dtifit_output_dir = os.path.join(output_dir,'03_dtifit')
+    for name in ['FA','MD','L1','L2','L3']:
+        touch(os.path.join(dtifit_output_dir,'dtifit__' + name + '.nii.gz'))
+    return dtifit_output_dir
+
+def mock_rd(dtifit_output_dir, compresslevel=6, n_cpus=1):
+    read(*[os.path.join(dtifit_output_dir,'dtifit__' + name + '.nii.gz') for name in ['L1','L2','L3']])
+    return {name: touch(os.path.join(dtifit_output_dir,'dtifit__' + name + '.nii.gz')) for name in ['RD','AD']}
+
+def mock_to_derivatives(data, data_raw, derivatives_dir, application_name, eddy_output_dir, dtifit_dir, eddy_input, figures,
+                        eddy_quad_dir, n_cpus=1):
+    read(data['dwi'][0]['filename'], eddy_input['in_bval'], eddy_input['in_mask'], *figures)
+    read(*glob.glob(os.path.join(eddy_output_dir,'eddy_corrected.*')))
+    read(os.path.join(eddy_output_dir,'eddy_corrected.eddy_rotated_bvecs'), os.path.join(dtifit_dir,'dtifit__RD.nii.gz'))
+    read(os.path.join(eddy_quad_dir,'qc.json'))
+    output_dir_session = os.path.join(derivatives_dir, application_name, 'sub-01', 'ses-01')
+    # The session folder is replaced, see staging.swap_tree
+    if os.path.exists(output_dir_session):
+        shutil.rmtree(output_dir_session)
+    touch(os.path.join(output_dir_session,'dwi','sub-01_ses-01_space-orig_desc-preproc_dwi.nii.gz'))
+    return output_dir_session
+
+def run_workflow(tmp_path, monkeypatch, gc_work_dir, work_dir):
+    monkeypatch.setattr(workflows, 'gather_inputs', mock_gather_inputs)
+    monkeypatch.setattr(workflows, 'run_dwidenoise', mock_dwidenoise)
+    monkeypatch.setattr(workflows, 'plot_before_after_frames', mock_plot_before_after_frames)
+    monkeypatch.setattr(workflows, 'run_mrdegibbs', mock_processing_step('_degibbs'))
+    monkeypatch.setattr(workflows, 'run_topup', mock_topup)
+    monkeypatch.setattr(workflows, 'plot_topup', mock_plot_topup)
+    monkeypatch.setattr(workflows, 'prepare_eddy', mock_prepare_eddy)
+    monkeypatch.setattr(workflows, 'run_eddy', mock_eddy)
+    monkeypatch.setattr(workflows, 'run_eddy_quad', mock_eddy_quad)
+    monkeypatch.setattr(workflows, 'run_n4biasfieldcorrection', mock_n4biasfieldcorrection)
+    monkeypatch.setattr(workflows, 'run_dtifit', mock_dtifit)
+    monkeypatch.setattr(workflows, 'run_rd', mock_rd)
+    monkeypatch.setattr(outputs, 'to_derivatives', mock_to_derivatives)
+    monkeypatch.setattr(reports, 'create_report', lambda *args: None)
+
+    bids_dir = tmp_path / 'bids'
+    dwi = touch(bids_dir / 'sub-01' / 'ses-01' / 'dwi' / 'sub-01_ses-01_dwi.nii.gz', False)
+    touch(bids_dir / 'sub-01' / 'ses-01' / 'dwi' / 'sub-01_ses-01_dwi.bval', False)
+    touch(bids_dir / 'sub-01' / 'ses-01' / 'dwi' / 'sub-01_ses-01_dwi.bvec', False)
+    data = {
+        'dwi': [{
+            'filename': dwi,
+            'metadata': {'PhaseEncodingDirection': 'y', 'PartialFourier': 1, 'TotalReadoutTime': 0.05},
+            'bval': np.array([0,1000]),
+            'b0_idx': np.array([0]),
+            'bhigh_idx': np.array([1]),
+            'gradients': GradientTable([0,1000], [[0,0,0],[1,0,0]], [0,0], 10)
+        }],
+        'fmap': [
+            {'filename': touch(bids_dir / 'sub-01' / 'ses-01' / 'fmap' / ('sub-01_ses-01_dir-' + direction + '_epi.nii.gz'), False),
+             'metadata': {'PhaseEncodingDirection': encoding_direction}}
+            for direction, encoding_direction in [('PA','y-'), ('AP','y')]
+        ],
+        'sbref': [],
+        'nifti_ext': '.nii.gz'
+    }
+    data_raw = {
+        'subject': '01',
+        'session': '01',
+        'bids_dir': str(bids_dir),
+        'b0_threshold': 100,
+        'fsl_version': '6.0.4',
+        'mrtrix3_version': '3.0.2',
+        'ants_version': '2.3.4',
+        'application_version': '0.3.0',
+        'nifti_ext': '.nii.gz',
+        'compression_level': 6,
+        'gc_work_dir': gc_work_dir,
+        'zarr_derivatives': False
+    }
+    topup_options, phase_encoding_directions = utils.check_if_dataset_compatible_with_topup(data)
+    wf = workflows.init_dmri_preprocessing_wf(data, data_raw, topup_options, phase_encoding_directions,
+        (5,5,5), None, str(work_dir), str(tmp_path / 'derivatives'), 'dmri_preprocessing')
+    wf.config['execution']['stop_on_first_crash'] = True
+    # Raises if a stage read a file deleted before
+    wf.run(plugin='Linear')
+    with open(str(work_dir / 'gc_refcounts.json')) as f:
+        return json.load(f)
+
+def get_stage_files(work_dir):
+    """
+    Files written by the stages, not by nipype or the checkpoints.
+    """
+    stage_files = []
+    for root, dirs, files in os.walk(str(work_dir)):
+        dirs[:] = [name for name in dirs if name not in ['checkpoints','telemetry','dmri_preprocessing_wf']]
+        stage_files.extend([os.path.join(root, name) for name in files if not name.startswith('gc_refcounts')])
+    return sorted(stage_files)
+
+def test_release_workflow(tmp_path, monkeypatch):
+    # Every intermediate is deleted once the stages getting it are done,
+    # and never before
+    work_dir = tmp_path / 'work_all'
+    refcounts = run_workflow(tmp_path, monkeypatch, 'all', work_dir)
+    assert refcounts == {}
+    assert get_stage_files(work_dir) == []
+    assert os.path.exists(str(tmp_path / 'derivatives' / 'dmri_preprocessing' / 'sub-01' / 'ses-01'))
+    # The BIDS inputs are kept
+    assert os.path.exists(str(tmp_path / 'bids' / 'sub-01' / 'ses-01' / 'dwi' / 'sub-01_ses-01_dwi.nii.gz'))
+
+    # keep_checkpoints only deletes the frames, and a rerun is skipped
+    work_dir = tmp_path / 'work_keep_checkpoints'
+    refcounts = run_workflow(tmp_path, monkeypatch, 'keep_checkpoints', work_dir)
+    assert refcounts == {}
+    stage_files = get_stage_files(work_dir)
+    assert os.path.join(str(work_dir), '01_hmc', 'eddy_corrected.nii.gz') in stage_files
+    assert [path for path in stage_files if path.endswith('_00.nii.gz')] == []
+    run_workflow(tmp_path, monkeypatch, 'keep_checkpoints', work_dir)
+    statuses = set()
+    for telemetry_file in glob.glob(str(work_dir / 'telemetry' / '*.json')):
+        with open(telemetry_file) as f:
+            statuses.add(json.load(f)['status'])
+    assert statuses == {'cached'}
+    # The runtime files are written after the export, which they include
+    runtime_tsv = str(tmp_path / 'derivatives' / 'dmri_preprocessing' / 'sub-01' / 'ses-01' / 'sub-01_ses-01_desc-runtime.tsv')
+    stages = [row['stage'] for row in telemetry.read_runtime(runtime_tsv)]
+    assert 'to_derivatives' in stages and 'eddy' in stages
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+import gzip
+import logging
+import numpy as np
+import nibabel as nib
+
+import dmri_preprocessing.compression as compression
+
+logger = logging.getLogger(__name__)
+
+def test_compress_file(tmp_path):
+    image = np.arange(10*10*10*6, dtype=np.int16).reshape((10,10,10,6))
+    nib.save(nib.Nifti1Image(image, np.eye(4)), str(tmp_path / 'dwi.nii'))
+    with open(str(tmp_path / 'dwi.nii'),'rb') as f:
+        raw = f.read()
+
+    for n_threads in [1, 3]:
+        compressed = str(tmp_path / ('dwi_%d.nii.gz' % n_threads))
+        # Small blocks, so the file has many gzip members
+        compression.compress_file(str(tmp_path / 'dwi.nii'), compressed, 6, n_threads, block_size=1000)
+        with gzip.open(compressed,'rb') as f:
+            assert f.read() == raw
+        assert np.array_equal(np.asanyarray(nib.load(compressed).dataobj), image)
+
+    # The output does not depend on the number of threads
+    with open(str(tmp_path / 'dwi_1.nii.gz'),'rb') as f1, open(str(tmp_path / 'dwi_3.nii.gz'),'rb') as f3:
+        assert f1.read() == f3.read()
+
+def test_compress_empty_file(tmp_path):
+    open(str(tmp_path / 'empty'),'wb').close()
+    compression.compress_file(str(tmp_path / 'empty'), str(tmp_path / 'empty.gz'), 6, 2)
+    with gzip.open(str(tmp_path / 'empty.gz'),'rb') as f:
+        assert f.read() == b''
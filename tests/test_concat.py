@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import pytest
+import logging
+import numpy as np
+import nibabel as nib
+
+import dmri_preprocessing.concat as concat
+from dmri_preprocessing.gradients import GradientTable
+
+logger = logging.getLogger(__name__)
+
+def save_image(data, fname, affine=np.eye(4)):
+    nib.save(nib.Nifti1Image(data, affine), fname)
+    return fname
+
+def test_concat_images(tmp_path):
+    run1 = np.arange(4*5*6*3, dtype=np.int16).reshape((4,5,6,3))
+    run2 = -np.arange(4*5*6, dtype=np.int16).reshape((4,5,6))
+    in_files = [
+        save_image(run1, str(tmp_path / 'run-1_dwi.nii.gz')),
+        save_image(run2, str(tmp_path / 'run-2_dwi.nii'))
+    ]
+    gradients = [
+        GradientTable([0,1000,1000], [[0,0,0],[1,0,0],[0,1,0]], [0,0,0], 10),
+        GradientTable([0], [[0,0,0]], [1], 10)
+    ]
+    expected = np.concatenate([run1, run2[..., np.newaxis]], axis=3)
+
+    for output_file in [str(tmp_path / 'dwi.nii.gz'), str(tmp_path / 'dwi.nii')]:
+        source_ids, merged_gradients = concat.concat_images(in_files, output_file, gradients)
+        assert source_ids.tolist() == [0,0,0,1]
+        assert merged_gradients.bvals.tolist() == [0,1000,1000,0]
+        assert merged_gradients.source_ids.tolist() == [0,0,0,1]
+        img = nib.load(output_file)
+        assert img.get_data_dtype() == np.int16
+        assert np.array_equal(np.asanyarray(img.dataobj), expected)
+
+    # Different data types are written as float32
+    in_files.append(save_image(np.ones((4,5,6,2), dtype=np.float32), str(tmp_path / 'run-3_dwi.nii')))
+    source_ids, merged_gradients = concat.concat_images(in_files, str(tmp_path / 'mixed.nii.gz'))
+    assert source_ids.tolist() == [0,0,0,1,2,2]
+    assert merged_gradients is None
+    img = nib.load(str(tmp_path / 'mixed.nii.gz'))
+    assert img.get_data_dtype() == np.float32
+    assert np.array_equal(img.get_fdata()[..., :4], expected)
+
+    # The gradient tables must match the images
+    with pytest.raises(AssertionError):
+        concat.concat_images(in_files[:2], str(tmp_path / 'dwi.nii'), gradients[::-1])
+    # And the images must be on the same grid
+    other_grid = save_image(np.zeros((4,5,7), dtype=np.int16), str(tmp_path / 'other.nii'))
+    with pytest.raises(AssertionError):
+        concat.concat_images([in_files[0], other_grid], str(tmp_path / 'dwi.nii'))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import os
+import logging
+import pytest
+import numpy as np
+import nibabel as nib
+
+import dmri_preprocessing.dtiscalars as dtiscalars
+
+logger = logging.getLogger(__name__)
+
+def write_eigenvalues(prefix, suffix, shape=(4,5,20)):
+    rng = np.random.RandomState(0)
+    eigenvalues = -np.sort(-rng.uniform(0, 3e-3, size=shape + (3,)), axis=-1)
+    # Background
+    eigenvalues[0] = 0
+    for i, name in enumerate(['L1', 'L2', 'L3']):
+        nib.save(nib.Nifti1Image(eigenvalues[..., i].astype(np.float32), np.eye(4)), prefix + name + suffix)
+    return [eigenvalues[..., i].astype(np.float32).astype(np.float64) for i in range(3)]
+
+def test_compute_scalars(tmp_path):
+    l1, l2, l3 = write_eigenvalues(str(tmp_path / 'dtifit__'), '.nii.gz')
+    l1_file = str(tmp_path / 'dtifit__L1.nii.gz')
+    # Several slabs, the last one partial
+    output_files = dtiscalars.compute_scalars(l1_file, sorted(dtiscalars.SCALARS), slab_slices=8)
+    assert output_files['RD'] == str(tmp_path / 'dtifit__RD.nii.gz')
+
+    maps = {name: nib.load(output_file).get_fdata() for name, output_file in output_files.items()}
+    assert nib.load(output_files['RD']).get_data_dtype() == np.float32
+    assert np.allclose(maps['RD'], (l2 + l3) / 2)
+    assert np.allclose(maps['AD'], l1)
+    assert np.allclose(maps['MD'], (l1 + l2 + l3) / 3)
+    assert np.allclose(maps['CL'] + maps['CP'] + maps['CS'], np.where(l1 > 0, 1, 0))
+    assert np.all(maps['CS'][0] == 0)
+
+def test_compute_scalars_batch(tmp_path):
+    derivatives_prefix = str(tmp_path / 'sub-01_ses-01_space-orig_desc-preproc_model-DTI_parameter-')
+    write_eigenvalues(derivatives_prefix, '_diffmodel.nii')
+    os.makedirs(str(tmp_path / 'work'))
+    write_eigenvalues(str(tmp_path / 'work' / 'dtifit__'), '.nii.gz')
+    # No L2 and L3
+    nib.save(nib.Nifti1Image(np.zeros((2,2,2), dtype=np.float32), np.eye(4)), str(tmp_path / 'broken_L1.nii'))
+
+    l1_files = dtiscalars.find_l1_files([str(tmp_path)])
+    assert l1_files == [
+        str(tmp_path / 'broken_L1.nii'),
+        derivatives_prefix + 'L1_diffmodel.nii',
+        str(tmp_path / 'work' / 'dtifit__L1.nii.gz')
+    ]
+    results = dtiscalars.compute_scalars_batch(l1_files, ['RD'], n_workers=2)
+    assert [result['status'] for result in results] == ['failed', 'success', 'success']
+    assert os.path.exists(derivatives_prefix + 'RD_diffmodel.nii')
+    # Maps are not found again as L1 images
+    assert len(dtiscalars.find_l1_files([str(tmp_path)])) == 3
+
+def test_compute_scalars_failure(tmp_path, monkeypatch):
+    write_eigenvalues(str(tmp_path / 'dtifit__'), '.nii.gz')
+    def broken_map(l1, l2, l3):
+        raise MemoryError("slab too large")
+    monkeypatch.setitem(dtiscalars.SCALARS, 'AD', broken_map)
+    with pytest.raises(MemoryError):
+        dtiscalars.compute_scalars(str(tmp_path / 'dtifit__L1.nii.gz'), ['RD', 'AD'])
+    # No map and no temporary file is left, which could be taken for a map
+    assert not [name for name in os.listdir(str(tmp_path)) if '.tmp' in name]
+    assert sorted(os.listdir(str(tmp_path))) == ['dtifit__L1.nii.gz', 'dtifit__L2.nii.gz', 'dtifit__L3.nii.gz']
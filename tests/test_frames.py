@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+import os
+import logging
+import numpy as np
+import nibabel as nib
+
+import dmri_preprocessing.frames as frames
+
+logger = logging.getLogger(__name__)
+
+def test_extract_frames(tmp_path):
+    image = np.arange(4*5*6*7, dtype=np.int16).reshape((4,5,6,7))
+    affine = np.diag([2.0, 2.0, 2.5, 1.0])
+    for extension in ['.nii', '.nii.gz']:
+        fname = str(tmp_path / ('dwi' + extension))
+        nib.save(nib.Nifti1Image(image, affine), fname)
+
+        outputs = frames.extract_frames(fname, [5, 0])
+        assert outputs == [str(tmp_path / ('dwi_05' + extension)), str(tmp_path / ('dwi_00' + extension))]
+        for frame_nr, output in zip([5, 0], outputs):
+            frame_img = nib.load(output)
+            assert frame_img.shape == (4,5,6)
+            assert np.allclose(frame_img.affine, affine)
+            assert np.array_equal(np.asanyarray(frame_img.dataobj), image[..., frame_nr])
+
+        # Cached frames are not written again
+        mtime = os.path.getmtime(outputs[0])
+        frames.frame_cache.clear()
+        assert frames.extract_frames(fname, [5])[0] == outputs[0]
+        assert os.path.getmtime(outputs[0]) == mtime
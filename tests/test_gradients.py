@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import logging
+import numpy as np
+
+from dmri_preprocessing.gradients import GradientTable
+
+logger = logging.getLogger(__name__)
+
+def write_run(tmpdir, name, bvals, bvecs):
+    base = str(tmpdir.join(name))
+    with open(base + '.bval','w') as f:
+        f.write(" ".join([str(bval) for bval in bvals]) + "\n")
+    np.savetxt(base + '.bvec', np.array(bvecs).T)
+    return base
+
+def test_gradient_table(tmpdir):
+    bvecs = [[0,0,0],[1,0,0],[0,1,0],[0,0,1],[1,0,0]]
+    base = write_run(tmpdir, 'run-1_dwi', [0,1000,995,2000,5], bvecs)
+    gradients = GradientTable.from_files(base + '.bval', base + '.bvec', 10, source_id=3)
+
+    assert len(gradients) == 5
+    assert gradients.bvecs.shape == (5,3)
+    assert gradients.b0_idx.tolist() == [0,4]
+    assert gradients.bhigh_idx.tolist() == [1,2,3]
+    assert gradients.source_ids.tolist() == [3]*5
+    assert gradients.shell_ids.tolist() == [0,1,1,2,0]
+    assert gradients.shells.tolist() == [0,998,2000]
+
+    # Writing and reading gives the same table
+    gradients.to_files(str(tmpdir.join('copy')))
+    copy = GradientTable.from_files(str(tmpdir.join('copy.bval')), str(tmpdir.join('copy.bvec')), 10, source_id=3)
+    assert np.allclose(copy.bvals, gradients.bvals)
+    assert np.allclose(copy.bvecs, gradients.bvecs)
+    assert repr(copy) == repr(gradients)
+
+def test_merge_and_subset(tmpdir):
+    base_1 = write_run(tmpdir, 'run-1_dwi', [0,1000], [[0,0,0],[1,0,0]])
+    base_2 = write_run(tmpdir, 'run-2_dwi', [0,2000,2000], [[0,0,0],[0,1,0],[0,0,1]])
+    run_1 = GradientTable.from_files(base_1 + '.bval', base_1 + '.bvec', 10, source_id=0)
+    run_2 = GradientTable.from_files(base_2 + '.bval', base_2 + '.bvec', 10, source_id=1)
+
+    merged = GradientTable.merge([run_1, run_2])
+    assert merged.bvals.tolist() == [0,1000,0,2000,2000]
+    assert merged.source_ids.tolist() == [0,0,1,1,1]
+    assert merged.b0_idx.tolist() == [0,2]
+
+    assert merged.select_runs([1]).bvals.tolist() == [0,2000,2000]
+    subset = merged.subset(merged.bhigh_mask)
+    assert subset.bvals.tolist() == [1000,2000,2000]
+    assert subset.source_ids.tolist() == [0,1,1]
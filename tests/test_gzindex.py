@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import os
+import gzip
+import logging
+
+import dmri_preprocessing.gzindex as gzindex
+import dmri_preprocessing.compression as compression
+
+logger = logging.getLogger(__name__)
+
+def test_open_indexed(tmp_path, monkeypatch):
+    # Small chunks, so members end in the middle of a chunk and of its output
+    monkeypatch.setattr(gzindex, 'CHUNK_SIZE', 1000)
+    raw = bytes(bytearray(range(256))) * 1000 + b'\x00' * 100000
+    with open(str(tmp_path / 'raw'),'wb') as f:
+        f.write(raw)
+    single = str(tmp_path / 'single.gz')
+    with gzip.open(single,'wb') as f:
+        f.write(raw)
+    multiple = str(tmp_path / 'multiple.gz')
+    compression.compress_file(str(tmp_path / 'raw'), multiple, 6, 1, block_size=10000)
+
+    assert len(gzindex.find_members(single)) == 1
+    assert gzindex.find_members(multiple) == gzindex.find_members(multiple)
+    assert [member[1] for member in gzindex.find_members(multiple)] == list(range(0, len(raw), 10000))
+
+    one_block = str(tmp_path / 'one_block.gz')
+    compression.compress_file(str(tmp_path / 'raw'), one_block, 6, 1)
+    assert not gzindex.is_block_compressed(single)
+    assert gzindex.is_block_compressed(multiple)
+
+    for fname in [single, multiple, one_block]:
+        # The second time the index is read from disk
+        for _ in range(2):
+            with gzindex.open_indexed(fname) as fileobj:
+                for offset, size in [(300000, 50), (12345, 20000), (0, 10), (len(raw) - 5, 10)]:
+                    fileobj.seek(offset)
+                    assert fileobj.read(size) == raw[offset:offset + size]
+                    assert fileobj.tell() == min(offset + size, len(raw))
+    # Files with one member have no seek points to index
+    assert not os.path.exists(gzindex.get_index_filename(single, False))
+    assert not os.path.exists(gzindex.get_index_filename(one_block, False))
+    assert os.path.exists(gzindex.get_index_filename(multiple, False))
@@ -33,3 +33,22 @@ def test_parser():
     assert pytest_wrapped_e.type == SystemExit
     assert pytest_wrapped_e.value.code == 2
 
+def test_parser_batch():
+    """
+    Test parser with several subjects and sessions
+    """
+    opts = dmri_preprocessing.parse_args(['bids_dir', 'output_dir','participant','--participant_label','sub-1234','12*','--work_dir','work_dir','--n_sessions','4'])
+    assert opts.participant_label == ['sub-1234','12*']
+    assert opts.session_label is None
+    assert opts.n_sessions == 4
+
+def test_parser_dry_run():
+    opts = dmri_preprocessing.parse_args(['bids', 'out', 'participant', '-w', 'work', '--dry-run'])
+    assert opts.dry_run is True
+
+def test_parser_preflight():
+    opts = dmri_preprocessing.parse_args(['bids', 'out', 'participant', '-w', 'work', '--preflight'])
+    assert opts.preflight is True
+    assert opts.skip_invalid is False
+    opts = dmri_preprocessing.parse_args(['bids', 'out', 'participant', '-w', 'work', '--skip-invalid'])
+    assert opts.skip_invalid is True
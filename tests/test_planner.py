@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import logging
+import numpy as np
+import nibabel as nib
+
+import dmri_preprocessing.utils as utils
+import dmri_preprocessing.planner as planner
+
+from test_workflows import mock_data
+
+logger = logging.getLogger(__name__)
+
+def write_image(filename, shape):
+    nib.save(nib.Nifti1Image(np.zeros(shape, dtype=np.int16), np.eye(4)), filename)
+
+def test_plan_session(tmp_path):
+    data = mock_data()
+    data['dwi'][0]['filename'] = str(tmp_path / 'sub-01_ses-01_dwi.nii.gz')
+    write_image(data['dwi'][0]['filename'], (10,10,5,30))
+    for fmap, direction in zip(data['fmap'], ['PA','AP']):
+        fmap['filename'] = str(tmp_path / ('sub-01_ses-01_dir-%s_epi.nii.gz' % direction))
+        write_image(fmap['filename'], (10,10,5,2))
+    data_raw = {'subject': '01', 'session': '01', 'bids_dir': str(tmp_path), 'b0_threshold': 100, 'application_version': '0.3.0', 'nifti_ext': '.nii.gz', 'compression_level': 6, 'gc_work_dir': 'off', 'zarr_derivatives': False}
+    data_raw.update({tool + '_version': version for tool, version in planner.UNKNOWN_VERSIONS.items()})
+    topup_options, phase_encoding_directions = utils.check_if_dataset_compatible_with_topup(data)
+
+    plan = planner.plan_session(data, data_raw, topup_options, phase_encoding_directions, (5,5,5), 4)
+    stages = {stage['stage']: stage for stage in plan['stages']}
+
+    assert plan['shape'] == (10,10,5)
+    assert plan['mrdegibbs'] is True
+    assert plan['topup_branch'] == 'only_fmap'
+    assert stages['eddy']['n_volumes'] == 30
+    assert stages['topup']['n_volumes'] == 4
+    # Stages are in execution order
+    order = [stage['stage'] for stage in plan['stages']]
+    assert order.index('dwidenoise') < order.index('mrdegibbs') < order.index('eddy')
+    assert stages['eddy']['depends_on'] == ['mrdegibbs','prepare_eddy']
+    assert plan['wall_time_s'] >= stages['eddy']['wall_time_s']
+    assert plan['disk_mb'] >= 0
+
+def test_estimate_session_disk():
+    # The dwi series stages of 1000 volumes of 100x100x60 voxels, the
+    # plots and topup are left out
+    assert planner.estimate_session_disk(1000 * 100*100*60) == 22 * 600
+    assert planner.estimate_session_disk(0) == 0
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import logging
+import numpy as np
+import nibabel as nib
+
+import dmri_preprocessing.preflight as preflight
+
+logger = logging.getLogger(__name__)
+
+def write_dwi(bids_dir, subject, session, bvals, n_volumes=None, metadata=None):
+    dwi_dir = os.path.join(bids_dir, 'sub-'+subject, 'ses-'+session, 'dwi')
+    os.makedirs(dwi_dir, exist_ok=True)
+    basename = os.path.join(dwi_dir, 'sub-%s_ses-%s_dwi' % (subject, session))
+    if n_volumes is None:
+        n_volumes = len(bvals)
+    nib.save(nib.Nifti1Image(np.zeros((2,2,2,n_volumes), dtype=np.int16), np.eye(4)), basename + '.nii.gz')
+    with open(basename + '.bval','w') as f:
+        f.write(" ".join([str(bval) for bval in bvals]) + "\n")
+    np.savetxt(basename + '.bvec', np.ones((3,len(bvals))))
+    if metadata is not None:
+        with open(basename + '.json','w') as f:
+            json.dump(metadata, f)
+
+def test_run_preflight(tmp_path):
+    bids_dir = str(tmp_path / 'bids')
+    manifest_file = str(tmp_path / 'out' / 'preflight_manifest.tsv')
+    write_dwi(bids_dir, '01', '01', [0,1000,1000,2000])
+    # Frame count does not match the gradients
+    write_dwi(bids_dir, '01', '02', [0,1000,1000], n_volumes=4)
+    # No high b-value volume
+    write_dwi(bids_dir, '02', '01', [0,0,5])
+    # No TotalReadoutTime
+    write_dwi(bids_dir, '03', '01', [0,1000], metadata={'PhaseEncodingDirection': 'j'})
+    with open(os.path.join(bids_dir, 'dwi.json'),'w') as f:
+        json.dump({'PhaseEncodingDirection': 'j', 'TotalReadoutTime': 0.05}, f)
+
+    sessions = [('01','01'),('01','02'),('02','01'),('03','01')]
+    rows = preflight.run_preflight(bids_dir, sessions, 100, manifest_file)
+    assert [row['status'] for row in rows] == ['ok','error','error','ok']
+    assert rows[0]['n_dwi_volumes'] == 4
+    assert rows[0]['shells'] == '0,1000,2000'
+    assert rows[0]['topup_branch'] == 'none'
+    assert '4 volumes, but 3 b-values' in rows[1]['errors']
+    assert 'no high b-value volume' in rows[2]['errors']
+
+    # Without TotalReadoutTime in the inherited sidecar
+    os.remove(os.path.join(bids_dir, 'dwi.json'))
+    with open(os.path.join(bids_dir, 'dwi.json'),'w') as f:
+        json.dump({'PhaseEncodingDirection': 'j'}, f)
+    rows = preflight.run_preflight(bids_dir, [('03','01')], 100, manifest_file)
+    assert 'missing TotalReadoutTime' in rows[0]['errors']
+
+    manifest = preflight.read_manifest(manifest_file)
+    assert manifest[0]['status'] == 'error'
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import logging
+
+from dmri_preprocessing import scheduler
+
+logger = logging.getLogger(__name__)
+
+def test_get_max_threads():
+    # Single threaded stages
+    assert scheduler.get_max_threads('dtifit') == 1
+    # Better scaling gives more threads
+    assert scheduler.get_max_threads('dwidenoise') > scheduler.get_max_threads('n4biasfieldcorrection')
+
+def test_acquire_release():
+    budget_file = scheduler.create_cpu_budget(8)
+    try:
+        # Alone, a stage gets all cpus
+        request_a, n_threads_a = scheduler.acquire(budget_file, 'n4biasfieldcorrection')
+        assert n_threads_a == 8
+        scheduler.release(budget_file, request_a)
+
+        # With another stage waiting, a stage gets no more threads than it
+        # can use efficiently, the next stage gets the rest
+        with open(budget_file) as f:
+            budget = json.load(f)
+        budget['queue'] = [{'id': request_a, 'pid': os.getpid()}, {'id': 'waiting', 'pid': os.getpid()}]
+        with open(budget_file,'w') as f:
+            json.dump(budget, f)
+        request_a, n_threads_a = scheduler.acquire(budget_file, 'n4biasfieldcorrection')
+        assert n_threads_a == scheduler.get_max_threads('n4biasfieldcorrection')
+        with open(budget_file) as f:
+            budget = json.load(f)
+        budget['queue'] = []
+        with open(budget_file,'w') as f:
+            json.dump(budget, f)
+        request_b, n_threads_b = scheduler.acquire(budget_file, 'dwidenoise')
+        assert n_threads_b == 8 - n_threads_a
+        with open(budget_file) as f:
+            budget = json.load(f)
+        assert sorted(budget['allocations']) == sorted([request_a, request_b])
+
+        scheduler.release(budget_file, request_a)
+        scheduler.release(budget_file, request_b)
+        with open(budget_file) as f:
+            budget = json.load(f)
+        assert budget['allocations'] == {}
+    finally:
+        scheduler.remove_cpu_budget(budget_file)
+    assert not os.path.exists(budget_file)
+
+def test_allocate_environment():
+    budget_file = scheduler.create_cpu_budget(2)
+    old_value = os.environ.get('OMP_NUM_THREADS')
+    try:
+        with scheduler.allocate(budget_file, 'eddy') as n_threads:
+            assert n_threads == 2
+            assert os.environ['OMP_NUM_THREADS'] == '2'
+    finally:
+        scheduler.remove_cpu_budget(budget_file)
+    assert os.environ.get('OMP_NUM_THREADS') == old_value
+
+    with scheduler.allocate(None, 'eddy') as n_threads:
+        assert n_threads == 1
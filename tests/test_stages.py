@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import logging
+
+from dmri_preprocessing import stages
+
+logger = logging.getLogger(__name__)
+
+def mock_stage_func(in_file, out_file, calls):
+    calls.append(in_file)
+    with open(in_file) as f_in, open(out_file,'w') as f_out:
+        f_out.write(f_in.read() + "processed")
+    return {'out_file': out_file}
+
+def test_run_stage(tmp_path):
+    in_file = str(tmp_path / "in.txt")
+    out_file = str(tmp_path / "out.txt")
+    with open(in_file,'w') as f:
+        f.write("data")
+
+    stage = {
+        'name': 'mock',
+        'checkpoint_dir': str(tmp_path / 'checkpoints'),
+        'params': {'window': 5}
+    }
+    calls = []
+
+    # First run, and rerun with the same key is skipped
+    result = stages.run_stage(stage, [in_file], mock_stage_func, in_file, out_file, calls)
+    assert result == {'out_file': out_file}
+    stages.run_stage(stage, [in_file], mock_stage_func, in_file, out_file, calls)
+    assert len(calls) == 1
+
+    # Changed parameter
+    stage['params']['window'] = 7
+    stages.run_stage(stage, [in_file], mock_stage_func, in_file, out_file, calls)
+    assert len(calls) == 2
+
+    # Changed input file
+    with open(in_file,'w') as f:
+        f.write("new data")
+    stages.run_stage(stage, [in_file], mock_stage_func, in_file, out_file, calls)
+    assert len(calls) == 3
+
+    # Missing output file
+    os.remove(out_file)
+    stages.run_stage(stage, [in_file], mock_stage_func, in_file, out_file, calls)
+    assert len(calls) == 4
+    assert os.path.exists(out_file)
+
+def test_run_stage_relocated(tmp_path):
+    work_dir = str(tmp_path / 'work')
+    os.makedirs(work_dir)
+    in_file = os.path.join(work_dir, "in.txt")
+    with open(in_file,'w') as f:
+        f.write("data")
+    stage = {
+        'name': 'mock',
+        'checkpoint_dir': os.path.join(work_dir, 'checkpoints'),
+        'params': {},
+        'roots': {'WORK_DIR': work_dir}
+    }
+    calls = []
+    stages.run_stage(stage, [in_file], mock_stage_func, in_file, os.path.join(work_dir, "out.txt"), calls)
+
+    # Checkpoints are valid when the work dir is moved (with times kept)
+    moved_dir = str(tmp_path / 'moved')
+    shutil.copytree(work_dir, moved_dir)
+    stage['checkpoint_dir'] = os.path.join(moved_dir, 'checkpoints')
+    stage['roots'] = {'WORK_DIR': moved_dir}
+    in_file = os.path.join(moved_dir, "in.txt")
+    result = stages.run_stage(stage, [in_file], mock_stage_func, in_file, os.path.join(moved_dir, "out.txt"), calls)
+    assert len(calls) == 1
+    assert result == {'out_file': os.path.join(moved_dir, "out.txt")}
+
+def mock_dir_stage_func(in_file, output_dir, calls):
+    calls.append(in_file)
+    os.makedirs(os.path.join(output_dir, 'sub'), exist_ok=True)
+    for name in ['a.txt', os.path.join('sub', 'b.txt')]:
+        with open(os.path.join(output_dir, name),'w') as f:
+            f.write("processed")
+    return output_dir
+
+def test_run_stage_directory_output(tmp_path):
+    in_file = str(tmp_path / "in.txt")
+    output_dir = str(tmp_path / "out")
+    with open(in_file,'w') as f:
+        f.write("data")
+    stage = {
+        'name': 'mock',
+        'checkpoint_dir': str(tmp_path / 'checkpoints'),
+        'params': {}
+    }
+    calls = []
+    stages.run_stage(stage, [in_file], mock_dir_stage_func, in_file, output_dir, calls)
+    assert sorted(stages.get_paths(output_dir)) == [
+        os.path.join(output_dir, 'a.txt'), os.path.join(output_dir, 'sub', 'b.txt')]
+
+    # Files added to the folder later (e.g. by the next stage) are not
+    # outputs of the stage, and frames read from images are not outputs
+    with open(os.path.join(output_dir, 'c.txt'),'w') as f:
+        f.write("next stage")
+    with open(os.path.join(output_dir, 'img.nii.gz'),'w') as f:
+        f.write("image")
+    for frame in ['img_00.nii.gz', 'img_100.nii.gz']:
+        with open(os.path.join(output_dir, frame),'w') as f:
+            f.write("frame")
+        assert os.path.join(output_dir, frame) not in stages.get_paths(output_dir)
+    stages.run_stage(stage, [in_file], mock_dir_stage_func, in_file, output_dir, calls)
+    assert len(calls) == 1
+
+    # Missing file inside the output folder, and missing folder
+    os.remove(os.path.join(output_dir, 'sub', 'b.txt'))
+    stages.run_stage(stage, [in_file], mock_dir_stage_func, in_file, output_dir, calls)
+    assert len(calls) == 2
+    shutil.rmtree(output_dir)
+    stages.run_stage(stage, [in_file], mock_dir_stage_func, in_file, output_dir, calls)
+    assert len(calls) == 3
+    assert os.path.exists(os.path.join(output_dir, 'sub', 'b.txt'))
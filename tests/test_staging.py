@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import os
+import logging
+import argparse
+import pytest
+
+from dmri_preprocessing import staging
+
+logger = logging.getLogger(__name__)
+
+def make_opts(tmp_path, sync_work_dir):
+    bids_dir = tmp_path / 'bids'
+    (bids_dir / 'sub-01' / 'ses-01' / 'dwi').mkdir(parents=True)
+    (bids_dir / 'sub-01' / 'ses-02' / 'dwi').mkdir(parents=True)
+    (bids_dir / 'dataset_description.json').write_text('{}')
+    (bids_dir / 'sub-01' / 'ses-01' / 'dwi' / 'sub-01_ses-01_dwi.nii.gz').write_text('dwi')
+    return argparse.Namespace(
+        bids_dir=str(bids_dir),
+        output_dir=str(tmp_path / 'out'),
+        work_dir=str(tmp_path / 'work'),
+        scratch_dir=str(tmp_path / 'scratch'),
+        sync_work_dir=sync_work_dir
+    )
+
+def test_staged_session(tmp_path):
+    opts = make_opts(tmp_path, sync_work_dir=True)
+    with staging.staged_session(opts, '01', '01', 'app') as staged_opts:
+        # Only the inputs of the session are staged
+        assert os.path.exists(os.path.join(staged_opts.bids_dir, 'dataset_description.json'))
+        assert os.path.exists(os.path.join(staged_opts.bids_dir, 'sub-01', 'ses-01', 'dwi', 'sub-01_ses-01_dwi.nii.gz'))
+        assert not os.path.exists(os.path.join(staged_opts.bids_dir, 'sub-01', 'ses-02'))
+        # Mock processing
+        session_dir = os.path.join(staged_opts.output_dir, 'app', 'sub-01', 'ses-01', 'dwi')
+        os.makedirs(session_dir)
+        with open(os.path.join(session_dir, 'sub-01_ses-01_space-orig_desc-preproc_dwi.nii.gz'),'w') as f:
+            f.write('preproc')
+        os.symlink('sub-01_ses-01_space-orig_desc-preproc_dwi.nii.gz', os.path.join(session_dir, 'link.nii.gz'))
+        os.makedirs(os.path.join(staged_opts.work_dir, 'app_wf', 'sub-01_ses-01_wf', 'checkpoints'))
+
+    assert os.path.exists(os.path.join(opts.output_dir, 'app', 'sub-01', 'ses-01', 'dwi', 'sub-01_ses-01_space-orig_desc-preproc_dwi.nii.gz'))
+    assert os.path.islink(os.path.join(opts.output_dir, 'app', 'sub-01', 'ses-01', 'dwi', 'link.nii.gz'))
+    assert os.path.isdir(os.path.join(opts.work_dir, 'app_wf', 'sub-01_ses-01_wf', 'checkpoints'))
+    assert os.listdir(opts.scratch_dir) == []
+
+def test_staged_session_failure(tmp_path):
+    opts = make_opts(tmp_path, sync_work_dir=True)
+    with pytest.raises(RuntimeError):
+        with staging.staged_session(opts, '01', '01', 'app') as staged_opts:
+            os.makedirs(os.path.join(staged_opts.output_dir, 'app', 'sub-01', 'ses-01'))
+            os.makedirs(os.path.join(staged_opts.work_dir, 'app_wf', 'sub-01_ses-01_wf', 'checkpoints'))
+            raise RuntimeError("stage failed")
+
+    # The checkpoints are kept to resume the session, but not the outputs
+    assert os.path.isdir(os.path.join(opts.work_dir, 'app_wf', 'sub-01_ses-01_wf', 'checkpoints'))
+    assert not os.path.exists(os.path.join(opts.output_dir, 'app', 'sub-01', 'ses-01'))
+    assert os.listdir(opts.scratch_dir) == []
+
+def test_export_derivatives_incomplete(tmp_path):
+    session = tmp_path / 'out' / 'app' / 'sub-01' / 'ses-01'
+    (session / 'dwi').mkdir(parents=True)
+    (session / 'dwi' / 'sub-01_ses-01_space-orig_desc-preproc_dwi.nii.gz').write_text('published')
+    (session / 'qc').mkdir()
+    (session / 'qc' / 'qc.json').write_text('old')
+
+    # A rerun which skipped the export only has e.g. the qc files
+    staged_session = tmp_path / 'scratch' / 'app' / 'sub-01' / 'ses-01'
+    (staged_session / 'qc').mkdir(parents=True)
+    (staged_session / 'qc' / 'qc.json').write_text('new')
+    staging.export_derivatives(str(tmp_path / 'scratch'), str(tmp_path / 'out'), 'app', '01', '01')
+    assert (session / 'dwi' / 'sub-01_ses-01_space-orig_desc-preproc_dwi.nii.gz').read_text() == 'published'
+    assert (session / 'qc' / 'qc.json').read_text() == 'new'
+
+def test_swap_tree(tmp_path):
+    session = tmp_path / 'sub-01' / 'ses-01'
+    partial = tmp_path / 'sub-01' / '.ses-01.partial'
+    (session / 'dwi').mkdir(parents=True)
+    (session / 'dwi' / 'old.nii.gz').write_text('old')
+    (partial / 'dwi').mkdir(parents=True)
+    (partial / 'dwi' / 'new.nii.gz').write_text('new')
+
+    staging.swap_tree(str(partial), str(session))
+    assert os.listdir(str(session / 'dwi')) == ['new.nii.gz']
+    # Neither the partial nor the old folder is left
+    assert os.listdir(str(tmp_path / 'sub-01')) == ['ses-01']
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+import sys
+import logging
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+def test_parse_args_does_not_import_scientific_stack():
+    code = (
+        "import sys\n"
+        "from dmri_preprocessing import dmri_preprocessing\n"
+        "dmri_preprocessing.parse_args(['in','out','participant','-w','work'])\n"
+        "print(' '.join(sys.modules))\n"
+    )
+    cmd = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    modules = set(name.split('.')[0] for name in cmd.stdout.split())
+    for module in ['numpy', 'pandas', 'nibabel', 'nipype', 'bids', 'matplotlib', 'jinja2']:
+        assert module not in modules
+
+def test_version():
+    cmd = subprocess.run(
+        [sys.executable, '-c', "from dmri_preprocessing import dmri_preprocessing; dmri_preprocessing.parse_args(['--version'])"],
+        capture_output=True, text=True
+    )
+    assert cmd.returncode == 0
+    assert 'dmri_preprocessing v' in cmd.stdout
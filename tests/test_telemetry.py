@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import logging
+import subprocess
+
+from dmri_preprocessing import telemetry
+
+logger = logging.getLogger(__name__)
+
+def test_measure(tmp_path):
+    telemetry_dir = str(tmp_path / 'telemetry')
+    out_file = str(tmp_path / 'out.bin')
+
+    with telemetry.measure('mock', telemetry_dir) as record:
+        record['n_threads'] = 2
+        # cpu time of tools run by the stage is included
+        subprocess.run([sys.executable, '-c', 'sum(range(10**7))'], check=True)
+        with open(out_file,'wb') as f:
+            f.write(os.urandom(2*10**6))
+            os.fsync(f.fileno())
+
+    with open(os.path.join(telemetry_dir,'mock.json')) as f:
+        saved = json.load(f)
+    assert saved['stage'] == 'mock'
+    assert saved['status'] == 'run'
+    assert saved['n_threads'] == 2
+    assert saved['cpu_time_s'] > 0
+    assert saved['wall_time_s'] >= saved['cpu_time_s']/2
+    if os.path.exists('/proc/self/status'):
+        assert saved['peak_rss_mb'] > 0
+
+def test_write_runtime(tmp_path):
+    telemetry_dir = str(tmp_path / 'telemetry')
+    for stage_name in ['dwidenoise', 'eddy']:
+        with telemetry.measure(stage_name, telemetry_dir):
+            pass
+
+    runtime_tsv = telemetry.write_runtime(telemetry_dir, str(tmp_path / 'sub-01_ses-01_desc-'))
+    assert runtime_tsv.endswith('sub-01_ses-01_desc-runtime.tsv')
+    assert os.path.exists(runtime_tsv.replace('.tsv','.json'))
+
+    records = telemetry.read_runtime(runtime_tsv)
+    assert sorted([record['stage'] for record in records]) == ['dwidenoise', 'eddy']
+    assert list(records[0]) == telemetry.COLUMNS
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
+import os
+import json
 import pytest
 import logging
+import numpy as np
+import nibabel as nib
 
 import dmri_preprocessing.utils as utils
 import dmri_preprocessing.dmri_preprocessing as dmri_preprocessing
@@ -28,8 +32,8 @@ def test_get_bids_layout():
     opts = mock_options()
 
     bids_dir = opts.bids_dir
-    subject = opts.participant_label.replace("sub-","")
-    session = opts.session_label.replace("ses-","")
+    subject = opts.participant_label[0].replace("sub-","")
+    session = opts.session_label[0].replace("ses-","")
 
     layout, subject_data = utils.get_bids_layout(bids_dir,subject,session)
     assert bids_dir in layout.root
@@ -41,8 +45,8 @@ def test_get_overview_of_data():
     opts = mock_options()
 
     bids_dir = opts.bids_dir
-    subject = opts.participant_label.replace("sub-","")
-    session = opts.session_label.replace("ses-","")
+    subject = opts.participant_label[0].replace("sub-","")
+    session = opts.session_label[0].replace("ses-","")
 
     layout, subject_data = utils.get_bids_layout(bids_dir,subject,session)
 
@@ -70,8 +74,8 @@ def test_check_if_dataset_compatible_with_topup():
     opts = mock_options()
 
     bids_dir = opts.bids_dir
-    subject = opts.participant_label.replace("sub-","")
-    session = opts.session_label.replace("ses-","")
+    subject = opts.participant_label[0].replace("sub-","")
+    session = opts.session_label[0].replace("ses-","")
 
     layout, subject_data = utils.get_bids_layout(bids_dir,subject,session)
 
@@ -282,4 +286,131 @@ def test_edit_phase_encoding_dir_metadata():
         metadata_e = utils.edit_phase_encoding_dir_metadata(metadata)
         assert metadata_e['PhaseEncodingDirection'] == dir_e[i]
         i += 1
-    
\ No newline at end of file
+    
+def make_bids_dataset(bids_dir):
+    for subject, session in [('01','01'),('01','02'),('02','01')]:
+        dwi_dir = os.path.join(bids_dir, 'sub-'+subject, 'ses-'+session, 'dwi')
+        os.makedirs(dwi_dir)
+        basename = os.path.join(dwi_dir, 'sub-%s_ses-%s_dwi' % (subject, session))
+        nib.save(nib.Nifti1Image(np.zeros((2,2,2,3), dtype=np.int16), np.eye(4)), basename + '.nii.gz')
+    with open(os.path.join(bids_dir, 'dataset_description.json'),'w') as f:
+        json.dump({'Name': 'mock', 'BIDSVersion': '1.4.0'}, f)
+    with open(os.path.join(bids_dir, 'dwi.json'),'w') as f:
+        json.dump({'PhaseEncodingDirection': 'j'}, f)
+
+def test_get_indexed_layout(tmp_path):
+    bids_dir = str(tmp_path / 'bids')
+    index_dir = str(tmp_path / 'index')
+    make_bids_dataset(bids_dir)
+
+    layout = utils.get_indexed_layout(bids_dir, '01', '01', index_dir, 'session')
+    # Only the session and the top level files are indexed
+    root = layout.root
+    assert os.path.exists(os.path.join(root, 'dataset_description.json'))
+    assert os.path.exists(os.path.join(root, 'sub-01', 'ses-01', 'dwi', 'sub-01_ses-01_dwi.nii.gz'))
+    assert not os.path.exists(os.path.join(root, 'sub-01', 'ses-02'))
+    assert not os.path.exists(os.path.join(root, 'sub-02'))
+    dwi_file = os.path.join(root, 'sub-01', 'ses-01', 'dwi', 'sub-01_ses-01_dwi.nii.gz')
+    assert layout.get_metadata(dwi_file)['PhaseEncodingDirection'] == 'j'
+
+    # The index is reused, and rebuilt when the session changes
+    key_file = os.path.join(index_dir, 'sub-01_ses-01', 'key.json')
+    key_mtime = os.stat(key_file).st_mtime_ns
+    utils.get_indexed_layout(bids_dir, '01', '01', index_dir, 'session')
+    assert os.stat(key_file).st_mtime_ns == key_mtime
+    with open(os.path.join(bids_dir, 'sub-01', 'ses-01', 'dwi', 'sub-01_ses-01_dwi.json'),'w') as f:
+        json.dump({'PhaseEncodingDirection': 'j-'}, f)
+    layout = utils.get_indexed_layout(bids_dir, '01', '01', index_dir, 'session')
+    assert layout.get_metadata(dwi_file)['PhaseEncodingDirection'] == 'j-'
+
+    # The whole dataset
+    layout = utils.get_indexed_layout(bids_dir, '01', '01', index_dir, 'dataset')
+    assert os.path.realpath(layout.root) == os.path.realpath(bids_dir)
+    assert sorted(layout.get_subjects()) == ['01', '02']
+
+    # Reused, and rebuilt when the session or the list of sessions changes
+    key_file = os.path.join(index_dir, 'dataset', 'key.json')
+    key_mtime = os.stat(key_file).st_mtime_ns
+    utils.get_indexed_layout(bids_dir, '01', '01', index_dir, 'dataset')
+    assert os.stat(key_file).st_mtime_ns == key_mtime
+    with open(os.path.join(bids_dir, 'sub-01', 'ses-01', 'dwi', 'sub-01_ses-01_dwi.json'),'w') as f:
+        json.dump({'PhaseEncodingDirection': 'i'}, f)
+    layout = utils.get_indexed_layout(bids_dir, '01', '01', index_dir, 'dataset')
+    assert layout.get_metadata(os.path.join(bids_dir, 'sub-01', 'ses-01', 'dwi', 'sub-01_ses-01_dwi.nii.gz'))['PhaseEncodingDirection'] == 'i'
+    os.makedirs(os.path.join(bids_dir, 'sub-02', 'ses-03', 'dwi'))
+    layout = utils.get_indexed_layout(bids_dir, '02', '03', index_dir, 'dataset')
+    assert 'sub-02_ses-03' in json.load(open(key_file))['sessions']
+
+def test_load_metadata(tmp_path):
+    bids_dir = str(tmp_path / 'bids')
+    make_bids_dataset(bids_dir)
+    dwi_dir = os.path.join(bids_dir, 'sub-01', 'ses-01', 'dwi')
+    with open(os.path.join(dwi_dir, 'sub-01_ses-01_dwi.json'),'w') as f:
+        json.dump({'PhaseEncodingDirection': 'j-', 'PartialFourier': 1}, f)
+    with open(os.path.join(bids_dir, 'sub-01', 'sub-01_dwi.json'),'w') as f:
+        json.dump({'TotalReadoutTime': 0.05, 'PartialFourier': 0.75}, f)
+    # Other suffix, not inherited
+    with open(os.path.join(bids_dir, 'epi.json'),'w') as f:
+        json.dump({'TotalReadoutTime': 1.0}, f)
+
+    filenames = [
+        os.path.join(dwi_dir, 'sub-01_ses-01_dwi.nii.gz'),
+        os.path.join(bids_dir, 'sub-01', 'ses-02', 'dwi', 'sub-01_ses-02_dwi.nii.gz'),
+        os.path.join(bids_dir, 'sub-02', 'ses-01', 'dwi', 'sub-02_ses-01_dwi.nii.gz')
+    ]
+    cache = {}
+    metadata = utils.load_metadata(filenames, bids_dir, cache)
+    assert metadata[filenames[0]] == {'PhaseEncodingDirection': 'y-', 'PartialFourier': 1, 'TotalReadoutTime': 0.05}
+    assert metadata[filenames[1]] == {'PhaseEncodingDirection': 'y', 'PartialFourier': 0.75, 'TotalReadoutTime': 0.05}
+    assert metadata[filenames[2]] == {'PhaseEncodingDirection': 'y'}
+    # The top level sidecar is parsed once
+    assert len([path for path in cache['sidecars'] if path.endswith('dwi.json')]) == 3
+
+def test_nifti_extensions(tmp_path):
+    assert utils.split_nifti_ext('/a/sub-01_dwi.nii.gz') == ('/a/sub-01_dwi', '.nii.gz')
+    assert utils.split_nifti_ext('/a/sub-01_dwi.nii') == ('/a/sub-01_dwi', '.nii')
+    assert utils.replace_nifti_ext('/a/sub-01_dwi.nii', '.bval') == '/a/sub-01_dwi.bval'
+    assert utils.add_nifti_suffix('/a/dwi.nii', '_denoised') == '/a/dwi_denoised.nii'
+    assert utils.get_output_type('/a/dwi_00.nii.gz') == 'NIFTI_GZ'
+    assert utils.get_output_type('/a/dwi_00.nii') == 'NIFTI'
+
+    # Decompressed to the work dir and compressed back to the derivatives
+    image = np.arange(24, dtype=np.int16).reshape((2,2,2,3))
+    nib.save(nib.Nifti1Image(image, np.eye(4)), str(tmp_path / 'dwi.nii.gz'))
+    utils.copy_nifti(str(tmp_path / 'dwi.nii.gz'), str(tmp_path / 'work.nii'))
+    utils.copy_nifti(str(tmp_path / 'work.nii'), str(tmp_path / 'derivative.nii.gz'))
+    with open(str(tmp_path / 'work.nii'),'rb') as f:
+        assert f.read(2) != b'\x1f\x8b'
+    assert np.array_equal(np.asanyarray(nib.load(str(tmp_path / 'derivative.nii.gz')).dataobj), image)
+
+def test_link_file(tmp_path, monkeypatch):
+    raw = str(tmp_path / 'raw.bval')
+    other = str(tmp_path / 'other.bval')
+    work = str(tmp_path / 'work.bval')
+    for fname, content in [(raw, '0 1000\n'), (other, '0 2000\n')]:
+        with open(fname,'w') as f:
+            f.write(content)
+
+    assert utils.link_file(raw, work) == 'hardlink'
+    # Linking again replaces the link, and does not write through it
+    utils.link_file(other, work)
+    with open(raw) as f:
+        assert f.read() == '0 1000\n'
+    with open(work) as f:
+        assert f.read() == '0 2000\n'
+
+    # Without hardlinks, dst does not change when src is written in place
+    assert utils.link_file(raw, work, symlink=False, hardlink=False) in ['reflink', 'copy']
+    assert os.stat(work).st_ino != os.stat(raw).st_ino
+    with open(raw,'w') as f:
+        f.write('0 3000\n')
+    with open(work) as f:
+        assert f.read() == '0 1000\n'
+
+    # Without hardlinks and reflinks (e.g. across filesystems)
+    def no_link(src, dst):
+        raise OSError("Invalid cross-device link")
+    monkeypatch.setattr(os, 'link', no_link)
+    monkeypatch.setattr(utils, 'reflink_file', no_link)
+    assert utils.link_file(raw, work) == 'symlink'
+    assert os.path.realpath(work) == os.path.realpath(raw)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import logging
+
+from dmri_preprocessing import versions
+
+logger = logging.getLogger(__name__)
+
+def test_get_tool_versions(tmp_path, monkeypatch):
+    # Fake mrtrix3 installation
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    dwidenoise = bin_dir / 'dwidenoise'
+    dwidenoise.write_text("#!/bin/sh\n")
+    dwidenoise.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir))
+    monkeypatch.delenv('FSLDIR', raising=False)
+
+    probed = []
+    def mock_probe_version(tool):
+        probed.append(tool)
+        return tool + '-1.0'
+    monkeypatch.setattr(versions, 'probe_version', mock_probe_version)
+
+    cache_file = str(tmp_path / 'tool_versions.json')
+    tool_versions = versions.get_tool_versions(cache_file)
+    assert tool_versions == {'fsl': 'fsl-1.0', 'mrtrix3': 'mrtrix3-1.0', 'ants': 'ants-1.0'}
+    assert sorted(probed) == ['ants', 'fsl', 'mrtrix3']
+    with open(cache_file) as f:
+        assert json.load(f)['mrtrix3']['key']['path'] == os.path.realpath(str(dwidenoise))
+
+    # Second run is read from the cache
+    assert versions.get_tool_versions(cache_file) == tool_versions
+    assert len(probed) == 3
+
+    # A new binary is probed again
+    os.utime(str(dwidenoise), ns=(0, 0))
+    versions.get_tool_versions(cache_file)
+    assert probed[3:] == ['mrtrix3']
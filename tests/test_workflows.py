@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import logging
+import numpy as np
+
+import dmri_preprocessing.utils as utils
+import dmri_preprocessing.workflows as workflows
+from dmri_preprocessing.gradients import GradientTable
+
+logger = logging.getLogger(__name__)
+
+def mock_data(partial_fourier=1):
+    data = {}
+    data['dwi'] = [{
+        'filename': '/mock/sub-01_ses-01_dwi.nii.gz',
+        'metadata': {
+            'PhaseEncodingDirection': 'y',
+            'PartialFourier': partial_fourier,
+            'TotalReadoutTime': 0.05
+        },
+        'bval': np.array([0,1000]),
+        'b0_idx': np.array([0]),
+        'bhigh_idx': np.array([1]),
+        'gradients': GradientTable([0,1000], [[0,0,0],[1,0,0]], [0,0], 10)
+    }]
+    data['fmap'] = [
+        {
+            'filename': '/mock/sub-01_ses-01_dir-PA_epi.nii.gz',
+            'metadata': {
+                'PhaseEncodingDirection': 'y-'
+            },
+        },
+        {
+            'filename': '/mock/sub-01_ses-01_dir-AP_epi.nii.gz',
+            'metadata': {
+                'PhaseEncodingDirection': 'y'
+            },
+        },
+    ]
+    data['sbref'] = []
+    data['nifti_ext'] = '.nii.gz'
+    return data
+
+def get_dependencies(wf):
+    graph = wf._create_flat_graph()
+    return {node.name: sorted([pred.name for pred in graph.predecessors(node)]) for node in graph.nodes()}
+
+def test_init_dmri_preprocessing_wf(tmp_path):
+    data = mock_data()
+    data_raw = {
+        'subject': '01',
+        'session': '01',
+        'bids_dir': '/mock',
+        'b0_threshold': 100,
+        'fsl_version': '6.0.4',
+        'mrtrix3_version': '3.0.2',
+        'ants_version': '2.3.4',
+        'application_version': '0.3.0',
+        'nifti_ext': '.nii.gz',
+        'compression_level': 6,
+        'gc_work_dir': 'off',
+        'zarr_derivatives': False
+    }
+    topup_options, phase_encoding_directions = utils.check_if_dataset_compatible_with_topup(data)
+
+    wf = workflows.init_dmri_preprocessing_wf(data, data_raw, topup_options, phase_encoding_directions,
+        (5,5,5), None, str(tmp_path), str(tmp_path / 'derivatives'), 'dmri_preprocessing')
+    dependencies = get_dependencies(wf)
+
+    # topup on fieldmaps does not wait for denoising
+    assert dependencies['topup'] == ['gather_inputs']
+    assert dependencies['mrdegibbs'] == ['dwidenoise']
+    assert dependencies['prepare_eddy'] == ['mrdegibbs','topup']
+    # eddy_quad runs in parallel with the rest of the pipeline, its qc
+    # folder is exported with the derivatives
+    assert dependencies['eddy_quad'] == ['eddy','prepare_eddy']
+    assert 'eddy_quad' not in dependencies['n4biasfieldcorrection'] + dependencies['dtifit']
+    assert 'eddy_quad' in dependencies['to_derivatives']
+    assert dependencies['create_report'] == ['n4biasfieldcorrection','to_derivatives']
+
+    # All processing stages are checkpointed
+    stage = wf.get_node('dwidenoise').inputs.stage
+    assert stage['params']['denoise_filter_length'] == (5,5,5)
+    assert stage['checkpoint_dir'] == str(tmp_path / 'checkpoints')
+    assert stage['telemetry_dir'] == str(tmp_path / 'telemetry')
+
+    # No mrdegibbs when data is acquired with partial fourier
+    data = mock_data(partial_fourier=0.75)
+    wf = workflows.init_dmri_preprocessing_wf(data, data_raw, topup_options, phase_encoding_directions,
+        (5,5,5), None, str(tmp_path), str(tmp_path / 'derivatives'), 'dmri_preprocessing')
+    dependencies = get_dependencies(wf)
+    assert 'mrdegibbs' not in dependencies
+    assert dependencies['prepare_eddy'] == ['dwidenoise','topup']
+    assert wf.get_node('dwidenoise').inputs.stage['gc'] is None
+
+    # With --gc_work_dir, each stage knows the stages getting its result
+    data_raw['gc_work_dir'] = 'all'
+    wf = workflows.init_dmri_preprocessing_wf(mock_data(), data_raw, topup_options, phase_encoding_directions,
+        (5,5,5), None, str(tmp_path), str(tmp_path / 'derivatives'), 'dmri_preprocessing')
+    gc = wf.get_node('dwidenoise').inputs.stage['gc']
+    assert gc['mode'] == 'all'
+    assert gc['refcount_file'] == str(tmp_path / 'gc_refcounts.json')
+    assert gc['consumers'] == ['mrdegibbs','plot_dwidenoise','plot_mrdegibbs']
+    # Figures reach to_derivatives through merge_figures
+    assert wf.get_node('plot_topup').inputs.stage['gc']['consumers'] == ['to_derivatives']
+    assert wf.get_node('to_derivatives').inputs.stage['gc']['consumers'] == []
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import os
+import logging
+import numpy as np
+import nibabel as nib
+
+import dmri_preprocessing.zarrstore as zarrstore
+
+logger = logging.getLogger(__name__)
+
+def test_write_zarr(tmp_path):
+    data = np.arange(5*6*7*3, dtype=np.int16).reshape((5,6,7,3))
+    # A volume with only zeros is not stored
+    data[..., 2] = 0
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    in_file = str(tmp_path / 'dwi.nii.gz')
+    nib.save(nib.Nifti1Image(data, affine), in_file)
+
+    store_dir = str(tmp_path / 'dwi.zarr')
+    zarrstore.write_zarr(in_file, store_dir, {'bvals': [0, 1000, 1000]}, n_threads=2, chunk_size=4)
+    chunk_files = [fname for fname in os.listdir(store_dir) if not fname.startswith('.')]
+    # 2x2x2 chunks per volume, for the two volumes with data
+    assert len(chunk_files) == 16
+    assert '1.1.1.0' in chunk_files and '0.0.0.2' not in chunk_files
+
+    volume, attributes = zarrstore.read_zarr(store_dir, (slice(None), slice(None), slice(None), 1))
+    assert volume.dtype == np.int16
+    assert np.array_equal(volume, data[..., 1])
+    slab, _ = zarrstore.read_zarr(store_dir, (slice(1,5), 3))
+    assert np.array_equal(slab, data[1:5, 3])
+    assert np.array_equal(zarrstore.read_zarr(store_dir)[0], data)
+    assert attributes['bvals'] == [0, 1000, 1000]
+    assert attributes['affine'] == affine.tolist()
+    assert attributes['_ARRAY_DIMENSIONS'] == ['x', 'y', 'z', 'volume']
+
+    # Writing again replaces the store, without the chunks which are
+    # all zeros now
+    data[..., 1] = 0
+    nib.save(nib.Nifti1Image(data, affine), in_file)
+    zarrstore.write_zarr(in_file, store_dir, n_threads=2, chunk_size=4)
+    assert '1.1.1.1' not in os.listdir(store_dir)
+    assert np.array_equal(zarrstore.read_zarr(store_dir)[0], data)
+    assert sorted(os.listdir(str(tmp_path))) == ['dwi.nii.gz', 'dwi.zarr']
+
+    # Scaled images are stored as float32
+    img = nib.Nifti1Image(data, affine)
+    img.header.set_slope_inter(0.5, 1.0)
+    nib.save(img, str(tmp_path / 'scaled.nii'))
+    zarrstore.write_zarr(str(tmp_path / 'scaled.nii'), str(tmp_path / 'scaled.zarr'))
+    scaled, _ = zarrstore.read_zarr(str(tmp_path / 'scaled.zarr'))
+    assert scaled.dtype == np.float32
+    assert np.allclose(scaled[..., 0], data[..., 0] * 0.5 + 1.0)